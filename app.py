@@ -1,12 +1,12 @@
-import streamlit as st
-import pandas as pd
 import datetime
-import io
-from PIL import Image
-from gtts import gTTS
+import time
+_import_start = time.perf_counter()
+
+import streamlit as st
 
-# Import Modules
-from modules import database, ai_vision, ui_components, notifications
+# Import Modules (heavy scan-page libraries - Gemini SDK, PIL, gTTS - load lazily on first use)
+from modules import startup, database, ai_vision, ui_components, notifications, image_store, tts, schedule, metrics, export, drug_catalog
+startup.record("import app modules", time.perf_counter() - _import_start)
 
 # --- Configuration & Setup ---
 st.set_page_config(
@@ -16,93 +16,56 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# Initialize DB
-database.init_db()
-ai_vision.configure_genai()
+# Initialize DB, Gemini client and background workers (once per server process)
+try:
+    startup.run_once()
+except Exception as e:
+    # Nothing below can work without the schema; the next rerun retries the setup
+    st.error(f"เริ่มระบบไม่สำเร็จ กรุณารีเฟรชหน้าอีกครั้ง ({e})")
+    st.stop()
 
 # --- Custom CSS for Senior UI ---
-st.markdown("""
-<style>
-    /* Fluid Typography: Scales with screen width but never gets too small */
-    html, body, [class*="css"] {
-        font-family: 'Sarabun', sans-serif;
-        /* Minimum 18px, Preference 5% of viewport width, Maximum 26px */
-        font-size: clamp(20px, 5vw, 26px); 
-    }
-    
-    /* Responsive Headers */
-    h1 { 
-        font-size: clamp(2rem, 8vw, 3rem) !important; 
-        color: #1B4F72; 
-        text-align: center; 
-        margin-bottom: 20px; 
-    }
-    h2 { 
-        font-size: clamp(1.6rem, 6vw, 2.2rem) !important; 
-        color: #154360; 
-        border-bottom: 3px solid #D4E6F1; 
-        padding-bottom: 10px; 
-    }
-    h3 { font-size: 1.4rem !important; color: #21618C; }
-    p, div, label, span { font-size: 1rem !important; }
-    
-    /* Responsive Buttons */
-    .stButton > button {
-        min-height: 70px !important; /* Allow growing if text wraps */
-        height: auto !important;
-        padding-top: 15px !important;
-        padding-bottom: 15px !important;
-        font-size: clamp(1.4rem, 5vw, 1.8rem) !important;
-        font-weight: bold !important;
-        border-radius: 20px !important;
-        margin-bottom: 15px !important;
-        border: 2px solid #ccc !important;
-        box-shadow: 0px 4px 6px rgba(0,0,0,0.1);
-        white-space: normal !important; /* Allow text wrapping */
-        word-wrap: break-word !important;
-        line-height: 1.3 !important;
-    }
-    
-    /* Input fields */
-    div[data-baseweb="input"] > div {
-        min-height: 60px !important;
-        height: auto !important;
-    }
-    input {
-        font-size: 1rem !important;
-    }
-    
-    /* Checkbox/Radio size fix */
-    label[data-baseweb="checkbox"] div:first-child {
-        transform: scale(1.5); /* Scale up the checkbox box itself */
-        margin-right: 15px;
-    }
-
-    /* Container Spacing for Mobile */
-    .block-container {
-        padding-top: 2rem;
-        padding-bottom: 5rem;
-        padding-left: 1rem !important;
-        padding-right: 1rem !important;
-    }
-</style>
-""", unsafe_allow_html=True)
+ui_components.inject_global_css()
 
 # --- Session State ---
 if 'page' not in st.session_state:
     st.session_state.page = 'dashboard' # dashboard, scan, settings
+# Hidden page for maintainers: open the app with ?diagnostics=1 (add &profile=1 to profile each rerun)
+if st.query_params.get('diagnostics') == '1':
+    st.session_state.page = 'diagnostics'
+if 'patient_id' not in st.session_state:
+    st.session_state.patient_id = database.DEFAULT_PATIENT_ID # Every DB call is scoped to this patient
 
 def navigate_to(page):
     st.session_state.page = page
     st.rerun()
 
+def render_patient_picker():
+    # Only shown when the device looks after more than one patient
+    patients = database.list_patients()
+    if len(patients) < 2:
+        return
+    names = dict(zip(patients['id'], patients['name']))
+    current = st.session_state.patient_id
+    chosen = st.selectbox(
+        "👥 ผู้ป่วย", list(names), format_func=lambda pid: names[pid] or f"#{pid}",
+        index=list(names).index(current) if current in names else 0
+    )
+    if chosen != current:
+        st.session_state.patient_id = int(chosen)
+        st.rerun()
+
 # --- Pages ---
 
-def render_dashboard():
-    st.title("🏡 หน้าหลัก (ยาหมอ)")
-    
+PERIOD_MAP = schedule.PERIOD_LABELS
+
+# The dashboard is split into fragments: a click inside one only reruns that fragment,
+# not the whole script (CSS, init, every DB read and card).
+
+@ui_components.fragment
+def render_settings_banner():
     # 1. User Info / Settings Link
-    user_settings = database.get_user_settings()
+    user_settings = database.get_user_settings(st.session_state.patient_id)
     if not user_settings or not user_settings['line_token']:
         st.warning("⚠️ ยังไม่ได้ตั้งค่าผู้ดูแล (Line)")
         if st.button("⚙️ ตั้งค่าระบบ", use_container_width=True):
@@ -111,57 +74,54 @@ def render_dashboard():
         if st.button(f"⚙️ ตั้งค่า (คุณ: {user_settings['name']})", use_container_width=True):
             navigate_to('settings')
 
-    st.divider()
-
-    # 2. Urgent / Current Dose (Logic: Morning, Noon, Evening, Bedtime)
-    current_hour = datetime.datetime.now().hour
-    period = "morning"
-    if 11 <= current_hour < 16: period = "noon"
-    elif 16 <= current_hour < 20: period = "evening"
-    elif current_hour >= 20: period = "bedtime"
+@ui_components.fragment
+def render_due_meds():
+    # 2. Urgent / Current Dose
+    period = schedule.current_period() # Morning, Noon, Evening, Bedtime
+    today = datetime.date.today()
+    st.header(f"💊 ยาที่ต้องทาน: {PERIOD_MAP[period]}")
     
-    period_map = {
-        "morning": "☀️ เช้า",
-        "noon": "☀️ เที่ยง",
-        "evening": "🌆 เย็น",
-        "bedtime": "🌙 ก่อนนอน"
-    }
-    
-    st.header(f"💊 ยาที่ต้องทาน: {period_map[period]}")
-    
-    # Fetch meds
-    meds_df = database.get_medications()
-    
-    has_meds_now = False
-    if not meds_df.empty:
-        for index, row in meds_df.iterrows():
-            # Check frequency in JSON string
-            if period in row['frequency']:
-                has_meds_now = True
-                def on_take(mid, mname):
-                    success = database.log_activity(mid, 'taken', f"Taken at {period}")
-                    if success:
-                        st.success(f"เก่งมาก! ทาน {mname} แล้ว")
-                        # Line Alert
-                        if user_settings and user_settings.get('line_token') and user_settings.get('user_id'):
-                            notifications.send_line_message(
-                                user_settings['line_token'], 
-                                user_settings['user_id'],
-                                f"👵 {user_settings['name']} ทานยา '{mname}' รอบ {period_map[period]} แล้วค่ะ ✅"
-                            )
-                        st.rerun()
-                
-                ui_components.med_card(
-                    (row['id'], row['name'], row['image_path'], row['dosage'], row['frequency'], row['stock'], row['created_at']),
-                    on_click_action=on_take
-                )
-
-    if not has_meds_now:
+    # Only doses of this period that are still pending (indexed lookup on dose_instances)
+    database.ensure_dose_instances(today)
+    meds_df = database.get_pending_doses(today, period, st.session_state.patient_id)
+    if meds_df.empty:
         st.success("✅ ตอนนี้ยังไม่มียาที่ต้องทาน พักผ่อนได้เลย")
+        return
+
+    def on_take(mid, mname):
+        # Line Alert: queued in the outbox with the log, sent by the background worker
+        user_settings = database.get_user_settings(st.session_state.patient_id)
+        alert = None
+        if user_settings and user_settings.get('line_token') and user_settings.get('user_id'):
+            alert = f"👵 {user_settings['name']} ทานยา '{mname}' รอบ {PERIOD_MAP[period]} แล้วค่ะ ✅"
+        # Idempotent: a double tap finds the dose already confirmed and writes nothing
+        confirmed = database.confirm_dose(mid, period, today, 'taken', f"Taken at {period}", notify=alert)
+        if confirmed is not None:
+            st.toast(f"เก่งมาก! ทาน {mname} แล้ว" if confirmed else f"บันทึก {mname} ไว้แล้วค่ะ") # Toasts survive the rerun below
+            if confirmed and alert:
+                notifications.wake_outbox_worker()
+            ui_components.rerun_fragment() # Only this med list is rebuilt
+
+    ui_components.med_cards(
+        meds_df[['id', 'name', 'image_path', 'dosage', 'frequency', 'stock', 'created_at', 'runout_date']].itertuples(index=False),
+        on_click_action=on_take
+    )
+
+@ui_components.fragment
+def render_sos():
+    # 4. SOS Button (Ambulance Icon)
+    st.markdown(ui_components.SOS_BUTTON_HTML, unsafe_allow_html=True)
+
+def render_dashboard():
+    st.title("🏡 หน้าหลัก (ยาหมอ)")
+
+    render_patient_picker()
+    render_settings_banner()
 
     st.divider()
 
-    
+    render_due_meds()
+
     st.divider()
 
     # 3. Add New Med Button (Camera Icon)
@@ -181,49 +141,73 @@ def render_dashboard():
     
     st.divider()
     
-    # 4. SOS Button (Ambulance Icon)
-    st.markdown("""
-        <a href="tel:1669" style="text-decoration: none;">
-            <div style="
-                display: flex; flex-direction: column; justify-content: center; align-items: center;
-                width: 100%; min-height: 120px; 
-                padding: 15px;
-                background-color: #C0392B; color: white; 
-                border-radius: 25px; 
-                font-weight: bold; cursor: pointer;
-                box-shadow: 0px 5px 15px rgba(192, 57, 43, 0.4);
-                border: 4px solid white;
-                transition: transform 0.1s;
-            ">
-                <span style="font-size: 4rem; line-height: 1;">🚑</span>
-                <span style="font-size: clamp(1.6rem, 5vw, 2rem); margin-top: 5px;">แจ้งฉุกเฉิน</span>
-            </div>
-        </a>
-    """, unsafe_allow_html=True)
+    render_sos()
 
-def play_audio(text):
-    """Generates and plays TTS audio"""
+def play_audio(*segments):
+    """Plays TTS audio; fixed segments come from the on-disk cache, no network needed"""
     try:
-        tts = gTTS(text=text, lang='th')
-        sound_file = io.BytesIO()
-        tts.write_to_fp(sound_file)
-        st.audio(sound_file, format='audio/mp3', autoplay=True)
+        sound = tts.speak(*segments)
+        if sound:
+            st.audio(sound, format='audio/mp3', autoplay=True)
     except Exception as e:
         st.error(f"Audio Error: {e}")
 
+SCAN_STATE_KEYS = ('scanned_data', 'scan_upload_key', 'scan_image', 'scan_image_path', 'typed_med_name')
+
+def clear_scan_state(*extra_keys):
+    for key in SCAN_STATE_KEYS + extra_keys:
+        if key in st.session_state:
+            del st.session_state[key]
+
+def render_typed_lookup():
+    """Typed names resolve from the local drug catalog: no photo and no Gemini call needed."""
+    typed = st.text_input("🔎 หรือพิมพ์ชื่อยา (ไทย / อังกฤษ / ชื่อการค้า)", key="typed_med_name")
+    if not typed:
+        return
+    suggestions = database.search_drugs(typed)
+    if suggestions:
+        choice = st.radio(
+            "หมายถึงยานี้ใช่ไหม?", range(len(suggestions)),
+            format_func=lambda i: f"{suggestions[i]['generic_name']} ({suggestions[i]['thai_name']}) - {suggestions[i]['indication']}",
+        )
+        if st.button("✅ ใช้ข้อมูลยานี้", type="primary"):
+            strength = drug_catalog.split_strength(typed)[1]
+            st.session_state.scanned_data = ai_vision.label_from_catalog(suggestions[choice], strength)
+            st.rerun()
+    else:
+        st.caption("ไม่พบในรายการยา ถ่ายรูปฉลากให้ AI อ่าน หรือกรอกเอง")
+    if st.button("✏️ กรอกข้อมูลเอง"):
+        st.session_state.scanned_data = ai_vision.LabelRecord(medicine_name=typed)
+        st.rerun()
+
 def render_scan():
     st.title("📸 เพิ่มยาใหม่")
     if st.button("⬅️ กลับหน้าหลัก"):
         # Clear scan data when leaving
-        if 'scanned_data' in st.session_state:
-            del st.session_state.scanned_data
+        clear_scan_state('batch_rows')
         navigate_to('dashboard')
+
+    mode = st.radio("วิธีเพิ่มยา", ["ทีละรูป", "หลายรูปพร้อมกัน (ผู้ป่วยใหม่)"], horizontal=True)
+    if mode != "ทีละรูป":
+        render_batch_scan()
+        return
+
+    if 'scanned_data' not in st.session_state:
+        render_typed_lookup()
         
     # Auto-Scan Logic: Key ensures reset on new upload
     uploaded_file = st.file_uploader("ถ่ายรูปซองยา/ขวดยา", type=['jpg', 'jpeg', 'png'], key="med_upload")
     
     if uploaded_file:
-        image = Image.open(uploaded_file)
+        # Rotate/downscale/contrast once per upload and keep it in the image store;
+        # the smaller image is what Gemini receives and what the card thumbnail uses
+        upload_key = (uploaded_file.name, uploaded_file.size)
+        if st.session_state.get('scan_upload_key') != upload_key:
+            image, image_path = image_store.prepare_upload(uploaded_file)
+            st.session_state.scan_image = image
+            st.session_state.scan_image_path = image_path
+            st.session_state.scan_upload_key = upload_key
+        image = st.session_state.scan_image
         st.image(image, caption='รูปยา', use_column_width=True)
         
         # Check if we already scanned this specific file or if it's new
@@ -235,65 +219,166 @@ def render_scan():
         
         if 'scanned_data' not in st.session_state:
             with st.spinner("🤖 AI กำลังอ่านฉลากยา... รอสักครู่นะคะ"):
-                data = ai_vision.extract_medicine_info(image)
+                data = ai_vision.extract_medicine_info(image, image_path=st.session_state.scan_image_path)
                 if data:
+                    data, _ = ai_vision.apply_catalog(data) # Catalog spelling + usual dose for blank fields
                     st.session_state.scanned_data = data
                     # Audio Feedback
-                    med_name = data.get('medicine_name', 'ยา')
-                    # Create a friendly summary
-                    summary = f"เจอแล้วค่ะ {med_name} "
-                    freqs = data.get('frequency', [])
+                    med_name = data.medicine_name
+                    # Create a friendly summary (spoken as cacheable segments)
+                    summary = ["เจอแล้วค่ะ", med_name]
+                    freqs = data.frequency
                     if freqs:
                         th_freqs = []
                         if "morning" in freqs: th_freqs.append("เช้า")
                         if "noon" in freqs: th_freqs.append("เที่ยง")
                         if "evening" in freqs: th_freqs.append("เย็น")
                         if "bedtime" in freqs: th_freqs.append("ก่อนนอน")
-                        summary += f"กินช่วง {' '.join(th_freqs)} ค่ะ"
+                        summary += ["กินช่วง", *th_freqs, "ค่ะ"]
                     
-                    play_audio(summary)
+                    play_audio(*summary)
                     st.rerun()
             
     if 'scanned_data' in st.session_state:
         data = st.session_state.scanned_data
+        # A box the patient already has is a refill, not a second medication
+        existing = database.find_existing_medication(data.medicine_name, st.session_state.patient_id)
+        if existing:
+            render_scan_refill(existing)
+            with st.expander("➕ ไม่ใช่ยาตัวเดิม บันทึกเป็นยาใหม่"):
+                render_save_med_form(data)
+        else:
+            render_save_med_form(data)
+
+def render_scan_refill(existing):
+    st.info(f"📦 มียา {existing['name']} อยู่แล้ว (เหลือ {existing['stock']} เม็ด) เติมสต็อกแทนการเพิ่มยาซ้ำนะคะ")
+    with st.form("scan_refill_form"):
+        quantity = st.number_input("จำนวนที่ได้มาเพิ่ม (เม็ด)", min_value=1, value=30, step=1)
+        if st.form_submit_button("📦 เติมสต็อก", type="primary"):
+            stock = database.refill_medication(existing['id'], quantity, "scan refill")
+            if stock is not None:
+                st.success(f"เติมยาแล้ว: {existing['name']} เหลือ {stock} เม็ด")
+                play_audio("เติมยา", existing['name'], "เรียบร้อยแล้วค่ะ")
+                clear_scan_state()
+                navigate_to('dashboard')
+
+def render_save_med_form(data):
+    with st.form("save_med_form"):
+        st.success("✅ ได้ข้อมูลยาเรียบร้อย (ตรวจสอบแล้วกดบันทึกด้านล่าง)")
+        name = st.text_input("ชื่อยา", value=data.medicine_name)
+        dosage = st.text_input("ปริมาณ (เช่น 1 เม็ด)", value=data.dosage)
         
-        with st.form("save_med_form"):
-            st.success("✅ AI อ่านข้อมูลเรียบร้อย (กดบันทึกด้านล่าง)")
-            name = st.text_input("ชื่อยา", value=data.get('medicine_name', ''))
-            dosage = st.text_input("ปริมาณ (เช่น 1 เม็ด)", value=data.get('dosage', ''))
-            
-            st.subheader("ทานเวลาไหนบ้าง?")
-            # Default Checks
-            default_freq = data.get('frequency', [])
-            c1, c2, c3, c4 = st.columns(4)
-            morning = c1.checkbox("เช้า", "morning" in default_freq)
-            noon = c2.checkbox("เที่ยง", "noon" in default_freq)
-            evening = c3.checkbox("เย็น", "evening" in default_freq)
-            bedtime = c4.checkbox("ก่อนนอน", "bedtime" in default_freq)
-            
-            stock = st.number_input("จำนวนยาที่มี (เม็ด)", min_value=0, value=10)
+        st.subheader("ทานเวลาไหนบ้าง?")
+        # Default Checks
+        default_freq = data.frequency
+        c1, c2, c3, c4 = st.columns(4)
+        morning = c1.checkbox("เช้า", "morning" in default_freq)
+        noon = c2.checkbox("เที่ยง", "noon" in default_freq)
+        evening = c3.checkbox("เย็น", "evening" in default_freq)
+        bedtime = c4.checkbox("ก่อนนอน", "bedtime" in default_freq)
+        
+        stock = st.number_input("จำนวนยาที่มี (เม็ด)", min_value=0, value=10)
+        
+        # Big Save Button
+        if st.form_submit_button("💾 บันทึกข้อมูลยา", type="primary"):
+            freq_list = []
+            if morning: freq_list.append("morning")
+            if noon: freq_list.append("noon")
+            if evening: freq_list.append("evening")
+            if bedtime: freq_list.append("bedtime")
             
-            # Big Save Button
-            if st.form_submit_button("💾 บันทึกข้อมูลยา", type="primary"):
-                freq_list = []
-                if morning: freq_list.append("morning")
-                if noon: freq_list.append("noon")
-                if evening: freq_list.append("evening")
-                if bedtime: freq_list.append("bedtime")
-                
-                success = database.add_medication(name, "path/to/img", dosage, freq_list, stock)
-                if success:
-                    st.success("บันทึกเรียบร้อย!")
-                    play_audio(f"บันทึก {name} เรียบร้อยแล้วค่ะ") 
-                    del st.session_state.scanned_data
-                    navigate_to('dashboard')
+            image_path = st.session_state.get('scan_image_path', '')
+            success = database.add_medication(name, image_path, dosage, freq_list, stock, st.session_state.patient_id)
+            if success:
+                st.success("บันทึกเรียบร้อย!")
+                play_audio("บันทึก", name, "เรียบร้อยแล้วค่ะ") 
+                clear_scan_state()
+                navigate_to('dashboard')
+
+def render_batch_scan():
+    """Onboarding: read many labels at once, review them in one table, save in one go."""
+    import pandas as pd
+    uploaded_files = st.file_uploader(
+        "เลือกรูปซองยา/ขวดยาหลายรูป", type=['jpg', 'jpeg', 'png'],
+        accept_multiple_files=True, key="batch_upload"
+    )
+
+    if uploaded_files and st.button(f"🤖 อ่านฉลากทั้งหมด ({len(uploaded_files)} รูป)", type="primary", use_container_width=True):
+        total = len(uploaded_files)
+        rows = [None] * total
+        progress = st.progress(0.0, text="🤖 AI กำลังอ่านฉลากยา...")
+        # Photos are read concurrently; the bar moves as each one finishes
+        for done, (index, image_path, data, errors) in enumerate(ai_vision.scan_uploads(uploaded_files), start=1):
+            existing = None
+            if data:
+                data, _ = ai_vision.apply_catalog(data)
+                existing = database.find_existing_medication(data.medicine_name, st.session_state.patient_id)
+            freqs = data.frequency if data else []
+            rows[index] = {
+                "save": data is not None and existing is None,
+                "name": data.medicine_name if data else uploaded_files[index].name,
+                "dosage": data.dosage if data else '',
+                "morning": "morning" in freqs,
+                "noon": "noon" in freqs,
+                "evening": "evening" in freqs,
+                "bedtime": "bedtime" in freqs,
+                "stock": 10,
+                "image_path": image_path,
+            }
+            if errors and not data:
+                st.warning(f"อ่านรูป {uploaded_files[index].name} ไม่สำเร็จ กรุณากรอกเอง")
+            if existing:
+                st.info(f"{existing['name']} มีอยู่แล้ว จึงไม่ได้เลือกบันทึกซ้ำ (เติมสต็อกได้ที่หน้าตั้งค่า 💊 จัดการสต็อกยา)")
+            progress.progress(done / total, text=f"อ่านแล้ว {done}/{total} รูป")
+        st.session_state.batch_rows = rows
+
+    if 'batch_rows' in st.session_state:
+        st.subheader("ตรวจสอบข้อมูลก่อนบันทึก")
+        edited = st.data_editor(
+            pd.DataFrame(st.session_state.batch_rows),
+            column_order=["save", "name", "dosage", "morning", "noon", "evening", "bedtime", "stock"],
+            column_config={
+                "save": st.column_config.CheckboxColumn("บันทึก"),
+                "name": st.column_config.TextColumn("ชื่อยา", required=True),
+                "dosage": st.column_config.TextColumn("ปริมาณ"),
+                "morning": st.column_config.CheckboxColumn("เช้า"),
+                "noon": st.column_config.CheckboxColumn("เที่ยง"),
+                "evening": st.column_config.CheckboxColumn("เย็น"),
+                "bedtime": st.column_config.CheckboxColumn("ก่อนนอน"),
+                "stock": st.column_config.NumberColumn("จำนวน (เม็ด)", min_value=0, step=1),
+            },
+            hide_index=True,
+            use_container_width=True,
+            key="batch_editor",
+        )
+
+        if st.button("💾 บันทึกยาทั้งหมด", type="primary", use_container_width=True):
+            # Cleared or added cells come back as NaN, which int() cannot take
+            edited["stock"] = pd.to_numeric(edited["stock"], errors="coerce").fillna(0)
+            meds = [
+                {
+                    "name": row["name"],
+                    "image_path": row["image_path"],
+                    "dosage": row["dosage"],
+                    "frequency": [p for p in ("morning", "noon", "evening", "bedtime") if row[p]],
+                    "stock": int(row["stock"]),
+                }
+                for row in edited.to_dict('records')
+                if row["save"] and row["name"]
+            ]
+            if meds and database.add_medications(meds, st.session_state.patient_id):
+                st.success(f"บันทึกยา {len(meds)} รายการเรียบร้อย!")
+                play_audio("บันทึกยา", len(meds), "รายการ", "เรียบร้อยแล้วค่ะ")
+                del st.session_state.batch_rows
+                navigate_to('dashboard')
 
 def render_settings():
     st.title("⚙️ ตั้งค่าระบบ")
     if st.button("⬅️ กลับหน้าหลัก"):
         navigate_to('dashboard')
 
-    current = database.get_user_settings() or {}
+    render_patient_picker()
+    current = database.get_user_settings(st.session_state.patient_id) or {}
     
     with st.form("settings_form"):
         name = st.text_input("ชื่อผู้สูงอายุ (เช่น คุณยาย)", value=current.get('name', ''))
@@ -305,14 +390,148 @@ def render_settings():
         st.caption("ไปที่ https://developers.line.biz/console/ เพื่อสร้าง Channel และเอาค่าเหล่านี้มาใส่")
         
         if st.form_submit_button("บันทึก"):
-            database.save_user_settings(name, line_token, user_id)
+            database.save_user_settings(name, line_token, user_id, st.session_state.patient_id)
             st.success("บันทึกค่าเรียบร้อย")
             st.rerun()
 
+    render_stock_manager()
+    render_exports()
+    render_add_patient()
+
+EXPORT_FORMATS = { # label -> (writer, extension, mime)
+    "CSV (Excel)": (export.write_csv, "csv", "text/csv"),
+    "Parquet": (export.write_parquet, "parquet", "application/vnd.apache.parquet"),
+}
+
+def _download(label, writer, file_name, mime, *args):
+    # The export streams into a temp file chunk by chunk; only the finished file is handed over
+    import tempfile
+    with tempfile.TemporaryFile() as f:
+        writer(f, *args)
+        f.seek(0)
+        st.download_button(label, data=f, file_name=file_name, mime=mime, use_container_width=True)
+
+def render_adherence_summary(start, end, patient_id):
+    # Daily rollups + today's live logs: complete even for months already archived
+    counts = database.get_action_counts(start, end, patient_id)
+    counts = counts[counts[['taken', 'skipped', 'missed']].sum(axis=1) > 0].copy()
+    if counts.empty:
+        st.info("ยังไม่มีประวัติการทานยาในช่วงนี้")
+        return
+    counts['adherence'] = (100 * counts['taken'] / counts[['taken', 'skipped', 'missed']].sum(axis=1)).round().astype(int)
+    st.dataframe(
+        counts[['med_name', 'taken', 'skipped', 'missed', 'adherence']].rename(columns={
+            'med_name': 'ชื่อยา', 'taken': 'ทานแล้ว', 'skipped': 'ข้าม', 'missed': 'ลืมทาน', 'adherence': 'ทานตรง (%)'
+        }),
+        hide_index=True, use_container_width=True
+    )
+    daily = database.get_daily_adherence(start, end, patient_id)
+    if not daily.empty:
+        totals = daily.groupby('day')[['taken', 'skipped', 'missed']].sum().sort_index()
+        st.line_chart((100 * totals['taken'] / totals.sum(axis=1)).rename("ทานตรง (%)"))
+
+def render_exports():
+    st.subheader("📄 รายงานสำหรับหมอ")
+    patient_id = st.session_state.patient_id
+    c1, c2 = st.columns(2)
+    today = datetime.date.today()
+    start = c1.date_input("ตั้งแต่", value=today - datetime.timedelta(days=90))
+    end = c2.date_input("ถึง", value=today)
+    render_adherence_summary(start, end + datetime.timedelta(days=1), patient_id)
+    formats = [f for f in EXPORT_FORMATS if f != "Parquet" or export.parquet_available()]
+    fmt = st.radio("รูปแบบไฟล์", formats, horizontal=True)
+    if st.button("📝 เตรียมรายงานการทานยา", use_container_width=True):
+        writer, ext, mime = EXPORT_FORMATS[fmt]
+        _download(
+            "📥 ดาวน์โหลดรายงาน", writer, f"yamor_history_{start}_{end}.{ext}", mime,
+            start, end + datetime.timedelta(days=1), patient_id
+        )
+    if st.button("📅 เตรียมปฏิทินการทานยา (.ics)", use_container_width=True):
+        _download("📥 ดาวน์โหลดปฏิทิน (.ics)", export.write_ics, "yamor_schedule.ics", "text/calendar", patient_id)
+
+def render_add_patient():
+    with st.expander("➕ เพิ่มผู้ป่วย"):
+        with st.form("add_patient_form", clear_on_submit=True):
+            name = st.text_input("ชื่อผู้ป่วย")
+            if st.form_submit_button("เพิ่ม") and name.strip():
+                st.session_state.patient_id = database.add_patient(name.strip())
+                st.success(f"เพิ่ม {name} แล้ว")
+                st.rerun()
+
+def render_stock_manager():
+    st.subheader("💊 จัดการสต็อกยา")
+    status = database.get_refill_status(st.session_state.patient_id)
+    if status.empty:
+        st.info("ยังไม่มียาในระบบ")
+        return
+
+    st.dataframe(
+        status[['name', 'stock', 'daily_usage', 'runout_date']].rename(columns={
+            'name': 'ชื่อยา', 'stock': 'เหลือ (เม็ด)', 'daily_usage': 'ใช้ต่อวัน', 'runout_date': 'คาดว่าหมดวันที่'
+        }),
+        hide_index=True, use_container_width=True
+    )
+
+    with st.form("refill_form"):
+        names = dict(zip(status['id'], status['name']))
+        med_id = st.selectbox("ยา", list(names), format_func=names.get)
+        c1, c2 = st.columns(2)
+        quantity = c1.number_input("จำนวน (เม็ด)", min_value=0, value=30, step=1)
+        mode = c2.radio("แบบ", ["เติมยา", "นับยาใหม่"], horizontal=True)
+        if st.form_submit_button("บันทึกสต็อก"):
+            if mode == "เติมยา":
+                stock = database.refill_medication(int(med_id), quantity, "refill")
+            else:
+                stock = database.adjust_stock(int(med_id), quantity, "counted")
+            if stock is not None:
+                st.success(f"บันทึกแล้ว: {names[med_id]} เหลือ {stock} เม็ด")
+
+def _metrics_table(summaries, columns=('count', 'errors', 'p50_ms', 'p95_ms', 'max_ms', 'total_ms')):
+    import pandas as pd
+    df = pd.DataFrame.from_dict(summaries, orient='index')
+    if df.empty:
+        return df
+    return df[list(columns)].sort_values('total_ms', ascending=False)
+
+def render_diagnostics():
+    st.title("🩺 Diagnostics")
+    if st.button("⬅️ กลับหน้าหลัก"):
+        st.query_params.clear()
+        navigate_to('dashboard')
+
+    # Where the time went, per area: db (SQLite), gemini, line, tts
+    live = metrics.snapshot()
+    st.subheader("Since process start")
+    st.dataframe(_metrics_table(metrics.by_area(live), ('count', 'errors', 'total_ms')), use_container_width=True)
+    st.dataframe(_metrics_table(live), use_container_width=True)
+
+    st.subheader("Last 24 hours (flushed)")
+    if st.button("Flush now"):
+        metrics.flush()
+    st.dataframe(_metrics_table(metrics.history(86400)), use_container_width=True)
+
+    st.subheader("Startup")
+    st.code(startup.format_report())
+
+    if metrics.last_profile:
+        st.subheader("cProfile (last profiled rerun)")
+        st.code(metrics.last_profile)
+
 # --- Main Router ---
-if st.session_state.page == 'dashboard':
-    render_dashboard()
-elif st.session_state.page == 'scan':
-    render_scan()
-elif st.session_state.page == 'settings':
-    render_settings()
+def render_page():
+    if st.session_state.page == 'dashboard':
+        render_dashboard()
+    elif st.session_state.page == 'scan':
+        render_scan()
+    elif st.session_state.page == 'settings':
+        render_settings()
+    elif st.session_state.page == 'diagnostics':
+        render_diagnostics()
+
+if st.query_params.get('profile') == '1':
+    with metrics.profiled():
+        render_page()
+    with st.expander("cProfile (this rerun)"):
+        st.code(metrics.last_profile)
+else:
+    render_page()
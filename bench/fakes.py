@@ -0,0 +1,210 @@
+import base64
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import random
+import threading
+import time
+import types
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# --- Local Fake APIs ---
+# Stand-ins for the Gemini and LINE HTTP APIs, served on 127.0.0.1 so the benchmarks
+# exercise the real client code paths (sessions, timeouts, retries, circuit breaker)
+# without network access, quota or API keys. Latency and failures are injected per server.
+
+FAKE_LABEL = {
+    "medicine_name": "Paracetamol 500 mg",
+    "dosage": "1 เม็ด",
+    "frequency": ["morning", "evening"],
+    "indication": "แก้ปวด ลดไข้",
+    "warning": "ไม่ควรเกิน 8 เม็ดต่อวัน",
+}
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # Bursts of parallel webhook replies would overflow the default backlog of 5
+
+class FakeAPIServer:
+    """
+    A local HTTP server that answers every POST after latency_sec (+ up to jitter_sec),
+    failing with error_status for a random error_rate share of requests.
+    Routes:
+      POST /v2/bot/message/push           -> LINE push ({} on success)
+      POST /v2/bot/message/reply          -> LINE reply ({}; payloads kept in .replies)
+      POST /gemini/<model>:generateContent -> {"text": <label JSON>}
+    """
+
+    def __init__(self, latency_sec=0.0, jitter_sec=0.0, error_rate=0.0, error_status=500, seed=None):
+        self.latency_sec = latency_sec
+        self.jitter_sec = jitter_sec
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.replies = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _HTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, payload = fake._respond(self.path, body)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass # Keep benchmark output clean
+
+        return Handler
+
+    def _respond(self, path, body):
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += len(body)
+            delay = self.latency_sec + self._random.random() * self.jitter_sec
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        if failed:
+            return self.error_status, {"message": f"injected error {self.error_status}"}
+        if path.startswith('/gemini/'):
+            return 200, {"text": json.dumps(FAKE_LABEL, ensure_ascii=False)}
+        if path == '/v2/bot/message/push':
+            return 200, {}
+        if path == '/v2/bot/message/reply':
+            with self._lock:
+                self.replies.append(json.loads(body))
+            return 200, {}
+        return 404, {"message": "not found"}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests, "errors": self.errors,
+                "bytes_received": self.bytes_received, "replies": len(self.replies),
+            }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+# --- Fake Gemini Client ---
+_gemini_session = requests.Session()
+
+class FakeGeminiModel:
+    """
+    Drop-in for genai.GenerativeModel as used by ai_vision.ModelRouter:
+    generate_content(parts, generation_config=..., request_options={"timeout": ...}) -> object with .text.
+    Blob parts ({'mime_type', 'data'}) are uploaded as-is; PIL images are encoded the way
+    the real SDK does (lossless WebP), so upload size counts.
+    """
+
+    def __init__(self, model_name, base_url):
+        self.model_name = model_name
+        self.url = f"{base_url}/gemini/{model_name}:generateContent"
+
+    def generate_content(self, parts, generation_config=None, request_options=None):
+        timeout = (request_options or {}).get("timeout")
+        files = {}
+        texts = []
+        for i, part in enumerate(parts):
+            if isinstance(part, str):
+                texts.append(part)
+            elif isinstance(part, dict):
+                files[f"image{i}"] = ('image', part['data'], part['mime_type'])
+            else:
+                buffer = io.BytesIO()
+                part.save(buffer, format='WEBP', lossless=True)
+                files[f"image{i}"] = ('image.webp', buffer.getvalue(), 'image/webp')
+        form = {"prompt": "\n".join(texts), "generation_config": json.dumps(generation_config or {})}
+        response = _gemini_session.post(self.url, data=form, files=files, timeout=timeout)
+        if response.status_code != 200:
+            # Same wording the router's breaker looks for ('404', '429') in SDK errors
+            raise RuntimeError(f"{response.status_code} {response.json().get('message')}")
+        return types.SimpleNamespace(text=response.json()["text"])
+
+def gemini_client_factory(base_url):
+    """client_factory for ai_vision.ModelRouter pointing every model at a fake server."""
+    return lambda model_name: FakeGeminiModel(model_name, base_url)
+
+# --- Fake LINE Platform (webhook side) ---
+class FakeLinePlatform:
+    """
+    Plays LINE's part of a webhook delivery: builds events the way the platform does,
+    signs the body with the channel secret (X-Line-Signature) and POSTs it to the
+    receiver. Replies to those events land on a FakeAPIServer (.replies).
+    """
+
+    def __init__(self, webhook_url, channel_secret, destination="Ubench0000000000000000000000000000"):
+        self.webhook_url = webhook_url
+        self.channel_secret = channel_secret
+        self.destination = destination
+        self._ids = itertools.count(1)
+        self._local = threading.local() # requests.Session is not thread-safe: one per sender thread
+
+    def _event(self, kind, user_id, **fields):
+        return dict({
+            "type": kind,
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "source": {"type": "user", "userId": user_id},
+            "webhookEventId": uuid.uuid4().hex,
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": uuid.uuid4().hex,
+        }, **fields)
+
+    def text_event(self, user_id, text):
+        return self._event("message", user_id, message={"id": str(next(self._ids)), "type": "text", "text": text})
+
+    def postback_event(self, user_id, data):
+        return self._event("postback", user_id, postback={"data": data})
+
+    def sign(self, body):
+        digest = hmac.new(self.channel_secret.encode('utf-8'), body, hashlib.sha256).digest()
+        return base64.b64encode(digest).decode('ascii')
+
+    def deliver(self, events, signature=None):
+        """POSTs one webhook request carrying events. Returns the HTTP status."""
+        body = json.dumps({"destination": self.destination, "events": events}, ensure_ascii=False).encode('utf-8')
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        response = session.post(self.webhook_url, data=body, timeout=10, headers={
+            "Content-Type": "application/json",
+            "X-Line-Signature": signature if signature is not None else self.sign(body),
+        })
+        return response.status_code
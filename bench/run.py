@@ -0,0 +1,356 @@
+"""
+Ya-Mor benchmarks - seeds a synthetic database, runs the app's data paths against it
+and prints the results as JSON:
+
+    python -m bench.run --patients 20 --meds 6 --years 2 --output results.json
+    python -m bench.run --baseline results.json   # adds the change vs. a previous run
+
+Gemini and LINE are local fake servers (bench/fakes.py) with configurable latency and
+error injection, so runs are repeatable offline and cost no quota.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import line_webhook
+from modules import database, ai_vision, image_store, notifications, schedule
+from bench import fakes, seed as seeding
+
+# --- Measurement ---
+def _summary(samples):
+    ordered = sorted(samples)
+    def pct(p):
+        return ordered[min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)] * 1000
+    return {
+        "n": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+def measure(func, iterations, setup=None):
+    """Runs func 'iterations' times (setup() before each, untimed). Returns a summary."""
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return _summary(samples)
+
+# --- Benchmarks ---
+def bench_dashboard(patient_ids, iterations):
+    """The reads behind render_dashboard: settings banner + pending doses now, per patient."""
+    period = schedule.current_period()
+    today = datetime.date.today()
+    def render():
+        database.ensure_dose_instances(today)
+        for patient_id in patient_ids:
+            database.get_user_settings(patient_id)
+            database.get_pending_doses(today, period, patient_id)
+    return {
+        "cold": measure(render, iterations, setup=database.clear_cache),
+        "warm": measure(render, iterations),
+    }
+
+def bench_log_activity(med_ids, count, notify_every):
+    """Insert throughput of log_activity ('taken' + stock decrement, some with an alert)."""
+    start = time.perf_counter()
+    for i in range(count):
+        alert = "bench alert" if notify_every and i % notify_every == 0 else None
+        database.log_activity(med_ids[i % len(med_ids)], 'taken', "bench", notify=alert)
+    elapsed = time.perf_counter() - start
+    return {"n": count, "total_sec": elapsed, "rows_per_sec": count / elapsed if elapsed else None}
+
+def bench_confirm_dose(med_ids, days):
+    """confirm_dose on fresh doses (log + stock + ledger) and on already confirmed ones (double taps)."""
+    first_day = datetime.date.today() + datetime.timedelta(days=30) # Clear of the generated horizon
+    doses = [(med_id, first_day + datetime.timedelta(days=d)) for d in range(days) for med_id in med_ids]
+    results = {}
+    for name in ("first_tap", "double_tap"):
+        samples = []
+        for med_id, day in doses:
+            start = time.perf_counter()
+            database.confirm_dose(med_id, 'morning', day, 'taken', "bench")
+            samples.append(time.perf_counter() - start)
+        results[name] = _summary(samples)
+    return results
+
+def bench_activity_logs(patient_id, iterations, pages):
+    """History page latency: first page, a deep page via the keyset cursor, a month window."""
+    cursor = None
+    for _ in range(pages):
+        page = database.get_activity_logs(50, before=cursor, patient_id=patient_id)
+        cursor = database.next_page_cursor(page) or cursor
+    month_end = datetime.date.today()
+    month_start = month_end - datetime.timedelta(days=30)
+    return {
+        "first_page": measure(lambda: database.get_activity_logs(50, patient_id=patient_id), iterations, database.clear_cache),
+        f"page_{pages}": measure(
+            lambda: database.get_activity_logs(50, before=cursor, patient_id=patient_id), iterations, database.clear_cache
+        ),
+        "last_30_days": measure(
+            lambda: database.get_activity_logs(500, start=month_start, end=month_end, patient_id=patient_id),
+            iterations, database.clear_cache
+        ),
+        "adherence_30_days": measure(
+            lambda: database.get_daily_adherence(month_start, month_end, patient_id), iterations, database.clear_cache
+        ),
+    }
+
+def bench_drug_lookup(patient_id, iterations):
+    """Catalog lookups of label-style names: fuzzy search (uncached) and existing-medication detection."""
+    names = ["Sara 500mg", "amlodipin 5 mg", "เมทฟอร์มิน", "Lipitor 20mg", "Omeprazol", "unknown herbal tea"]
+    def search():
+        for name in names:
+            database.search_drugs(name)
+    def existing():
+        for name in names:
+            database.find_existing_medication(name, patient_id)
+    return {
+        "names": len(names),
+        "search": measure(search, iterations, database.clear_cache),
+        "find_existing": measure(existing, iterations, database.clear_cache),
+    }
+
+def _label_photo(rng):
+    # A phone-sized noisy photo: realistic encode/resize cost without shipping fixtures
+    from PIL import Image
+    noise = bytes(rng.getrandbits(8) for _ in range(64 * 48 * 3))
+    return Image.frombytes('RGB', (64, 48), noise).resize((4032, 3024), Image.BILINEAR)
+
+def bench_scan_to_save(patient_id, iterations, rng):
+    """Photo -> preprocess -> store -> Gemini (fake) -> add_medication; uncached and cached."""
+    photos = [_label_photo(rng) for _ in range(iterations)]
+    stages = {"preprocess": [], "store": [], "extract": [], "save": [], "total": []}
+    failures = 0
+
+    def scan(photo, use_cache):
+        nonlocal failures
+        t0 = time.perf_counter()
+        image = image_store.preprocess(photo)
+        t1 = time.perf_counter()
+        image_path = image_store.save(image)
+        t2 = time.perf_counter()
+        data, errors = ai_vision.extract_label(image, use_cache=use_cache, image_path=image_path)
+        t3 = time.perf_counter()
+        if data is None:
+            failures += 1
+        else:
+            database.add_medication(
+                data.medicine_name, image_path, data.dosage, data.frequency, 30, patient_id
+            )
+        t4 = time.perf_counter()
+        return t0, t1, t2, t3, t4
+
+    for photo in photos:
+        t0, t1, t2, t3, t4 = scan(photo, use_cache=True) # First sight of each photo: cache miss
+        for name, (a, b) in zip(stages, ((t0, t1), (t1, t2), (t2, t3), (t3, t4), (t0, t4))):
+            stages[name].append(b - a)
+    cached = []
+    for photo in photos:
+        t0, *_, t4 = scan(photo, use_cache=True)
+        cached.append(t4 - t0)
+
+    result = {name: _summary(samples) for name, samples in stages.items()}
+    result["total_cached"] = _summary(cached)
+    result["failures"] = failures
+    return result
+
+def bench_outbox(patient_ids, count):
+    """Drains the outbox plus 'count' new alerts through the fake LINE server (coalesced per patient)."""
+    for i in range(count):
+        database.enqueue_notification(f"bench alert {i}", patient_ids[i % len(patient_ids)])
+    with database.get_connection() as conn:
+        queued = conn.execute("SELECT COUNT(*) FROM notification_outbox WHERE status = 'pending'").fetchone()[0]
+    start = time.perf_counter()
+    pushes = 0
+    for _ in range(notifications.MAX_ATTEMPTS):
+        pushes += notifications.drain_outbox()
+        with database.get_connection() as conn:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM notification_outbox WHERE status IN ('pending', 'sending')"
+            ).fetchone()[0]
+        if not pending:
+            break
+        with database.get_connection() as conn: # Make retries due now instead of after the backoff
+            conn.execute("UPDATE notification_outbox SET next_attempt_at = 0 WHERE status = 'pending'")
+    elapsed = time.perf_counter() - start
+    with database.get_connection() as conn:
+        by_status = dict(conn.execute("SELECT status, COUNT(*) FROM notification_outbox GROUP BY status").fetchall())
+    return {"alerts": queued, "pushes": pushes, "total_sec": elapsed, "outbox": by_status}
+
+# --- Runner ---
+def bench_webhook(patient_ids, line, count, per_request, senders):
+    """
+    A burst of 'count' LINE webhook events (dose postbacks, double taps, "กินแล้ว" and menu
+    texts) from the fake LINE platform: request ack latency and events/s until every reply is sent.
+    """
+    secret = "bench-secret"
+    server = line_webhook.LineWebhookServer(secret, "bench-token", "127.0.0.1", 0).start_in_thread()
+    platform = fakes.FakeLinePlatform(f"http://127.0.0.1:{server.port}{server.path}", secret)
+    today = datetime.date.today()
+    doses = [ # Today's and yesterday's doses of every med, each tapped up to twice
+        (database.get_user_settings(patient_id)['user_id'], urlencode({
+            "action": "taken", "med_id": med_id, "period": period, "day": day.isoformat(),
+        }))
+        for patient_id in patient_ids
+        for med_id in database.get_medications(patient_id)['id'].tolist()
+        for period in schedule.PERIODS
+        for day in (today, today - datetime.timedelta(days=1))
+    ]
+    user_ids = [user_id for user_id, _ in doses]
+    events = []
+    for i, (user_id, data) in zip(range(count), itertools.cycle(doses * 2)):
+        if i % 20 == 0:
+            events.append(platform.text_event(user_ids[i % len(user_ids)], "กินแล้ว"))
+        elif i % 20 == 10:
+            events.append(platform.text_event(user_ids[i % len(user_ids)], "ยา"))
+        else:
+            events.append(platform.postback_event(user_id, data))
+    requests_ = [events[i:i + per_request] for i in range(0, len(events), per_request)]
+    replies_before = len(line.replies)
+
+    def deliver(chunk):
+        start = time.perf_counter()
+        status = platform.deliver(chunk)
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(senders) as pool:
+        acks = list(pool.map(deliver, requests_))
+    delivered = time.perf_counter() - start
+    server.wait_idle(120)
+    elapsed = time.perf_counter() - start
+    batches = server.writer.batches
+    server.stop_in_thread()
+    return {
+        "events": len(events),
+        "requests": len(requests_),
+        "rejected": sum(1 for status, _ in acks if status != 200),
+        "ack": _summary([latency for _, latency in acks]),
+        "delivered_sec": delivered,
+        "total_sec": elapsed,
+        "events_per_sec": len(events) / elapsed,
+        "replies": len(line.replies) - replies_before,
+        "write_batches": batches,
+    }
+
+def _compare(results, baseline, path=()):
+    # Relative change of every *_ms / *_sec / *_per_sec number that exists in both runs
+    changes = {}
+    for key, value in results.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict) and isinstance(old, dict):
+            changes.update(_compare(value, old, path + (key,)))
+        elif key.endswith(('_ms', '_sec', '_per_sec')) and isinstance(value, (int, float)) and old:
+            changes[".".join(path + (key,))] = round((value - old) / old * 100, 1)
+    return changes
+
+def run(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="yamor-bench-")
+    db_file = args.db or os.path.join(workdir, "bench.db")
+    image_store.MEDIA_DIR = os.path.join(workdir, "media")
+
+    started = time.perf_counter()
+    seeded = seeding.seed(db_file, args.patients, args.meds, args.years, args.seed)
+    seed_sec = time.perf_counter() - started
+    patients = database.list_patients()['id'].tolist()
+    meds = database.get_medications(patients[0])['id'].tolist()
+
+    gemini = fakes.FakeAPIServer(args.gemini_latency, args.gemini_jitter, args.gemini_error_rate, seed=args.seed)
+    line = fakes.FakeAPIServer(args.line_latency, args.line_jitter, args.line_error_rate, seed=args.seed)
+    with gemini, line:
+        ai_vision.set_router(ai_vision.ModelRouter(
+            ai_vision.CANDIDATE_MODELS, client_factory=fakes.gemini_client_factory(gemini.url)
+        ))
+        notifications.LINE_PUSH_URL = f"{line.url}/v2/bot/message/push"
+        notifications.COALESCE_SECONDS = 0
+
+        results = {
+            "dashboard": bench_dashboard(patients, args.iterations),
+            "activity_logs": bench_activity_logs(patients[0], args.iterations, args.pages),
+            "log_activity": bench_log_activity(meds, args.inserts, args.notify_every),
+            "confirm_dose": bench_confirm_dose(meds, max(args.inserts // max(len(meds), 1), 1)),
+            "drug_lookup": bench_drug_lookup(patients[0], args.iterations),
+            "scan_to_save": bench_scan_to_save(patients[0], args.scans, rng),
+            "outbox": bench_outbox(patients, args.alerts),
+        }
+        notifications.LINE_REPLY_URL = f"{line.url}/v2/bot/message/reply"
+        results["webhook"] = bench_webhook(patients, line, args.webhook_events, args.events_per_request, args.senders)
+        results["scan_to_save"]["gemini_server"] = gemini.stats()
+        results["outbox"]["line_server"] = line.stats()
+
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "config": vars(args),
+        "dataset": dict(seeded, seed_sec=seed_sec, db_bytes=os.path.getsize(db_file)),
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            report["change_vs_baseline_pct"] = _compare(results, json.load(f).get("results", {}))
+    database.close_connections()
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    data = parser.add_argument_group("dataset")
+    data.add_argument("--patients", type=int, default=5)
+    data.add_argument("--meds", type=int, default=5, help="medications per patient")
+    data.add_argument("--years", type=float, default=1.0, help="years of activity_logs history")
+    data.add_argument("--seed", type=int, default=0)
+    data.add_argument("--db", help="keep the seeded database at this path (default: temp dir)")
+
+    work = parser.add_argument_group("workload")
+    work.add_argument("--iterations", type=int, default=20, help="repetitions of each read benchmark")
+    work.add_argument("--pages", type=int, default=20, help="depth of the paginated history benchmark")
+    work.add_argument("--inserts", type=int, default=500, help="log_activity calls")
+    work.add_argument("--notify-every", type=int, default=10, help="every Nth log also queues an alert (0 = never)")
+    work.add_argument("--scans", type=int, default=5, help="photos for scan-to-save")
+    work.add_argument("--alerts", type=int, default=50, help="outbox alerts to drain")
+    work.add_argument("--webhook-events", type=int, default=1000, help="LINE webhook events in the burst")
+    work.add_argument("--events-per-request", type=int, default=5, help="events per webhook delivery")
+    work.add_argument("--senders", type=int, default=8, help="concurrent webhook deliveries")
+
+    fake = parser.add_argument_group("fake APIs")
+    fake.add_argument("--gemini-latency", type=float, default=0.5, help="seconds")
+    fake.add_argument("--gemini-jitter", type=float, default=0.2, help="seconds")
+    fake.add_argument("--gemini-error-rate", type=float, default=0.0)
+    fake.add_argument("--line-latency", type=float, default=0.1, help="seconds")
+    fake.add_argument("--line-jitter", type=float, default=0.05, help="seconds")
+    fake.add_argument("--line-error-rate", type=float, default=0.0)
+
+    parser.add_argument("--baseline", help="previous results JSON to compare against")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
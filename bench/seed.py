@@ -0,0 +1,108 @@
+import datetime
+import random
+
+from modules import database, schedule
+
+# --- Synthetic Data ---
+# Databases are created through database.init_db() (the app's own migrations) and
+# patients/medications through the public API, so a seeded file is interchangeable
+# with appointments.db. Only the years of history are bulk-inserted.
+
+MED_NAMES = [
+    "Paracetamol", "Amlodipine", "Metformin", "Simvastatin", "Losartan",
+    "Omeprazole", "Aspirin", "Atorvastatin", "Glipizide", "Furosemide",
+]
+DOSAGES = ["1 เม็ด", "2 เม็ด", "1/2 เม็ด", "1 ช้อนชา"]
+# Share of scheduled doses per outcome; the rest get no log at all
+OUTCOMES = (("taken", 0.85), ("skipped", 0.05), ("missed", 0.07))
+
+def _utc_text(local_dt):
+    # activity_logs.timestamp is UTC text, like SQLite's CURRENT_TIMESTAMP
+    return local_dt.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def _outcome(rng):
+    roll = rng.random()
+    for action, share in OUTCOMES:
+        if roll < share:
+            return action
+        roll -= share
+    return None
+
+def seed(db_file, patients=1, meds_per_patient=5, years=1.0, seed=0, batch_size=10000):
+    """
+    Creates (or extends) db_file with synthetic patients, medications and
+    'years' of daily activity logs. Returns a summary dict with row counts.
+    """
+    rng = random.Random(seed)
+    database.DB_FILE = db_file
+    database.init_db()
+
+    today = datetime.date.today()
+    days = max(int(years * 365), 1)
+    first_day = today - datetime.timedelta(days=days)
+    patient_ids = []
+    for p in range(patients):
+        if p == 0:
+            patient_id = database.DEFAULT_PATIENT_ID
+            database.save_user_settings(f"ผู้ป่วย {p + 1}", "bench-token", f"Ubench{p + 1}", patient_id)
+        else:
+            patient_id = database.add_patient(f"ผู้ป่วย {p + 1}", "bench-token", f"Ubench{p + 1}")
+        patient_ids.append(patient_id)
+        database.add_medications([
+            {
+                "name": f"{rng.choice(MED_NAMES)} {m + 1}",
+                "image_path": "",
+                "dosage": rng.choice(DOSAGES),
+                "frequency": sorted(rng.sample(schedule.PERIODS, rng.randint(1, 3)), key=schedule.PERIODS.index),
+                "stock": rng.randint(0, 120),
+            }
+            for m in range(meds_per_patient)
+        ], patient_id)
+
+    with database.get_connection() as conn:
+        conn.execute(
+            "UPDATE medications SET created_at = ? WHERE patient_id IN (%s)" % ",".join("?" * len(patient_ids)),
+            (f"{first_day} 00:00:00", *patient_ids)
+        )
+        meds = conn.execute(
+            "SELECT s.patient_id, s.med_id, s.period FROM medication_schedules s WHERE s.patient_id IN (%s)"
+            % ",".join("?" * len(patient_ids)), patient_ids
+        ).fetchall()
+
+    logs = 0
+    rows = []
+    def flush():
+        with database.get_connection() as conn:
+            conn.executemany(
+                "INSERT INTO activity_logs (patient_id, med_id, action, timestamp, note, period) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        rows.clear()
+
+    for offset in range(days):
+        day = first_day + datetime.timedelta(days=offset)
+        for patient_id, med_id, period in meds:
+            action = _outcome(rng)
+            if action is None:
+                continue
+            start, end = schedule.period_window(day, period)
+            if action == 'missed':
+                when, note = end - datetime.timedelta(seconds=1), f"Missed at {period}"
+            else:
+                when = start + datetime.timedelta(seconds=rng.randrange(int((end - start).total_seconds())))
+                note = f"Taken at {period}" if action == 'taken' else ""
+            rows.append((patient_id, med_id, action, _utc_text(when), note, period))
+            logs += 1
+            if len(rows) >= batch_size:
+                flush()
+    if rows:
+        flush()
+
+    database.clear_cache()
+    return {
+        "patients": len(patient_ids),
+        "medications": len({med_id for _, med_id, _ in meds}),
+        "schedules": len(meds),
+        "activity_logs": logs,
+        "days": days,
+    }
@@ -0,0 +1,362 @@
+"""
+Ya-Mor LINE Webhook - lets caregivers confirm doses from the LINE chat:
+
+    LINE_CHANNEL_SECRET=... LINE_CHANNEL_ACCESS_TOKEN=... python line_webhook.py --port 8080
+
+Set the channel's Webhook URL to https://<your host>/callback (see LINE_API_GUIDE.md).
+A caregiver whose LINE user ID is saved in Settings (or linked to the patient as a
+caregiver account) can then:
+  - send "กินแล้ว" to confirm every dose still pending in the current period
+  - send anything else to get the pending doses as quick-reply buttons, one tap per dose
+Answers use the event's reply token, so they never spend push quota; reply tokens belong to
+the channel, so its own Channel Access Token is required even for unregistered users.
+
+Every request is verified (X-Line-Signature) and acknowledged right away; its events are
+handled concurrently, and their dose confirmations are group-committed to SQLite by a
+single writer task (one transaction per burst instead of one per tap).
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlencode
+
+from modules import database, metrics, notifications, schedule
+
+MAX_BODY_BYTES = 1024 * 1024
+KEEPALIVE_SEC = 75 # Idle time before a kept-alive connection is closed
+WRITE_BATCH_MAX = 200 # Doses per SQLite transaction
+TAKEN_WORDS = {"กินแล้ว", "ทานแล้ว", "กินยาแล้ว", "ทานยาแล้ว"}
+NOTE = "Confirmed via LINE"
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+
+# --- Batched Writer ---
+class DoseWriter:
+    """
+    Collects dose confirmations from concurrent event handlers and commits whatever has
+    queued up in one database.confirm_doses() call, off the event loop. While a batch
+    commits the next one accumulates, so a burst costs a few transactions, not hundreds.
+    """
+
+    def __init__(self, max_batch=WRITE_BATCH_MAX):
+        self.max_batch = max_batch
+        self._queue = asyncio.Queue()
+        self.batches = 0
+
+    async def confirm(self, med_id, period, day, action='taken', note=NOTE):
+        """Queues one dose and waits for its commit. Returns True/False/None like confirm_dose()."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((med_id, period, day, action, note), future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(0) # Let handlers already running enqueue theirs
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            with metrics.timer("webhook.write_batch"):
+                results = await asyncio.to_thread(database.confirm_doses, [dose for dose, _ in batch])
+            self.batches += 1
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+# --- Webhook Server ---
+class LineWebhookServer:
+    """
+    A small HTTP/1.1 server on asyncio streams (no web framework needed): POST <path>
+    takes LINE webhook deliveries, GET / answers health checks.
+    """
+
+    def __init__(self, channel_secret, access_token, host='0.0.0.0', port=8080, path='/callback'):
+        self.channel_secret = channel_secret
+        self.access_token = access_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.writer = None
+        self._writer_task = None
+        self._server = None
+        self._tasks = set()
+        self._connections = set()
+        # Replies are blocking HTTPS calls: a pool keeps a burst of them in flight at once
+        self._reply_executor = ThreadPoolExecutor(notifications.REPLY_WORKERS, thread_name_prefix="line-reply")
+        self._loop = None
+        self._thread = None
+
+    # HTTP
+    async def start(self):
+        database.init_db()
+        self._loop = asyncio.get_running_loop()
+        self.writer = DoseWriter()
+        self._writer_task = asyncio.create_task(self.writer.run())
+        self._server = await asyncio.start_server(self._serve_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1] # The real one when port=0
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"[webhook] listening on {self.host}:{self.port}{self.path}")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _serve_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_SEC)
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                status = self._dispatch(method, target.split('?', 1)[0], headers, body)
+                close = headers.get('connection', '').lower() == 'close'
+                await self._respond(writer, status, close)
+                if close:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _respond(self, writer, status, close=False):
+        body = json.dumps({} if status == 200 else {"message": REASONS[status]}).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    def _dispatch(self, method, path, headers, body):
+        if method == 'GET' and path in ('/', '/healthz'):
+            return 200
+        if path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if not notifications.verify_signature(self.channel_secret, body, headers.get('x-line-signature')):
+            metrics.increment("webhook.bad_signature")
+            return 401
+        try:
+            events = json.loads(body).get('events', [])
+        except (ValueError, AttributeError):
+            return 400
+        # Acknowledge now, handle in the background: LINE only waits a few seconds per delivery
+        for event in events:
+            task = asyncio.create_task(self._handle_event(event))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return 200
+
+    async def drain(self):
+        """Waits until every event received so far has been handled and answered."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def close(self):
+        await self.drain()
+        if self._server:
+            self._server.close()
+        for writer in list(self._connections): # Kept-alive clients would otherwise hold their task open
+            writer.close()
+        if self._writer_task:
+            self._writer_task.cancel()
+        self._reply_executor.shutdown(wait=False)
+
+    # Running next to other code (benchmarks, the Streamlit process)
+    def start_in_thread(self):
+        """Serves on a daemon thread with its own event loop; returns once it is listening."""
+        ready = threading.Event()
+
+        def serve():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+        self._thread = threading.Thread(target=serve, name="line-webhook", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def wait_idle(self, timeout=None):
+        asyncio.run_coroutine_threadsafe(self.drain(), self._loop).result(timeout)
+
+    def stop_in_thread(self):
+        asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    # Events
+    async def _handle_event(self, event):
+        try:
+            with metrics.timer("webhook.event"):
+                await self._handle(event)
+        except Exception as e:
+            print(f"[webhook] event error: {e}")
+
+    async def _handle(self, event):
+        reply_token = event.get('replyToken')
+        line_user_id = (event.get('source') or {}).get('userId')
+        if event.get('type') not in ('message', 'postback', 'follow') or not reply_token:
+            return
+        # SQLite calls block: run them on a worker thread, never on the event loop
+        patients = await asyncio.to_thread(database.get_line_patients, line_user_id)
+        if not patients:
+            await self._reply(reply_token, [notifications.text_message(
+                "ยังไม่ได้ลงทะเบียนค่ะ 🙏\nนำรหัสนี้ไปใส่ในหน้าตั้งค่าของแอปยาหมอ (User ID คนดูแล):\n" + str(line_user_id)
+            )])
+            return
+
+        today = datetime.date.today()
+        period = schedule.current_period()
+        if event['type'] == 'postback':
+            messages = await self._on_postback(patients, event.get('postback', {}).get('data', ''))
+        elif event['type'] == 'message' and event.get('message', {}).get('text', '').strip() in TAKEN_WORDS:
+            messages = await self._on_taken(patients, today, period)
+        else:
+            messages = [await self._pending_menu(patients, today, period)]
+        await self._reply(reply_token, messages)
+
+    async def _pending(self, patients, day, period):
+        return await asyncio.to_thread(self._pending_sync, patients, day, period)
+
+    @staticmethod
+    def _pending_sync(patients, day, period):
+        # [(patient_id, patient name, [(med_id, med name, dosage), ...])] with something pending
+        database.ensure_dose_instances(day)
+        pending = []
+        for patient_id, name, _ in patients:
+            doses = database.get_pending_doses(day, period, patient_id)
+            if not doses.empty:
+                pending.append((patient_id, name, list(zip(doses['id'].tolist(), doses['name'], doses['dosage']))))
+        return pending
+
+    async def _pending_menu(self, patients, day, period):
+        pending = await self._pending(patients, day, period)
+        label = schedule.PERIOD_LABELS[period]
+        if not pending:
+            return notifications.text_message(f"✅ รอบ {label} ไม่มียาค้างแล้วค่ะ")
+        lines, actions = [f"💊 ยาที่ยังไม่ได้ทาน รอบ {label}"], []
+        for patient_id, name, doses in pending:
+            lines.append(f"👵 {name}")
+            lines += [f"  - {med} ({dosage})" if dosage else f"  - {med}" for _, med, dosage in doses]
+            for med_id, med, _ in doses:
+                data = urlencode({"action": "taken", "med_id": med_id, "period": period, "day": day.isoformat()})
+                actions.append(notifications.postback_action(f"✅ {med}", data, f"กิน {med} แล้ว"))
+        if len(pending) == 1:
+            actions.insert(0, notifications.message_action("✅ กินครบแล้ว", "กินแล้ว"))
+        else:
+            for patient_id, name, _ in pending:
+                data = urlencode({"action": "taken", "patient_id": patient_id, "period": period, "day": day.isoformat()})
+                actions.insert(0, notifications.postback_action(f"✅ {name} ครบ", data, f"{name} กินครบแล้ว"))
+        return notifications.text_message("\n".join(lines), actions)
+
+    async def _on_taken(self, patients, day, period):
+        pending = await self._pending(patients, day, period)
+        if len(pending) > 1:
+            # One "กินแล้ว" for several patients is ambiguous: ask with a button per patient
+            return [await self._pending_menu(patients, day, period)]
+        doses = [(med_id, med) for _, _, meds in pending for med_id, med, _ in meds]
+        return [await self._confirm(doses, period, day)]
+
+    async def _on_postback(self, patients, data):
+        params = {key: values[0] for key, values in parse_qs(data).items()}
+        action = params.get('action')
+        period = params.get('period')
+        try:
+            day = datetime.date.fromisoformat(params.get('day', ''))
+            patient_id = int(params['patient_id']) if 'patient_id' in params else None
+            med_id = int(params.get('med_id', 0))
+        except ValueError:
+            print(f"[webhook] bad postback: {data!r}")
+            return []
+        if action not in ('taken', 'skipped') or period not in schedule.PERIODS:
+            return []
+        if abs((day - datetime.date.today()).days) > 1: # Buttons from today's (or last night's) menu only
+            return []
+        allowed = {p[0] for p in patients}
+        if patient_id is not None:
+            if patient_id not in allowed:
+                return []
+            pending = await self._pending([p for p in patients if p[0] == patient_id], day, period)
+            doses = [(med_id, med) for _, _, meds in pending for med_id, med, _ in meds]
+        else:
+            med = await asyncio.to_thread(database.get_medication, med_id)
+            if med is None or med['patient_id'] not in allowed: # Only doses of this user's own patients
+                return []
+            doses = [(med['id'], med['name'])]
+        return [await self._confirm(doses, period, day, action)]
+
+    async def _confirm(self, doses, period, day, action='taken'):
+        label = schedule.PERIOD_LABELS[period]
+        if not doses:
+            return notifications.text_message(f"✅ รอบ {label} ไม่มียาค้างแล้วค่ะ")
+        results = await asyncio.gather(*(
+            self.writer.confirm(med_id, period, day.isoformat(), action) for med_id, _ in doses
+        ))
+        done = [name for (_, name), ok in zip(doses, results) if ok]
+        already = [name for (_, name), ok in zip(doses, results) if ok is False]
+        if any(ok is None for ok in results):
+            return notifications.text_message("⚠️ บันทึกไม่สำเร็จ ลองใหม่อีกครั้งนะคะ")
+        verb = "กิน" if action == 'taken' else "ข้าม"
+        lines = []
+        if done:
+            lines.append(f"✅ บันทึก{verb}ยารอบ {label} แล้ว: {', '.join(done)}")
+        if already:
+            lines.append(f"(บันทึกไว้ก่อนแล้ว: {', '.join(already)})")
+        return notifications.text_message("\n".join(lines))
+
+    async def _reply(self, reply_token, messages):
+        if not messages:
+            return
+        ok, error = await self._loop.run_in_executor(
+            self._reply_executor, notifications.reply_message, self.access_token, reply_token, messages
+        )
+        if not ok:
+            print(f"[webhook] reply failed: {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    parser.add_argument("--path", default="/callback", help="webhook path (default /callback)")
+    args = parser.parse_args()
+
+    secret = os.environ.get("LINE_CHANNEL_SECRET")
+    if not secret:
+        parser.error("set LINE_CHANNEL_SECRET (LINE Developers Console > Basic settings > Channel secret)")
+    access_token = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
+    if not access_token:
+        parser.error("set LINE_CHANNEL_ACCESS_TOKEN (LINE Developers Console > Messaging API > Channel access token)")
+    server = LineWebhookServer(secret, access_token, args.host, args.port, args.path)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Ya-Mor Maintenance - keeps activity_logs and the DB file small. Run it once a day
+(cron / scheduled task), next to the app:
+
+    python maintenance.py                       # rollups, archive, vacuum
+    python maintenance.py --retention-days 365  # keep a year of raw logs in SQLite
+
+1. Finished days are summed into daily_adherence (what the reports read).
+2. Raw logs of whole months older than the retention window move to
+   archive/activity_logs_YYYY-MM.csv.gz (still included in doctor exports).
+   Dose instances older than a few weeks are dropped (the rollups keep the history).
+3. Freed pages are returned with an incremental vacuum.
+"""
+import argparse
+import time
+
+from modules import archive, database
+
+def run(retention_days=None, skip_archive=False, vacuum_pages=None):
+    database.init_db()
+    started = time.perf_counter()
+    summary = {"rolled_up_days": database.rollup_daily_adherence()}
+    if not skip_archive:
+        summary["archived_rows"] = archive.archive_old_logs(retention_days)
+    summary["dose_instances_pruned"] = database.prune_dose_instances()
+    summary["vacuum_pages_freed"], summary["db_pages"] = database.vacuum_incremental(vacuum_pages)
+    summary["seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--retention-days", type=int, default=None,
+                        help=f"raw logs to keep in SQLite (default {archive.RETENTION_DAYS}, env YAMOR_LOG_RETENTION_DAYS)")
+    parser.add_argument("--skip-archive", action="store_true", help="only roll up and vacuum")
+    parser.add_argument("--vacuum-pages", type=int, default=None, help="free at most this many pages (default: all)")
+    args = parser.parse_args()
+
+    summary = run(args.retention_days, args.skip_archive, args.vacuum_pages)
+    for key, value in summary.items():
+        print(f"[maintenance] {key}: {value}")
+
+if __name__ == "__main__":
+    main()
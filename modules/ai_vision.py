@@ -1,58 +1,398 @@
-import google.generativeai as genai
 import streamlit as st
+import hashlib
 import json
+import os
+import threading
 import time
+from dataclasses import dataclass, field, asdict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from modules import database, drug_catalog, image_store, metrics, startup
+from modules.schedule import PERIODS
+
+def _genai():
+    # google.generativeai takes ~1 s to import; only the scan page needs it
+    return startup.lazy_import('google.generativeai')
+
+def _config(name, default):
+    # Same lookup order as the API key: Streamlit secrets, then environment variable
+    try:
+        value = st.secrets.get(name)
+    except Exception:
+        value = None
+    value = value or os.environ.get(name)
+    return type(default)(value) if value else default
+
+# --- Extraction Cache ---
+# Refill photos of the same box are the common case, so results are cached in SQLite
+# by image content (exact pixels). Matching near-identical photos by perceptual hash is
+# opt-in (YAMOR_VISION_PHASH_DISTANCE, e.g. 4): boxes of one brand in different strengths
+# (Metformin 500 / 850) hash alike, and a wrong cached dose must never come back silently.
+CACHE_TTL_DAYS = _config("YAMOR_VISION_CACHE_TTL_DAYS", 180)
+CACHE_MAX_ENTRIES = _config("YAMOR_VISION_CACHE_MAX_ENTRIES", 500)
+PHASH_MAX_DISTANCE = _config("YAMOR_VISION_PHASH_DISTANCE", 0)
+
+def _dhash(image, hash_size=8):
+    # Difference hash: compares neighbouring pixels of a tiny grayscale copy (64 bits)
+    from PIL import Image
+    gray = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def image_fingerprint(image):
+    """Returns (content hash, perceptual hash) of an image."""
+    normalized = image.convert('RGB') # Same pixels hash the same, whatever the file format/metadata
+    digest = hashlib.sha256()
+    digest.update(f"{normalized.size}".encode())
+    digest.update(normalized.tobytes())
+    return digest.hexdigest(), _dhash(normalized)
+
+# --- Model Router ---
+# Models to try (Newer models first)
+CANDIDATE_MODELS = [
+    'gemini-2.0-flash',
+    'gemini-flash-latest',
+    'gemini-1.5-flash',
+    'gemini-1.5-pro',
+]
+
+MODEL_TIMEOUT_SEC = _config("YAMOR_VISION_MODEL_TIMEOUT_SEC", 20.0)
+SCAN_DEADLINE_SEC = _config("YAMOR_VISION_DEADLINE_SEC", 30.0) # Whole scan, across all models
+# Hedged mode: if the current model has not answered after this many seconds, also ask
+# the next one and keep whichever valid answer comes first. 0 = off (pure fallback).
+HEDGE_AFTER_SEC = _config("YAMOR_VISION_HEDGE_AFTER_SEC", 0.0)
+
+# Circuit breaker: a model that keeps failing is skipped for a while instead of being
+# retried (and waited on) by every scan
+FAILURE_THRESHOLD = 2
+COOLDOWN_SEC = 60
+QUOTA_COOLDOWN_SEC = 600 # 429 / ResourceExhausted
+NOT_FOUND_COOLDOWN_SEC = 86400 # Deprecated or unknown model name
+
+class ModelRouter:
+    """
+    Holds one client per model (built once) and per-model health.
+    client_factory(name) must return an object with
+    generate_content(parts, generation_config=..., request_options=...);
+    by default it is genai.GenerativeModel.
+    """
+
+    def __init__(self, model_names, client_factory=None):
+        client_factory = client_factory or _genai().GenerativeModel
+        self.model_names = list(model_names)
+        self._clients = {name: client_factory(name) for name in self.model_names}
+        self._failures = {name: 0 for name in self.model_names}
+        self._open_until = {name: 0.0 for name in self.model_names}
+        self._lock = threading.Lock()
+
+    def available_models(self):
+        """Models whose circuit is closed, in preference order."""
+        now = time.time()
+        with self._lock:
+            ready = [n for n in self.model_names if self._open_until[n] <= now]
+            if not ready:
+                # Everything is cooling down: probe the one that recovers first (half-open)
+                ready = [min(self.model_names, key=lambda n: self._open_until[n])]
+        return ready
+
+    def record_success(self, name):
+        with self._lock:
+            self._failures[name] = 0
+            self._open_until[name] = 0.0
+
+    def record_failure(self, name, error):
+        kind = type(error).__name__
+        text = str(error)
+        with self._lock:
+            if kind == 'NotFound' or '404' in text:
+                self._open_until[name] = time.time() + NOT_FOUND_COOLDOWN_SEC
+            elif kind == 'ResourceExhausted' or '429' in text:
+                self._open_until[name] = time.time() + QUOTA_COOLDOWN_SEC
+            elif isinstance(error, ValueError):
+                pass # Unparseable answer: the model is healthy, it just formatted badly
+            else:
+                self._failures[name] += 1
+                if self._failures[name] >= FAILURE_THRESHOLD:
+                    self._open_until[name] = time.time() + COOLDOWN_SEC
+
+    def _call(self, name, parts, parse, timeout, generation_config):
+        # One sample per model attempt: latency, and failures (timeouts, quota, bad JSON)
+        with metrics.timer(f"gemini.{name}"):
+            response = self._clients[name].generate_content(
+                parts, generation_config=generation_config, request_options={"timeout": timeout}
+            )
+            return parse(response.text)
+
+    def generate(self, parts, parse, deadline_sec=None, hedge_after_sec=None, generation_config=None):
+        """
+        Asks the available models in order until one returns a parseable answer.
+        Never takes longer than deadline_sec overall. Returns (result, model_name, errors);
+        result is None when every model failed or the deadline passed.
+        """
+        deadline_sec = deadline_sec or SCAN_DEADLINE_SEC
+        hedge_after_sec = HEDGE_AFTER_SEC if hedge_after_sec is None else hedge_after_sec
+        deadline = time.time() + deadline_sec
+        models = self.available_models()
+        queue = iter(models)
+        pending = {}
+        errors = []
+        # Every call gets its own workers (one per model it may ask), so concurrent scans
+        # never queue behind each other and use up their deadline before starting
+        executor = ThreadPoolExecutor(max_workers=len(models), thread_name_prefix="gemini")
+
+        def launch_next():
+            for name in queue:
+                timeout = min(MODEL_TIMEOUT_SEC, max(deadline - time.time(), 0.1))
+                pending[executor.submit(self._call, name, parts, parse, timeout, generation_config)] = name
+                return True
+            return False
+
+        try:
+            return self._race(pending, launch_next, deadline, deadline_sec, hedge_after_sec, errors)
+        finally:
+            # Nothing still waiting to start may reach Gemini once the call is over
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _race(self, pending, launch_next, deadline, deadline_sec, hedge_after_sec, errors):
+        launch_next()
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            wait_for = min(remaining, hedge_after_sec) if hedge_after_sec > 0 else remaining
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            if not done:
+                if hedge_after_sec > 0:
+                    launch_next() # Slow answer: hedge with the next model (no-op when none left)
+                continue
+
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self.record_failure(name, e)
+                    errors.append(f"{name}: {str(e)}")
+                    continue
+                self.record_success(name)
+                metrics.increment(f"gemini.answered_by.{name}")
+                return result, name, errors
+
+            if not pending:
+                launch_next()
+
+        if pending:
+            errors.append(f"timeout after {deadline_sec:g}s: {', '.join(pending.values())}")
+            for name in pending.values(): # Too slow counts against the model like any failure
+                self.record_failure(name, TimeoutError(f"no answer within {deadline_sec:g}s"))
+        return None, None, errors
+
+_router = None
+_api_key = None
+_router_lock = threading.Lock()
 
 def configure_genai():
+    """
+    Resolves the API key (cheap, run once at startup). The SDK itself is imported and
+    configured by get_router() on the first scan.
+    """
+    global _api_key
     api_key = st.secrets.get("GEMINI_API_KEY")
     if not api_key:
         # Check system env var as fallback
-        import os
         api_key = os.environ.get("GEMINI_API_KEY")
     
     if api_key:
-        genai.configure(api_key=api_key)
+        _api_key = api_key
         return True
     return False
 
-def extract_medicine_info(image):
-    # Models to try (Newer models first)
-    candidate_models = [
-        'gemini-2.0-flash',
-        'gemini-flash-latest',
-        'gemini-1.5-flash',
-        'gemini-1.5-pro',
-    ]
-
-    prompt = """
-    คุณคือเภสัชกรผู้เชี่ยวชาญ ช่วยดูรูปซองยาหรือขวดยานี้ แล้วดึงข้อมูลสำคัญออกมาเป็น JSON format ดังนี้:
-    {
-        "medicine_name": "ชื่อยา (ภาษาอังกฤษหรือไทย)",
-        "dosage": "ปริมาณการทาน (เช่น 1 เม็ด, 2 ช้อนชา)",
-        "frequency": ["morning", "noon", "evening", "bedtime"],  <-- เลือกเฉพาะช่วงเวลาที่ต้องทานจากฉลาก (ถ้ามี 'ก่อนอาหาร/หลังอาหาร' ไม่ต้องใส่ ให้ใส่แค่ช่วงเวลา)
-        "indication": "สรรพคุณ (รักษาอะไร - สั้นๆ)",
-        "warning": "คำเตือนสำคัญ (ถ้ามี)"
-    }
-    
-    กฏการตอบ:
-    1. ถ้าหาชื่อยาไม่เจอ ให้ใส่ "ไม่ระบุ"
-    2. frequency ต้องเป็น Array ของ string: "morning" (เช้า), "noon" (กลางวัน), "evening" (เย็น), "bedtime" (ก่อนนอน) เท่านั้น
-    3. ตอบกลับเฉพาะ JSON เท่านั้น ไม่ต้องมี markdown block
+def get_router():
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                if _api_key:
+                    _genai().configure(api_key=_api_key)
+                _router = ModelRouter(CANDIDATE_MODELS)
+    return _router
+
+def set_router(router):
+    """Replaces the model router (e.g. with fake clients for benchmarks)."""
+    global _router
+    _router = router
+
+# --- Label Extraction ---
+# Gemini answers in JSON mode against RESPONSE_SCHEMA, so the reply is always parseable
+# and 'frequency' can only hold the four periods; the prompt therefore only says what to read.
+PROMPT = """อ่านฉลากยาในรูปนี้ในฐานะเภสัชกร
+- frequency: ช่วงเวลาที่ต้องทาน (เช้า=morning, กลางวัน=noon, เย็น=evening, ก่อนนอน=bedtime) ไม่ต้องใส่ก่อน/หลังอาหาร
+- ถ้าหาชื่อยาไม่เจอ ให้ medicine_name เป็น "ไม่ระบุ"
+- indication และ warning สั้นๆ เป็นภาษาไทย"""
+
+RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "medicine_name": {"type": "STRING", "description": "ชื่อยา (อังกฤษหรือไทย)"},
+        "dosage": {"type": "STRING", "description": "ปริมาณต่อครั้ง เช่น 1 เม็ด, 2 ช้อนชา"},
+        "frequency": {"type": "ARRAY", "items": {"type": "STRING", "enum": list(PERIODS)}},
+        "indication": {"type": "STRING"},
+        "warning": {"type": "STRING"},
+    },
+    "required": ["medicine_name", "dosage", "frequency"],
+}
+
+GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA,
+    "temperature": 0.0,
+}
+
+UNKNOWN_NAME = "ไม่ระบุ"
+# Thai period words that older cached results (or a lenient model) may contain
+_THAI_PERIODS = {"เช้า": "morning", "กลางวัน": "noon", "เที่ยง": "noon", "เย็น": "evening", "ก่อนนอน": "bedtime"}
+
+def _text(value):
+    if value is None or isinstance(value, (dict, list)):
+        return ""
+    return str(value).strip()
+
+@dataclass
+class LabelRecord:
+    """A validated label reading. from_dict() never fails: bad fields fall back one by one."""
+    medicine_name: str = UNKNOWN_NAME
+    dosage: str = ""
+    frequency: list = field(default_factory=list) # Subset of PERIODS, in PERIODS order
+    indication: str = ""
+    warning: str = ""
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+        frequency = data.get("frequency")
+        if isinstance(frequency, str):
+            frequency = frequency.replace(",", " ").split()
+        if not isinstance(frequency, list):
+            frequency = []
+        words = {_THAI_PERIODS.get(_text(p), _text(p).lower()) for p in frequency}
+        return cls(
+            medicine_name=_text(data.get("medicine_name")) or UNKNOWN_NAME,
+            dosage=_text(data.get("dosage")),
+            frequency=[p for p in PERIODS if p in words],
+            indication=_text(data.get("indication")),
+            warning=_text(data.get("warning")),
+        )
+
+    def to_dict(self):
+        return asdict(self)
+
+def label_from_catalog(drug, strength=""):
+    """A LabelRecord from a database.search_drugs() entry (typed name, no photo needed)."""
+    return LabelRecord(
+        medicine_name=f"{drug['generic_name']} {strength}".strip(),
+        dosage=drug['dosage'],
+        frequency=list(drug['frequency']),
+        indication=drug['indication'],
+        warning=drug['warning'],
+    )
+
+def apply_catalog(record):
+    """
+    Normalizes a label reading against the local drug catalog. On a full match the name
+    becomes the generic name (keeping the strength on the label); a partial one - e.g. one
+    ingredient of a combination product - keeps the scanned name. Either way empty fields
+    take the catalog's usual values. Returns (record, fully matched catalog drug or None).
+    """
+    drug = database.match_drug(record.medicine_name)
+    close = drug or next(iter(database.search_drugs(record.medicine_name, 1, database.MATCH_MIN_SCORE)), None)
+    if close is None:
+        return record, None
+    suggested = label_from_catalog(close, drug_catalog.split_strength(record.medicine_name)[1])
+    return LabelRecord(
+        medicine_name=suggested.medicine_name if drug else record.medicine_name,
+        dosage=record.dosage or suggested.dosage,
+        frequency=record.frequency or suggested.frequency,
+        indication=record.indication or suggested.indication,
+        warning=record.warning or suggested.warning,
+    ), drug
+
+def _parse_response(text):
+    # JSON mode returns bare JSON; a ValueError here means a broken reply (the model stays healthy)
+    return LabelRecord.from_dict(json.loads(text))
+
+def _image_part(image, image_path=None):
+    # Gemini gets the compact JPEG the image store keeps: handed a PIL image, the SDK
+    # would re-encode it as lossless WebP, several times larger
+    if image_path and os.path.isfile(image_path):
+        with open(image_path, 'rb') as f:
+            data = f.read()
+    else:
+        data = image_store.encode_jpeg(image)
+    return {'mime_type': 'image/jpeg', 'data': data}
+
+def extract_label(image, use_cache=True, image_path=None):
     """
+    Reads a medicine label without any Streamlit UI (safe to call from worker threads).
+    image is used for the cache fingerprint; Gemini is sent the stored JPEG at image_path
+    (or the image encoded the same way). Returns (LabelRecord, errors); the record is
+    None when no model could read it.
+    """
+    ttl_seconds = CACHE_TTL_DAYS * 86400
+    if use_cache:
+        image_hash, phash = image_fingerprint(image)
+        cached = database.get_cached_extraction(image_hash, phash, PHASH_MAX_DISTANCE, ttl_seconds)
+        if cached:
+            metrics.increment("gemini.cache_hit")
+            return LabelRecord.from_dict(cached), []
+
+    with metrics.timer("gemini.scan") as sample: # Whole scan, across fallbacks and hedges
+        data, model_name, errors = get_router().generate(
+            [PROMPT, _image_part(image, image_path)], _parse_response, generation_config=GENERATION_CONFIG
+        )
+        sample.ok = data is not None
+    if data is not None and use_cache:
+        database.save_cached_extraction(image_hash, phash, data.to_dict(), CACHE_MAX_ENTRIES, ttl_seconds)
+    return data, errors
 
+def extract_medicine_info(image, use_cache=True, image_path=None):
     with st.spinner('🤖 AI กำลังอ่านฉลากยา... (เภสัชกรส่วนตัวกำลังทำงาน)'):
-        errors = []
-        for model_name in candidate_models:
-            try:
-                model = genai.GenerativeModel(model_name)
-                response = model.generate_content([prompt, image])
-                text = response.text.replace('```json', '').replace('```', '').strip()
-                data = json.loads(text)
-                return data
-            except Exception as e:
-                errors.append(f"{model_name}: {str(e)}")
-                continue
+        data, errors = extract_label(image, use_cache, image_path)
+        if data is not None:
+            return data
 
         # Fallback if all fail
         st.error(f"❌ ไม่สามารถอ่านฉลากยาได้\n{errors}")
         return None
+
+# --- Batch Scanning ---
+BATCH_WORKERS = _config("YAMOR_VISION_BATCH_WORKERS", 3) # Bounded: Gemini rate limits per key
+
+def _scan_upload(uploaded_file):
+    image, image_path = image_store.prepare_upload(uploaded_file)
+    data, errors = extract_label(image, image_path=image_path)
+    return image_path, data, errors
+
+def scan_uploads(uploaded_files, max_workers=None):
+    """
+    Preprocesses, stores and reads many uploaded photos concurrently.
+    Yields (index, image_path, data, errors) as each photo finishes (any order).
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or BATCH_WORKERS, thread_name_prefix="scan") as pool:
+        futures = {pool.submit(_scan_upload, f): i for i, f in enumerate(uploaded_files)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                image_path, data, errors = future.result()
+            except Exception as e:
+                image_path, data, errors = '', None, [str(e)]
+            yield index, image_path, data, errors
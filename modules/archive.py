@@ -0,0 +1,96 @@
+import csv
+import datetime
+import gzip
+import os
+
+from modules import database
+
+# --- Activity Log Archive ---
+# Raw activity_logs older than RETENTION_DAYS (and already in the daily_adherence rollup)
+# move out of SQLite into one gzip'd CSV per UTC month: archive/activity_logs_YYYY-MM.csv.gz.
+# Only whole months are archived, so each file is written once; reading one back is a
+# streaming decompress, used for doctor reports that reach that far back.
+ARCHIVE_DIR = 'archive'
+RETENTION_DAYS = int(os.environ.get("YAMOR_LOG_RETENTION_DAYS", 180))
+COLUMNS = ['id', 'patient_id', 'med_id', 'med_name', 'action', 'timestamp', 'note', 'period']
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"activity_logs_{month}.csv.gz")
+
+def archive_month(month):
+    """Writes a month of raw logs to its archive file, then deletes them from the DB. Returns rows moved."""
+    path = archive_path(month)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    exists = month in database.get_log_archives()
+    # A month archived before only gets a new gzip member appended (readers see one stream);
+    # otherwise the file is built aside and swapped in, so a crash never leaves half a file
+    target = path if exists else f"{path}.tmp{os.getpid()}"
+    rows = 0
+    with gzip.open(target, 'at' if exists else 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        if not exists:
+            writer.writerow(COLUMNS)
+        for chunk in database.iter_log_month(month):
+            writer.writerows(chunk)
+            rows += len(chunk)
+    if not exists:
+        os.replace(target, path)
+    if rows:
+        database.delete_archived_month(month, path, rows)
+    return rows
+
+def archive_old_logs(retention_days=None):
+    """Archives every whole month older than the retention window. Returns {month: rows}."""
+    retention_days = RETENTION_DAYS if retention_days is None else retention_days
+    before = datetime.date.today() - datetime.timedelta(days=retention_days)
+    return {month: archive_month(month) for month in database.get_archivable_months(before)}
+
+def _utc_text(value):
+    # Same conversion as the live queries: local date/datetime -> activity_logs UTC text
+    if value is None:
+        return None
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    return value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def _months_between(lo, hi):
+    # Archived months that can hold rows of the UTC window [lo, hi)
+    return [
+        (month, path) for month, path in sorted(database.get_log_archives().items())
+        if (lo is None or month >= lo[:7]) and (hi is None or month <= hi[:7])
+    ]
+
+def iter_archived_logs(start=None, end=None, patient_id=database.DEFAULT_PATIENT_ID, chunk_size=database.EXPORT_CHUNK_ROWS):
+    """
+    Archived logs of one patient in the local window [start, end), oldest month first,
+    as lists of (id, timestamp, med_id, med_name, action, period, note) - the same
+    shape as database.iter_activity_logs().
+    """
+    lo, hi = _utc_text(start), _utc_text(end)
+    patient = str(patient_id)
+    chunk = []
+    for month, path in _months_between(lo, hi):
+        if not os.path.exists(path):
+            print(f"[archive] missing file for {month}: {path}")
+            continue
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                if row['patient_id'] != patient:
+                    continue
+                if (lo and row['timestamp'] < lo) or (hi and row['timestamp'] >= hi):
+                    continue
+                chunk.append((
+                    int(row['id']), row['timestamp'], int(row['med_id']), row['med_name'],
+                    row['action'], row['period'] or None, row['note'],
+                ))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+def query_archive(start=None, end=None, patient_id=database.DEFAULT_PATIENT_ID):
+    """Archived logs as a DataFrame (on demand - loads the whole window)."""
+    import pandas as pd
+    rows = [row for chunk in iter_archived_logs(start, end, patient_id) for row in chunk]
+    return pd.DataFrame(rows, columns=['id', 'timestamp', 'med_id', 'med_name', 'action', 'period', 'note'])
@@ -1,14 +1,231 @@
 import sqlite3
 import datetime
+import ast
+import json
+import math
+import re
+import functools
+import queue
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 import pandas as pd
 import streamlit as st
 
+from modules import drug_catalog
+from modules.schedule import PERIODS, PERIOD_LABELS, period_window
+
 DB_FILE = 'appointments.db' # Keeping the same DB file for simplicity, but we will add new tables
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
+# Patients are rows of 'users' (role 'patient'); every table is keyed by patient_id.
+# Single-patient installs keep using user 1, which is what every default below points at.
+DEFAULT_PATIENT_ID = 1
+
+# --- Connection Pool ---
+# Streamlit reruns the whole script on every click, and every session runs in its own
+# thread. Instead of sqlite3.connect() per call we keep a small pool of long-lived
+# connections (WAL mode, so readers never block the writer) and lend them out.
+POOL_SIZE = 8
+BUSY_TIMEOUT_SEC = 10
+STATEMENT_CACHE_SIZE = 128
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_db_file = None
+
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL", # Only takes effect on a new file; vacuum_incremental() converts old ones
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",   # Safe with WAL, avoids fsync on every commit
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",     # ~8 MB page cache per connection
+    "PRAGMA mmap_size=67108864",   # 64 MB memory-mapped reads
+)
+
+def _new_connection():
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=BUSY_TIMEOUT_SEC,
+        check_same_thread=False, # Connections move between Streamlit threads via the pool
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def _reset_pool_if_moved():
+    # DB_FILE may be swapped (e.g. tests, benchmarks); drop connections to the old file
+    global _pool_db_file
+    if _pool_db_file == DB_FILE:
+        return
+    with _pool_lock:
+        if _pool_db_file == DB_FILE:
+            return
+        close_connections()
+        _pool_db_file = DB_FILE
+
+def close_connections():
+    """Closes every idle pooled connection."""
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            return
+        conn.close()
+
+@contextmanager
+def get_connection():
+    """
+    Borrows a pooled connection.
+    Commits when the block succeeds, rolls back when it raises, then returns
+    the connection to the pool (or closes it if the pool is already full).
+    """
+    _reset_pool_if_moved()
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _new_connection()
+
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+# --- Read Cache ---
+# Streamlit reruns call the same getters over and over, so reads are memoized per process.
+# Each cached getter declares the tables it reads; every write bumps the generation of
+# the tables it touched, which makes the dependent entries stale on their next lookup.
+# The least recently used entries are dropped beyond CACHE_MAX_ENTRIES (every date
+# window and page cursor is its own key, so the key space is unbounded).
+CACHE_MAX_ENTRIES = 1024
+_generations = defaultdict(int)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_seen_generations = {} # table -> table_generations.generation this process last saw
+
+def _invalidate(*tables):
+    with _cache_lock:
+        for table in tables:
+            _generations[table] += 1
+    _publish_writes(tables)
+
+def _publish_writes(tables):
+    # Shared per-table counters, so other processes invalidate exactly these tables
+    try:
+        with get_connection() as conn:
+            rows = conn.execute(f'''
+                INSERT INTO table_generations (name, generation) VALUES {", ".join(["(?, 1)"] * len(tables))}
+                ON CONFLICT(name) DO UPDATE SET generation = generation + 1
+                RETURNING name, generation
+            ''', tables).fetchall()
+        _seen_generations.update(rows)
+    except sqlite3.OperationalError:
+        pass # Not migrated yet (no table_generations): only this process knows about the write
+
+def clear_cache():
+    """Drops every cached read (e.g. after editing the DB file from outside the app)."""
+    with _cache_lock:
+        _cache.clear()
+
+def _copy(value):
+    # Callers get their own copy, so mutating a DataFrame/dict never corrupts the cache
+    return value.copy() if hasattr(value, 'copy') else value
+
+# Other processes (reminder engine, webhook) write to the same file. SQLite's
+# data_version changes whenever another connection commits, so a dedicated probe
+# connection tells us - at most once per EXTERNAL_CHECK_SEC - to compare the shared
+# table_generations with the ones we saw, and invalidate only the tables that moved.
+# (Our own writes change data_version too, but leave nothing to invalidate.)
+EXTERNAL_CHECK_SEC = 1.0
+_probe = None
+_probe_checked_at = 0.0
+
+def open_change_probe():
+    """
+    Returns a function that reports True when any other connection (in this or another
+    process) has committed since its previous call.
+    """
+    conn = _new_connection()
+    last = [conn.execute("PRAGMA data_version").fetchone()[0]]
+    lock = threading.Lock()
+
+    def changed():
+        with lock:
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == last[0]:
+                return False
+            last[0] = version
+            return True
+    return changed
+
+def _apply_external_writes():
+    with get_connection() as conn:
+        rows = conn.execute("SELECT name, generation FROM table_generations").fetchall()
+    with _cache_lock:
+        for table, generation in rows:
+            if _seen_generations.get(table) != generation:
+                _seen_generations[table] = generation
+                _generations[table] += 1
+
+def _check_external_writes():
+    global _probe, _probe_checked_at
+    now = time.monotonic()
+    if now - _probe_checked_at < EXTERNAL_CHECK_SEC:
+        return
+    _probe_checked_at = now
+    try:
+        if _probe is None:
+            _probe = open_change_probe()
+            _apply_external_writes()
+        elif _probe():
+            _apply_external_writes()
+    except sqlite3.Error:
+        _probe = None
+
+def _cached(*tables):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _check_external_writes()
+            key = (func.__name__, DB_FILE, args, tuple(sorted(kwargs.items())))
+            with _cache_lock:
+                stamp = tuple(_generations[t] for t in tables)
+                hit = _cache.get(key)
+                if hit is not None and hit[0] == stamp:
+                    _cache.move_to_end(key)
+            if hit is not None and hit[0] == stamp:
+                return _copy(hit[1])
+
+            # Stamp was taken before the query: a write that lands meanwhile leaves
+            # this entry stale rather than wrongly fresh
+            value = func(*args, **kwargs)
+            with _cache_lock:
+                _cache[key] = (stamp, value)
+                _cache.move_to_end(key)
+                while len(_cache) > CACHE_MAX_ENTRIES:
+                    _cache.popitem(last=False)
+            return _copy(value)
+        return wrapper
+    return decorator
+
+# --- Schema Migrations ---
+# Each step runs exactly once per database, in order, and is recorded in schema_version.
+# To change the schema: append a new step to MIGRATIONS (never edit an applied one).
+# Steps are frozen: they inline every rule they apply instead of calling the helpers
+# below, which keep changing, so a database migrated next year ends up like one
+# migrated today.
+
+def _migration_001_base_tables(c):
     # 1. Users (Caregivers/Patient Pair)
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -60,96 +277,1557 @@ def init_db():
         )
     ''')
 
-    conn.commit()
-    conn.close()
+def _migration_002_users_line_user_id(c):
+    # Databases created by V1 have no 'user_id' column (LINE Notify only needed the token)
+    columns = [row[1] for row in c.execute("PRAGMA table_info(users)")]
+    if 'user_id' not in columns:
+        c.execute("ALTER TABLE users ADD COLUMN user_id TEXT")
+
+def _migration_003_activity_log_indexes(c):
+    # get_activity_logs joins on med_id and sorts by timestamp DESC
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp ON activity_logs(timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_med_timestamp ON activity_logs(med_id, timestamp)")
+
+def _migration_004_medication_schedules(c):
+    # One row per (medication, period) instead of a list repr in medications.frequency,
+    # so "what is due now" is an indexed lookup. time_of_day is reserved for clock times.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS medication_schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            med_id INTEGER NOT NULL,
+            period TEXT NOT NULL, -- 'morning', 'noon', 'evening', 'bedtime'
+            time_of_day TEXT, -- Optional 'HH:MM'
+            UNIQUE(med_id, period),
+            FOREIGN KEY(med_id) REFERENCES medications(id) ON DELETE CASCADE
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_medication_schedules_period ON medication_schedules(period, med_id)")
+
+    # Backfill from the old str(list) column and rewrite it as real JSON
+    known = ('morning', 'noon', 'evening', 'bedtime')
+    rows = c.execute("SELECT id, frequency FROM medications").fetchall()
+    for med_id, frequency in rows:
+        try:
+            listed = ast.literal_eval(frequency or '[]') # "['morning', 'evening']"
+        except (ValueError, SyntaxError):
+            listed = [p for p in known if p in (frequency or '')]
+        periods = [p for p in known if isinstance(listed, (list, tuple)) and p in listed]
+        c.executemany(
+            "INSERT OR IGNORE INTO medication_schedules (med_id, period) VALUES (?, ?)",
+            [(med_id, p) for p in periods]
+        )
+        c.execute("UPDATE medications SET frequency = ? WHERE id = ?", (json.dumps(periods), med_id))
+
+def _migration_005_activity_log_action_index(c):
+    # Per-medication counts and "last taken" read (med_id, action, timestamp) straight from the index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_med_action_timestamp ON activity_logs(med_id, action, timestamp)")
+
+def _migration_006_notification_outbox(c):
+    # LINE alerts are written here in the same transaction as the log that caused them,
+    # and sent later by the background worker in modules.notifications.
+    # Times are unix seconds so the worker can do backoff arithmetic directly.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id INTEGER NOT NULL, -- users.id whose LINE settings are used
+            message TEXT NOT NULL,
+            status TEXT DEFAULT 'pending', -- 'pending', 'sending', 'sent', 'failed'
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            sent_at REAL,
+            FOREIGN KEY(owner_id) REFERENCES users(id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_status ON notification_outbox(status, next_attempt_at)")
+
+def _migration_007_vision_cache(c):
+    # Gemini label-extraction results keyed by image content, so a re-scanned box
+    # (the common case for refills) never needs another network round-trip
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS vision_cache (
+            image_hash TEXT PRIMARY KEY, -- sha256 of the normalized pixels
+            phash INTEGER, -- 64-bit difference hash for near-identical photos
+            result TEXT NOT NULL, -- JSON returned by extract_medicine_info
+            created_at REAL NOT NULL,
+            last_hit_at REAL NOT NULL,
+            hits INTEGER DEFAULT 0
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_vision_cache_last_hit ON vision_cache(last_hit_at)")
+
+def _migration_008_activity_log_period(c):
+    # Which dose period a log belongs to, so missed-dose detection is a direct lookup
+    c.execute("ALTER TABLE activity_logs ADD COLUMN period TEXT")
+    # Logs written by the dashboard so far carry it in the note: "Taken at <period>"
+    c.execute("UPDATE activity_logs SET period = substr(note, 10) WHERE note LIKE 'Taken at %'")
+
+def _migration_009_stock_ledger(c):
+    # Every stock change is a row here; medications.stock stays as the running balance
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stock_movements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            med_id INTEGER NOT NULL,
+            kind TEXT NOT NULL, -- 'dose', 'refill', 'adjustment'
+            quantity INTEGER NOT NULL, -- Signed change actually applied to the stock
+            stock_after INTEGER NOT NULL,
+            note TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(med_id) REFERENCES medications(id)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_med ON stock_movements(med_id, created_at)")
+
+    # Refill forecast, kept up to date on every movement so the dashboard only reads it
+    c.execute("ALTER TABLE medications ADD COLUMN dose_units INTEGER DEFAULT 1") # Units per dose
+    c.execute("ALTER TABLE medications ADD COLUMN daily_usage REAL DEFAULT 0") # Units per day (schedule)
+    c.execute("ALTER TABLE medications ADD COLUMN runout_date TEXT") # Projected local date of stock 0
+    c.execute("ALTER TABLE medications ADD COLUMN stock_alert_level INTEGER") # Lowest LOW_STOCK_DAYS already alerted
+
+    rows = c.execute('''
+        SELECT m.id, m.dosage, m.stock, COUNT(s.id)
+        FROM medications m LEFT JOIN medication_schedules s ON s.med_id = m.id
+        GROUP BY m.id
+    ''').fetchall()
+    today = datetime.date.today()
+    for med_id, dosage, stock, doses_per_day in rows:
+        # Whole units per dose: "2 เม็ด" -> 2, "1/2 tablet" -> 1, no number -> 1
+        match = re.search(r"(\d+(?:\.\d+)?)(?:\s*/\s*(\d+))?", str(dosage or ''))
+        dose_units = 1
+        if match:
+            value = float(match.group(1)) / ((float(match.group(2)) or 1) if match.group(2) else 1)
+            dose_units = max(math.ceil(value), 1)
+        stock = max(stock or 0, 0) # The old 'stock - 1' could go negative
+        daily_usage = doses_per_day * dose_units
+        runout_date = None
+        if daily_usage:
+            runout_date = (today + datetime.timedelta(days=math.floor(stock / daily_usage))).isoformat()
+        c.execute(
+            "UPDATE medications SET stock = ?, dose_units = ?, daily_usage = ?, runout_date = ? WHERE id = ?",
+            (stock, dose_units, daily_usage, runout_date, med_id)
+        )
+        c.execute(
+            "INSERT INTO stock_movements (med_id, kind, quantity, stock_after, note) VALUES (?, 'adjustment', ?, ?, 'opening balance')",
+            (med_id, stock, stock)
+        )
+
+def _migration_010_patient_tenancy(c):
+    # One deployment serves many patients: every row gets an owner, and every hot
+    # index is led by patient_id so per-patient queries never touch other patients' rows
+    for table in ('medications', 'medication_schedules', 'activity_logs', 'stock_movements'):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN patient_id INTEGER NOT NULL DEFAULT 1")
+    c.execute("UPDATE users SET role = 'patient' WHERE role IS NULL")
+    # Existing rows were all defaulted to patient 1, so it must exist
+    c.execute("INSERT OR IGNORE INTO users (id, name, role) VALUES (1, '', 'patient')")
+
+    # A caregiver (users.role = 'caregiver') can look after many patients
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS caregiver_patients (
+            caregiver_id INTEGER NOT NULL,
+            patient_id INTEGER NOT NULL,
+            PRIMARY KEY (caregiver_id, patient_id),
+            FOREIGN KEY(caregiver_id) REFERENCES users(id),
+            FOREIGN KEY(patient_id) REFERENCES users(id)
+        )
+    ''')
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_medications_patient ON medications(patient_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_medication_schedules_patient_period ON medication_schedules(patient_id, period, med_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_patient_timestamp ON activity_logs(patient_id, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_patient ON stock_movements(patient_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_owner ON notification_outbox(owner_id, status)")
+    # Superseded by the patient-led versions above
+    c.execute("DROP INDEX IF EXISTS idx_activity_logs_timestamp")
+    c.execute("DROP INDEX IF EXISTS idx_medication_schedules_period")
+
+def _migration_011_metrics(c):
+    # One row per metric name and flush window (see modules/metrics.py)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            window_start REAL NOT NULL, -- Unix time
+            name TEXT NOT NULL, -- e.g. 'db.get_pending_doses', 'gemini.gemini-2.0-flash'
+            count INTEGER NOT NULL,
+            errors INTEGER NOT NULL DEFAULT 0,
+            total_ms REAL NOT NULL,
+            max_ms REAL NOT NULL,
+            buckets TEXT NOT NULL -- JSON {bucket index: samples}
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_metrics_window ON metrics(window_start)")
+
+def _migration_012_daily_rollups(c):
+    # Finished days of activity_logs, summed per patient/day/med by the maintenance job,
+    # so reports never rescan (or need) years of raw rows
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_adherence (
+            patient_id INTEGER NOT NULL,
+            day TEXT NOT NULL, -- Local date 'YYYY-MM-DD'
+            med_id INTEGER NOT NULL,
+            taken INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            missed INTEGER NOT NULL DEFAULT 0,
+            last_taken TIMESTAMP, -- Latest 'taken' log of the day (UTC, like activity_logs)
+            PRIMARY KEY (patient_id, day, med_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_daily_adherence_med ON daily_adherence(med_id, day)")
+    # Key/value bookkeeping of background jobs (e.g. 'rollup_through')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    # Raw logs moved out to compressed monthly files (modules/archive.py)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS log_archives (
+            month TEXT PRIMARY KEY, -- 'YYYY-MM' (UTC, like activity_logs.timestamp)
+            path TEXT NOT NULL,
+            rows INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _migration_013_dose_instances(c):
+    # One row per expected dose (med, local day, period), generated ahead of time.
+    # Confirming flips 'pending' exactly once, so double taps cannot log/decrement/alert twice.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS dose_instances (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            med_id INTEGER NOT NULL,
+            day TEXT NOT NULL, -- Local date 'YYYY-MM-DD'
+            period TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', -- 'pending', 'taken', 'skipped', 'missed'
+            confirmed_at TIMESTAMP,
+            UNIQUE(med_id, day, period),
+            FOREIGN KEY(med_id) REFERENCES medications(id) ON DELETE CASCADE
+        )
+    ''')
+    # "What is still due" only ever looks at pending rows
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_dose_instances_pending
+        ON dose_instances(patient_id, day, period) WHERE status = 'pending'
+    ''')
+    # Today's and tomorrow's doses; a medication only owes doses whose period ends
+    # (local time) after it was added. Timestamps are compared in UTC, like created_at.
+    today = datetime.date.today()
+    period_ends = {'morning': 11, 'noon': 16, 'evening': 20, 'bedtime': 24}
+
+    def utc(value):
+        return value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    for offset in range(2):
+        day = today + datetime.timedelta(days=offset)
+        for period, end_hour in period_ends.items():
+            end = datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(hours=end_hour)
+            c.execute('''
+                INSERT OR IGNORE INTO dose_instances (patient_id, med_id, day, period)
+                SELECT s.patient_id, s.med_id, ?, s.period
+                FROM medication_schedules s
+                JOIN medications m ON m.id = s.med_id
+                WHERE s.period = ? AND m.created_at < ?
+            ''', (day.isoformat(), period, utc(end)))
+    # Doses already logged today are not pending any more
+    midnight = utc(datetime.datetime.combine(today, datetime.time()))
+    c.execute('''
+        UPDATE dose_instances SET status = (
+            SELECT l.action FROM activity_logs l
+            WHERE l.med_id = dose_instances.med_id AND l.period = dose_instances.period
+              AND l.timestamp >= ? AND l.action IN ('taken', 'skipped', 'missed')
+            ORDER BY l.id DESC LIMIT 1
+        ), confirmed_at = CURRENT_TIMESTAMP
+        WHERE day = ? AND EXISTS (
+            SELECT 1 FROM activity_logs l
+            WHERE l.med_id = dose_instances.med_id AND l.period = dose_instances.period
+              AND l.timestamp >= ? AND l.action IN ('taken', 'skipped', 'missed')
+        )
+    ''', (midnight, today.isoformat(), midnight))
+
+def _migration_014_drug_catalog(c):
+    # Local medicine catalog with a trigram index over every known spelling, so a scanned
+    # or typed name is normalized without a network call. The rows themselves are
+    # reference data, loaded (and reloaded when it changes) by _sync_drug_catalog().
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS drug_catalog (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            generic_name TEXT NOT NULL UNIQUE,
+            thai_name TEXT,
+            dosage TEXT, -- Usual dose, e.g. '1 เม็ด'
+            frequency TEXT, -- JSON list of usual periods
+            indication TEXT,
+            warning TEXT
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS drug_names (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            drug_id INTEGER NOT NULL,
+            name TEXT NOT NULL, -- As written: generic, Thai or brand
+            name_key TEXT NOT NULL UNIQUE, -- drug_catalog.normalize_name(name)
+            grams INTEGER NOT NULL, -- Number of trigrams (for the similarity score)
+            FOREIGN KEY(drug_id) REFERENCES drug_catalog(id) ON DELETE CASCADE
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS drug_name_trigrams (
+            trigram TEXT NOT NULL,
+            name_id INTEGER NOT NULL,
+            PRIMARY KEY (trigram, name_id)
+        ) WITHOUT ROWID
+    ''')
+    # Which catalog drug a medication is, so a re-scanned box is recognized as a refill
+    c.execute("ALTER TABLE medications ADD COLUMN drug_id INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_medications_drug ON medications(patient_id, drug_id)")
+
+def _migration_015_table_generations(c):
+    # A write counter per table, bumped by every process after it writes (see the read
+    # cache), so each process invalidates only the cached reads of the tables that changed
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS table_generations (
+            name TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_016_recount_dose_units(c):
+    # dose_units used to take the first number of the dosage text, so "5 mg" took 5 units
+    # off the stock per dose. Recount with the rule of that time: only a number followed
+    # by a count unit, strengths removed first.
+    strength = re.compile(
+        r"(\d+(?:[.,]\d+)?)\s*(mg|mcg|µg|ug|g|ml|iu|units?|%|มก\.?|มิลลิกรัม|ไมโครกรัม|กรัม|มล\.?)(?![a-z])",
+        re.IGNORECASE,
+    )
+    count = re.compile(
+        r"(\d+(?:\.\d+)?)(?:\s*/\s*(\d+))?\s*(?:เม็ด|แคปซูล|ช้อน|ซอง|หยด|tab|cap|pill|sachet|spoon|drop|puff)",
+        re.IGNORECASE,
+    )
+    today = datetime.date.today()
+    rows = c.execute('''
+        SELECT m.id, m.dosage, m.stock, m.dose_units, COUNT(s.id)
+        FROM medications m LEFT JOIN medication_schedules s ON s.med_id = m.id
+        GROUP BY m.id
+    ''').fetchall()
+    for med_id, dosage, stock, old_units, doses_per_day in rows:
+        text = strength.sub(" ", unicodedata.normalize('NFKC', str(dosage or ''))).strip(" -,/")
+        match = count.search(text)
+        dose_units = 1
+        if match:
+            value = float(match.group(1)) / ((float(match.group(2)) or 1) if match.group(2) else 1)
+            dose_units = max(math.ceil(value), 1)
+        if dose_units == old_units:
+            continue
+        daily_usage = doses_per_day * dose_units
+        runout_date = None
+        if daily_usage:
+            runout_date = (today + datetime.timedelta(days=math.floor((stock or 0) / daily_usage))).isoformat()
+        # Low-stock alerts sent from the wrong usage start over
+        c.execute(
+            "UPDATE medications SET dose_units = ?, daily_usage = ?, runout_date = ?, stock_alert_level = NULL WHERE id = ?",
+            (dose_units, daily_usage, runout_date, med_id)
+        )
+
+MIGRATIONS = [
+    (1, _migration_001_base_tables),
+    (2, _migration_002_users_line_user_id),
+    (3, _migration_003_activity_log_indexes),
+    (4, _migration_004_medication_schedules),
+    (5, _migration_005_activity_log_action_index),
+    (6, _migration_006_notification_outbox),
+    (7, _migration_007_vision_cache),
+    (8, _migration_008_activity_log_period),
+    (9, _migration_009_stock_ledger),
+    (10, _migration_010_patient_tenancy),
+    (11, _migration_011_metrics),
+    (12, _migration_012_daily_rollups),
+    (13, _migration_013_dose_instances),
+    (14, _migration_014_drug_catalog),
+    (15, _migration_015_table_generations),
+    (16, _migration_016_recount_dose_units),
+]
+
+_migrated_db_file = None
+_migrate_lock = threading.Lock()
+
+def init_db():
+    """
+    Brings the schema up to date.
+    Cheap to call on every rerun: migrations only run once per process.
+    """
+    global _migrated_db_file
+    if _migrated_db_file == DB_FILE:
+        return
+    with _migrate_lock:
+        if _migrated_db_file == DB_FILE:
+            return
+        migrate()
+        _sync_drug_catalog()
+        _migrated_db_file = DB_FILE
+
+def get_schema_version():
+    with get_connection() as conn:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def migrate():
+    """Applies every pending migration, each in its own transaction."""
+    with get_connection() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+    if get_schema_version() >= MIGRATIONS[-1][0]:
+        return
+
+    for version, step in MIGRATIONS:
+        with get_connection() as conn:
+            # IMMEDIATE takes the write lock up front, so two processes starting
+            # together cannot apply the same step twice
+            conn.execute("BEGIN IMMEDIATE")
+            done = conn.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,)).fetchone()
+            if not done:
+                step(conn.cursor())
+                conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
 
 # --- Medication Functions ---
-def add_medication(name, image_path, dosage, frequency, stock):
+def parse_frequency(frequency):
+    """
+    Returns the known periods in a frequency value, in PERIODS order.
+    Accepts a list, a JSON string, or the legacy str(list) repr.
+    """
+    if isinstance(frequency, str):
+        try:
+            frequency = json.loads(frequency)
+        except ValueError:
+            try:
+                frequency = ast.literal_eval(frequency)
+            except (ValueError, SyntaxError):
+                frequency = [p for p in PERIODS if p in frequency]
+    if not isinstance(frequency, (list, tuple, set)):
+        return []
+    return [p for p in PERIODS if p in frequency]
+
+# Units the stock is counted in. A number followed by anything else is a strength or a
+# volume ("5 mg", "10 ml" - labels often put those in the dosage field), not a count.
+_COUNT_UNITS = re.compile(
+    r"(\d+(?:\.\d+)?)(?:\s*/\s*(\d+))?\s*(?:เม็ด|แคปซูล|ช้อน|ซอง|หยด|tab|cap|pill|sachet|spoon|drop|puff)",
+    re.IGNORECASE,
+)
+
+def parse_dose_units(dosage):
+    """
+    Whole units taken per dose from free text: "2 เม็ด" -> 2, "1/2 tablet" -> 1,
+    "500 mg 1 tab" -> 1. Anything without a counted number ("5 mg", "10 ml") counts as 1.
+    """
+    text, _ = drug_catalog.split_strength(dosage)
+    match = _COUNT_UNITS.search(text)
+    if not match:
+        return 1
+    value = float(match.group(1))
+    if match.group(2):
+        value /= float(match.group(2)) or 1
+    return max(math.ceil(value), 1)
+
+def _insert_medication(c, patient_id, name, image_path, dosage, frequency, stock):
+    periods = parse_frequency(frequency)
+    dose_units = parse_dose_units(dosage)
+    daily_usage = len(periods) * dose_units
+    stock = max(int(stock or 0), 0)
+    match = _match_drug(c, name)
+    c.execute('''
+        INSERT INTO medications (patient_id, name, image_path, dosage, frequency, stock, dose_units, daily_usage, runout_date, drug_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        patient_id, name, image_path, dosage, json.dumps(periods), stock, dose_units, daily_usage,
+        _runout_date(stock, daily_usage), match['drug_id'] if match else None,
+    ))
+    med_id = c.lastrowid
+    c.executemany(
+        "INSERT INTO medication_schedules (patient_id, med_id, period) VALUES (?, ?, ?)",
+        [(patient_id, med_id, p) for p in periods]
+    )
+    c.execute('''
+        INSERT INTO stock_movements (patient_id, med_id, kind, quantity, stock_after, note)
+        VALUES (?, ?, 'adjustment', ?, ?, 'opening balance')
+    ''', (patient_id, med_id, stock, stock))
+    _generate_doses(c, datetime.date.today(), DOSE_HORIZON_DAYS, med_id)
+
+# Every table _insert_medication() writes
+_MEDICATION_TABLES = ('medications', 'medication_schedules', 'stock_movements', 'dose_instances')
+
+def add_medication(name, image_path, dosage, frequency, stock, patient_id=DEFAULT_PATIENT_ID):
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO medications (name, image_path, dosage, frequency, stock)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (name, image_path, dosage, str(frequency), stock))
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            _insert_medication(conn.cursor(), patient_id, name, image_path, dosage, frequency, stock)
+        _invalidate(*_MEDICATION_TABLES)
         return True
     except Exception as e:
         st.error(f"Error adding medication: {e}")
         return False
 
-def get_medications():
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM medications", conn)
-    conn.close()
-    return df
+def add_medications(meds, patient_id=DEFAULT_PATIENT_ID):
+    """
+    Bulk insert for batch scanning: all rows commit in one transaction, or none do.
+    meds: iterable of dicts with name, image_path, dosage, frequency, stock.
+    """
+    try:
+        with get_connection() as conn:
+            c = conn.cursor()
+            for med in meds:
+                _insert_medication(
+                    c, patient_id, med['name'], med.get('image_path', ''), med.get('dosage', ''),
+                    med.get('frequency', []), med.get('stock', 0)
+                )
+        _invalidate(*_MEDICATION_TABLES)
+        return True
+    except Exception as e:
+        st.error(f"Error adding medications: {e}")
+        return False
+
+@_cached('medications')
+def get_medications(patient_id=DEFAULT_PATIENT_ID):
+    with get_connection() as conn:
+        return pd.read_sql_query("SELECT * FROM medications WHERE patient_id = ? ORDER BY id", conn, params=(patient_id,))
+
+def get_medication(med_id):
+    """One medication as a dict (id, patient_id, name, dosage, stock), or None. A single indexed row: not cached."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT id, patient_id, name, dosage, stock FROM medications WHERE id = ?", (med_id,)).fetchone()
+    return dict(zip(('id', 'patient_id', 'name', 'dosage', 'stock'), row)) if row else None
+
+# --- Drug Catalog Functions ---
+# Lookups score every catalog spelling sharing a trigram with the query (Dice coefficient)
+# and keep the best spelling per drug. The index is a few thousand rows, so a lookup is
+# one indexed GROUP BY and well under a millisecond.
+MATCH_MIN_SCORE = 0.7 # Same drug (normalize a name, detect an existing medication)
+SUGGEST_MIN_SCORE = 0.3 # Worth suggesting while the name is still being typed
+
+def _upsert_catalog_drug(c, generic_name, thai_name, aliases, dosage, frequency, indication, warning):
+    # Keyed by generic name, so a drug keeps its id (and medications.drug_id) across reloads
+    c.execute('''
+        INSERT INTO drug_catalog (generic_name, thai_name, dosage, frequency, indication, warning)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(generic_name) DO UPDATE SET
+            thai_name = excluded.thai_name, dosage = excluded.dosage, frequency = excluded.frequency,
+            indication = excluded.indication, warning = excluded.warning
+    ''', (generic_name, thai_name, dosage, json.dumps(parse_frequency(frequency)), indication, warning))
+    drug_id = c.execute("SELECT id FROM drug_catalog WHERE generic_name = ?", (generic_name,)).fetchone()[0]
+    for name in (generic_name, thai_name, *aliases):
+        key = drug_catalog.normalize_name(name)
+        grams = drug_catalog.trigrams(key)
+        if not grams:
+            continue
+        c.execute("INSERT OR IGNORE INTO drug_names (drug_id, name, name_key, grams) VALUES (?, ?, ?, ?)",
+                  (drug_id, name, key, len(grams)))
+        if c.rowcount:
+            name_id = c.lastrowid
+            c.executemany("INSERT INTO drug_name_trigrams (trigram, name_id) VALUES (?, ?)", [(g, name_id) for g in grams])
+    return drug_id
+
+def _search_catalog(c, text, limit, min_score):
+    grams = drug_catalog.trigrams(drug_catalog.normalize_name(text))
+    if not grams:
+        return []
+    rows = c.execute(f'''
+        SELECT n.drug_id, n.name, n.grams, COUNT(*)
+        FROM drug_name_trigrams t
+        JOIN drug_names n ON n.id = t.name_id
+        WHERE t.trigram IN ({",".join("?" * len(grams))})
+        GROUP BY t.name_id
+    ''', tuple(grams)).fetchall()
+    best = {}
+    for drug_id, name, name_grams, shared in rows:
+        score = drug_catalog.similarity(shared, len(grams), name_grams)
+        if score >= min_score and score > best.get(drug_id, (0.0,))[0]:
+            best[drug_id] = (score, name)
+    ranked = sorted(best.items(), key=lambda item: -item[1][0])[:limit]
+    if not ranked:
+        return []
+    drugs = {
+        row[0]: row for row in c.execute(f'''
+            SELECT id, generic_name, thai_name, dosage, frequency, indication, warning
+            FROM drug_catalog WHERE id IN ({",".join("?" * len(ranked))})
+        ''', [drug_id for drug_id, _ in ranked])
+    }
+    return [
+        {
+            "drug_id": drug_id, "generic_name": drugs[drug_id][1], "thai_name": drugs[drug_id][2] or "",
+            "matched_name": name, "dosage": drugs[drug_id][3] or "", "frequency": parse_frequency(drugs[drug_id][4]),
+            "indication": drugs[drug_id][5] or "", "warning": drugs[drug_id][6] or "", "score": round(score, 3),
+            "full": drug_catalog.is_full_match(text, name),
+        }
+        for drug_id, (score, name) in ranked
+    ]
+
+def _full_match(matches):
+    # Only a full match is the same drug: a combination product scores high against
+    # each of its ingredients, and must never be linked to (or renamed as) one of them
+    return next((m for m in matches if m['full']), None)
+
+def _match_drug(c, name):
+    return _full_match(_search_catalog(c, name, 3, MATCH_MIN_SCORE))
+
+def _catalog_version(conn):
+    row = conn.execute("SELECT value FROM maintenance_state WHERE key = 'drug_catalog_version'").fetchone()
+    return row[0] if row else None
+
+def _sync_drug_catalog():
+    # Loads drug_catalog.SEED_DRUGS when the database holds an older CATALOG_VERSION:
+    # drugs are upserted, the spelling index rebuilt with today's normalize_name(), and
+    # every medication re-matched against it (so a link made by older rules is dropped)
+    version = str(drug_catalog.CATALOG_VERSION)
+    with get_connection() as conn:
+        if _catalog_version(conn) == version:
+            return
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if _catalog_version(conn) == version: # Another process got here first
+            return
+        c = conn.cursor()
+        c.execute("DELETE FROM drug_name_trigrams")
+        c.execute("DELETE FROM drug_names")
+        for generic, thai, aliases, dosage, frequency, indication, warning in drug_catalog.SEED_DRUGS:
+            _upsert_catalog_drug(c, generic, thai, aliases, dosage, frequency, indication, warning)
+        for med_id, name in c.execute("SELECT id, name FROM medications").fetchall():
+            match = _match_drug(c, name)
+            c.execute("UPDATE medications SET drug_id = ? WHERE id = ?", (match and match['drug_id'], med_id))
+        c.execute("INSERT OR REPLACE INTO maintenance_state (key, value) VALUES ('drug_catalog_version', ?)", (version,))
+    _invalidate('drug_catalog', 'medications')
+
+@_cached('drug_catalog')
+def search_drugs(text, limit=5, min_score=SUGGEST_MIN_SCORE):
+    """
+    Catalog drugs whose generic, Thai or brand name resembles text, best first. Each is a
+    dict with drug_id, generic_name, thai_name, matched_name, dosage, frequency,
+    indication, warning, score (0..1) and full (drug_catalog.is_full_match()).
+    """
+    with get_connection() as conn:
+        return _search_catalog(conn.cursor(), text, limit, min_score)
+
+def match_drug(name):
+    """The catalog drug a medicine name fully refers to (see search_drugs), or None."""
+    return _full_match(search_drugs(name, 3, MATCH_MIN_SCORE))
+
+def find_existing_medication(name, patient_id=DEFAULT_PATIENT_ID):
+    """
+    The patient's medication that name refers to - same catalog drug, or the same name
+    once normalized - as a dict (id, name, dosage, stock), or None.
+    A different strength ("5 mg" vs "10 mg") is a different medication.
+    """
+    match = match_drug(name)
+    key = drug_catalog.normalize_name(name).replace(" ", "") # Thai is often written without spaces
+    strength = drug_catalog.split_strength(name)[1]
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT id, name, dosage, stock, drug_id FROM medications WHERE patient_id = ? ORDER BY id", (patient_id,)
+        ).fetchall()
+    for med_id, med_name, dosage, stock, drug_id in rows:
+        med_strength = drug_catalog.split_strength(med_name)[1]
+        if strength and med_strength and strength.lower() != med_strength.lower():
+            continue
+        same_drug = match is not None and drug_id == match['drug_id']
+        if same_drug or (key and drug_catalog.normalize_name(med_name).replace(" ", "") == key):
+            return {"id": med_id, "name": med_name, "dosage": dosage, "stock": stock}
+    return None
 
 # --- Activity Log Functions ---
-def log_activity(med_id, action, note=""):
+def log_activity(med_id, action, note="", notify=None, period=None):
+    """
+    Records a dose action for a period ('morning', 'noon', ...).
+    If notify (a message) is given, a LINE alert is queued in the outbox in the same
+    transaction, so a log never exists without its alert.
+    This always writes; confirming a scheduled dose goes through confirm_dose().
+    """
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO activity_logs (med_id, action, note)
-            VALUES (?, ?, ?)
-        ''', (med_id, action, note))
-        
-        # Deduct stock if taken
-        if action == 'taken':
-            c.execute('UPDATE medications SET stock = stock - 1 WHERE id = ?', (med_id,))
+        # Log + stock deduction + alert commit together (one transaction)
+        with get_connection() as conn:
+            # The patient is the medication's owner
+            conn.execute('''
+                INSERT INTO activity_logs (patient_id, med_id, action, note, period)
+                SELECT patient_id, id, ?, ?, ? FROM medications WHERE id = ?
+            ''', (action, note, period, med_id))
             
-        conn.commit()
-        conn.close()
+            # Deduct stock if taken (ledgered, never below zero)
+            if action == 'taken':
+                _apply_stock_movement(conn, med_id, 'dose')
+
+            if notify:
+                patient_id = conn.execute("SELECT patient_id FROM medications WHERE id = ?", (med_id,)).fetchone()
+                _enqueue_notification(conn, notify, patient_id[0] if patient_id else DEFAULT_PATIENT_ID)
+        _invalidate('activity_logs', 'medications', 'stock_movements')
         return True
     except Exception as e:
         st.error(f"Error logging activity: {e}")
         return False
 
-def get_activity_logs():
-    conn = sqlite3.connect(DB_FILE)
+# --- Dose Ledger ---
+# dose_instances holds every expected dose of today and the next days. The dashboard
+# reads the pending ones; confirm_dose() and record_missed_doses() change a dose only
+# while it is still pending, which makes repeated confirmations no-ops.
+DOSE_HORIZON_DAYS = 2 # Today + tomorrow, so a dose exists before its period starts
+DOSE_KEEP_DAYS = 35 # Older instances are dropped by maintenance (the rollups keep the history)
+
+_doses_generated = {} # DB_FILE -> local day the horizon was last generated from
+
+def _generate_doses(c, first_day, days, med_id=None):
+    # INSERT OR IGNORE: running it again (any process, any time) never duplicates a dose.
+    # A medication only owes doses whose period ends after it was added.
+    for offset in range(days):
+        day = first_day + datetime.timedelta(days=offset)
+        for period in PERIODS:
+            _, end = period_window(day, period)
+            c.execute(f'''
+                INSERT OR IGNORE INTO dose_instances (patient_id, med_id, day, period)
+                SELECT s.patient_id, s.med_id, ?, s.period
+                FROM medication_schedules s
+                JOIN medications m ON m.id = s.med_id
+                WHERE s.period = ? AND m.created_at < ? {"AND s.med_id = ?" if med_id is not None else ""}
+            ''', (day.isoformat(), period, _to_db_timestamp(end), *([med_id] if med_id is not None else [])))
+
+def ensure_dose_instances(today=None):
+    """Generates the dose horizon from today (once per day per process). Returns True if it ran."""
+    today = today or datetime.date.today()
+    if _doses_generated.get(DB_FILE) == today:
+        return False
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _generate_doses(conn, today, DOSE_HORIZON_DAYS)
+    _doses_generated[DB_FILE] = today
+    _invalidate('dose_instances')
+    return True
+
+@_cached('dose_instances', 'medications')
+def get_pending_doses(day, period, patient_id=DEFAULT_PATIENT_ID):
+    """Medications (m.* plus dose_id) whose dose of 'period' on local date 'day' is still pending."""
     query = """
+        SELECT m.*, d.id AS dose_id
+        FROM dose_instances d
+        JOIN medications m ON m.id = d.med_id
+        WHERE d.patient_id = ? AND d.day = ? AND d.period = ? AND d.status = 'pending'
+        ORDER BY d.med_id
+    """
+    with get_connection() as conn:
+        return pd.read_sql_query(query, conn, params=(patient_id, str(day), period))
+
+def confirm_dose(med_id, period, day=None, action='taken', note="", notify=None):
+    """
+    Confirms one scheduled dose ('taken' or 'skipped'): log, stock deduction and the
+    optional LINE alert commit together, and only if the dose was still pending.
+    Returns True if this call confirmed it, False if it was already confirmed
+    (a double tap), None on error.
+    """
+    try:
+        with get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            confirmed = _confirm_dose(conn, med_id, period, day, action, note, notify)
+        if confirmed:
+            _invalidate('dose_instances', 'activity_logs', 'medications', 'stock_movements')
+        return confirmed
+    except Exception as e:
+        st.error(f"Error confirming dose: {e}")
+        return None
+
+def confirm_doses(doses):
+    """
+    Group commit for bursts (e.g. the LINE webhook): confirms many doses in one
+    transaction. doses: iterable of (med_id, period, day, action, note).
+    Returns one result per dose, as confirm_dose() would (all None on error).
+    """
+    doses = list(doses)
+    try:
+        with get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            results = [_confirm_dose(conn, *dose) for dose in doses]
+        if any(results):
+            _invalidate('dose_instances', 'activity_logs', 'medications', 'stock_movements')
+        return results
+    except Exception as e:
+        st.error(f"Error confirming doses: {e}")
+        return [None] * len(doses)
+
+def _confirm_dose(conn, med_id, period, day=None, action='taken', note="", notify=None):
+    day = str(day or datetime.date.today())
+    # A dose outside the generated horizon (or of a schedule added meanwhile) is created on the spot
+    conn.execute('''
+        INSERT OR IGNORE INTO dose_instances (patient_id, med_id, day, period)
+        SELECT patient_id, id, ?, ? FROM medications WHERE id = ?
+    ''', (day, period, med_id))
+    confirmed = conn.execute('''
+        UPDATE dose_instances SET status = ?, confirmed_at = CURRENT_TIMESTAMP
+        WHERE med_id = ? AND day = ? AND period = ? AND status = 'pending'
+    ''', (action, med_id, day, period)).rowcount
+    if not confirmed:
+        return False
+
+    patient_id = conn.execute("SELECT patient_id FROM medications WHERE id = ?", (med_id,)).fetchone()[0]
+    conn.execute('''
+        INSERT INTO activity_logs (patient_id, med_id, action, note, period) VALUES (?, ?, ?, ?, ?)
+    ''', (patient_id, med_id, action, note, period))
+    if action == 'taken':
+        _apply_stock_movement(conn, med_id, 'dose')
+    if notify:
+        _enqueue_notification(conn, notify, patient_id)
+    return True
+
+def prune_dose_instances(keep_days=DOSE_KEEP_DAYS):
+    """Deletes dose instances older than keep_days. Returns the number removed."""
+    cutoff = (datetime.date.today() - datetime.timedelta(days=keep_days)).isoformat()
+    with get_connection() as conn:
+        removed = conn.execute("DELETE FROM dose_instances WHERE day < ?", (cutoff,)).rowcount
+    _invalidate('dose_instances')
+    return removed
+
+def _to_db_timestamp(value):
+    """
+    Converts a local date/datetime to the UTC text format CURRENT_TIMESTAMP stores
+    ('YYYY-MM-DD HH:MM:SS'). Strings are assumed to be in that format already.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    return value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def _log_window(patient_id, start, end, alias='l'):
+    # WHERE fragments for one patient and an optional [start, end) window,
+    # matching the (patient_id, timestamp) index
+    clauses, params = [f"{alias}.patient_id = ?"], [patient_id]
+    if start is not None:
+        clauses.append(f"{alias}.timestamp >= ?")
+        params.append(_to_db_timestamp(start))
+    if end is not None:
+        clauses.append(f"{alias}.timestamp < ?")
+        params.append(_to_db_timestamp(end))
+    return clauses, params
+
+@_cached('activity_logs', 'medications')
+def get_activity_logs(limit=50, before=None, start=None, end=None, patient_id=DEFAULT_PATIENT_ID):
+    """
+    One page of history, newest first.
+    before: (timestamp, id) of the last row of the previous page (keyset pagination),
+            so deep pages cost the same as the first one.
+    start/end: optional local date/datetime window [start, end).
+    """
+    clauses, params = _log_window(patient_id, start, end)
+    if before is not None:
+        clauses.append("(l.timestamp, l.id) < (?, ?)")
+        params.extend(before)
+    where = f"WHERE {' AND '.join(clauses)}"
+
+    query = f"""
         SELECT l.id, m.name as med_name, l.action, l.timestamp, l.note 
         FROM activity_logs l
         JOIN medications m ON l.med_id = m.id
-        ORDER BY l.timestamp DESC
+        {where}
+        ORDER BY l.timestamp DESC, l.id DESC
+        LIMIT ?
     """
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    return df
+    with get_connection() as conn:
+        return pd.read_sql_query(query, conn, params=(*params, limit))
 
-# --- User/Settings Functions ---
-def save_user_settings(name, line_token, user_id):
-    # For simplicity, we assume single user pair mostly, so we update or insert ID 1
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    # Check if exists
-    c.execute("SELECT count(*) FROM users WHERE id = 1")
-    exists = c.fetchone()[0]
-    
-    # Check column 'user_id' exists (migration for existing DB)
+def next_page_cursor(logs_df):
+    """The 'before' cursor for the page after logs_df (None when there are no more rows)."""
+    if logs_df.empty:
+        return None
+    last = logs_df.iloc[-1]
+    return (last['timestamp'], int(last['id']))
+
+# --- Streaming Reads (exports) ---
+# Generators over a server-side cursor: rows arrive EXPORT_CHUNK_ROWS at a time, so an
+# export of years of history never holds more than one chunk in memory.
+EXPORT_CHUNK_ROWS = 5000
+
+def iter_activity_logs(start=None, end=None, patient_id=DEFAULT_PATIENT_ID, chunk_size=EXPORT_CHUNK_ROWS):
+    """
+    Yields lists of (id, timestamp, med_id, med_name, action, period, note), oldest first,
+    for the local window [start, end).
+    """
+    clauses, params = _log_window(patient_id, start, end)
+    query = f"""
+        SELECT l.id, l.timestamp, l.med_id, m.name, l.action, l.period, l.note
+        FROM activity_logs l
+        JOIN medications m ON l.med_id = m.id
+        WHERE {' AND '.join(clauses)}
+        ORDER BY l.timestamp, l.id
+    """
+    with get_connection() as conn:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+def iter_schedules(patient_id=DEFAULT_PATIENT_ID, chunk_size=EXPORT_CHUNK_ROWS):
+    """Yields lists of (med_id, name, dosage, period, time_of_day, created_at) per scheduled dose."""
+    query = """
+        SELECT s.med_id, m.name, m.dosage, s.period, s.time_of_day, m.created_at
+        FROM medication_schedules s
+        JOIN medications m ON m.id = s.med_id
+        WHERE s.patient_id = ?
+        ORDER BY s.med_id, s.period
+    """
+    with get_connection() as conn:
+        cursor = conn.execute(query, (patient_id,))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+# --- Adherence Reports (aggregated in SQL, never the full history in pandas) ---
+# Reports read finished days from the daily_adherence rollup and only the days after
+# 'rollup_through' (normally just today) from the raw activity_logs.
+
+def _rollup_through(conn):
+    row = conn.execute("SELECT value FROM maintenance_state WHERE key = 'rollup_through'").fetchone()
+    return datetime.date.fromisoformat(row[0]) if row and row[0] else None
+
+def _as_day(value, round_up=False):
+    # Local date of a date/datetime bound; an exclusive end inside a day includes that day
+    if value is None or isinstance(value, str):
+        return value[:10] if value else None
+    if isinstance(value, datetime.datetime):
+        day = value.date()
+        if round_up and value.time() != datetime.time():
+            day += datetime.timedelta(days=1)
+        return day.isoformat()
+    return value.isoformat()
+
+def _adherence_source(conn, patient_id, start=None, end=None):
+    """
+    SQL (and params) of a subquery with one row per day and medication:
+    (day, med_id, taken, skipped, missed, last_taken), rollups + live logs.
+    """
+    rolled = _rollup_through(conn)
+    live_from = _to_db_timestamp(rolled + datetime.timedelta(days=1)) if rolled else None
+
+    rollup_clauses, rollup_params = ["r.patient_id = ?", "r.day <= ?"], [patient_id, rolled and rolled.isoformat()]
+    if start is not None:
+        rollup_clauses.append("r.day >= ?")
+        rollup_params.append(_as_day(start))
+    if end is not None:
+        rollup_clauses.append("r.day < ?")
+        rollup_params.append(_as_day(end, round_up=True))
+
+    live_clauses, live_params = _log_window(patient_id, start, end)
+    if live_from is not None:
+        live_clauses.append("l.timestamp >= ?")
+        live_params.append(live_from)
+
+    sql = f"""
+        SELECT r.day, r.med_id, r.taken, r.skipped, r.missed, r.last_taken
+        FROM daily_adherence r
+        WHERE {' AND '.join(rollup_clauses)}
+        UNION ALL
+        SELECT date(l.timestamp, 'localtime') AS day, l.med_id,
+               SUM(l.action = 'taken'), SUM(l.action = 'skipped'), SUM(l.action = 'missed'),
+               MAX(CASE WHEN l.action = 'taken' THEN l.timestamp END)
+        FROM activity_logs l
+        WHERE {' AND '.join(live_clauses)}
+        GROUP BY day, l.med_id
+    """
+    return sql, [*rollup_params, *live_params]
+
+@_cached('activity_logs', 'daily_adherence', 'medications')
+def get_daily_adherence(start=None, end=None, patient_id=DEFAULT_PATIENT_ID):
+    """Per local day and medication: taken/skipped/missed counts and adherence (0-1)."""
+    with get_connection() as conn:
+        source, params = _adherence_source(conn, patient_id, start, end)
+        query = f"""
+            SELECT d.day, d.med_id, m.name AS med_name, d.taken, d.skipped, d.missed,
+                   ROUND(1.0 * d.taken / (d.taken + d.skipped + d.missed), 3) AS adherence
+            FROM ({source}) d
+            JOIN medications m ON d.med_id = m.id
+            ORDER BY d.day DESC, d.med_id
+        """
+        return pd.read_sql_query(query, conn, params=params)
+
+@_cached('activity_logs', 'daily_adherence', 'medications')
+def get_action_counts(start=None, end=None, patient_id=DEFAULT_PATIENT_ID):
+    """Per medication: how many doses were taken, skipped and missed."""
+    with get_connection() as conn:
+        source, params = _adherence_source(conn, patient_id, start, end)
+        query = f"""
+            SELECT m.id AS med_id,
+                   m.name AS med_name,
+                   COALESCE(SUM(d.taken), 0) AS taken,
+                   COALESCE(SUM(d.skipped), 0) AS skipped,
+                   COALESCE(SUM(d.missed), 0) AS missed
+            FROM medications m
+            LEFT JOIN ({source}) d ON d.med_id = m.id
+            WHERE m.patient_id = ?
+            GROUP BY m.id
+            ORDER BY m.id
+        """
+        return pd.read_sql_query(query, conn, params=(*params, patient_id))
+
+@_cached('activity_logs', 'daily_adherence', 'medications')
+def get_last_taken(patient_id=DEFAULT_PATIENT_ID):
+    """Per medication: timestamp of the most recent 'taken' log (None if never taken)."""
+    with get_connection() as conn:
+        source, params = _adherence_source(conn, patient_id)
+        query = f"""
+            SELECT m.id AS med_id,
+                   m.name AS med_name,
+                   MAX(d.last_taken) AS last_taken
+            FROM medications m
+            LEFT JOIN ({source}) d ON d.med_id = m.id
+            WHERE m.patient_id = ?
+            GROUP BY m.id
+            ORDER BY m.id
+        """
+        return pd.read_sql_query(query, conn, params=(*params, patient_id))
+
+# --- Maintenance: Rollups, Archival, Vacuum ---
+# Run by maintenance.py (daily). Rows only ever leave activity_logs after their day has
+# been rolled up, so reports stay complete whatever has been archived.
+
+def _tenant_filter(alias='activity_logs'):
+    # Lets batch scans over a time range use the (patient_id, timestamp) index. Every
+    # patient that can own a log is listed - including one whose medications are gone -
+    # so no row is ever left out of the rollups or the archive.
+    return f"{alias}.patient_id IN (SELECT id FROM users UNION SELECT patient_id FROM medications)"
+
+def rollup_daily_adherence(through_day=None):
+    """
+    Sums every finished local day up to through_day (default: yesterday) that is not
+    rolled up yet into daily_adherence. Returns the number of days rolled up.
+    """
+    through_day = through_day or datetime.date.today() - datetime.timedelta(days=1)
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rolled = _rollup_through(conn)
+        if rolled is not None:
+            first_day = rolled + datetime.timedelta(days=1)
+        else:
+            oldest = conn.execute("SELECT date(MIN(timestamp), 'localtime') FROM activity_logs").fetchone()[0]
+            first_day = datetime.date.fromisoformat(oldest) if oldest else through_day
+        if first_day > through_day:
+            return 0
+
+        conn.execute(f'''
+            INSERT INTO daily_adherence (patient_id, day, med_id, taken, skipped, missed, last_taken)
+            SELECT patient_id, date(timestamp, 'localtime') AS day, med_id,
+                   SUM(action = 'taken'), SUM(action = 'skipped'), SUM(action = 'missed'),
+                   MAX(CASE WHEN action = 'taken' THEN timestamp END)
+            FROM activity_logs
+            WHERE {_tenant_filter()} AND timestamp >= ? AND timestamp < ?
+            GROUP BY patient_id, day, med_id
+            ON CONFLICT(patient_id, day, med_id) DO UPDATE SET
+                taken = excluded.taken, skipped = excluded.skipped, missed = excluded.missed,
+                last_taken = excluded.last_taken
+        ''', (_to_db_timestamp(first_day), _to_db_timestamp(through_day + datetime.timedelta(days=1))))
+        conn.execute(
+            "INSERT OR REPLACE INTO maintenance_state (key, value) VALUES ('rollup_through', ?)",
+            (through_day.isoformat(),)
+        )
+    _invalidate('daily_adherence')
+    return (through_day - first_day).days + 1
+
+def _next_month(month):
+    year, mon = map(int, month.split('-'))
+    return f"{year + mon // 12:04d}-{mon % 12 + 1:02d}"
+
+def get_archivable_months(before):
+    """
+    'YYYY-MM' months whose raw logs all lie before the local date 'before' and have
+    been rolled up already, oldest first.
+    """
+    with get_connection() as conn:
+        rolled = _rollup_through(conn)
+        if rolled is None:
+            return []
+        cutoff = _to_db_timestamp(min(before, rolled + datetime.timedelta(days=1)))
+        oldest = conn.execute("SELECT MIN(timestamp) FROM activity_logs").fetchone()[0]
+    months = []
+    month = oldest[:7] if oldest else None
+    while month and f"{_next_month(month)}-01 00:00:00" <= cutoff:
+        months.append(month)
+        month = _next_month(month)
+    return months
+
+def iter_log_month(month, chunk_size=EXPORT_CHUNK_ROWS):
+    """Yields lists of (id, patient_id, med_id, med_name, action, timestamp, note, period) of a UTC month."""
+    query = f"""
+        SELECT l.id, l.patient_id, l.med_id, m.name, l.action, l.timestamp, l.note, l.period
+        FROM activity_logs l
+        LEFT JOIN medications m ON m.id = l.med_id
+        WHERE {_tenant_filter('l')} AND l.timestamp >= ? AND l.timestamp < ?
+        ORDER BY l.patient_id, l.timestamp, l.id
+    """
+    with get_connection() as conn:
+        cursor = conn.execute(query, (f"{month}-01", f"{_next_month(month)}-01"))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+def delete_archived_month(month, path, rows):
+    """Records the archive file of a month and drops its raw rows, in one transaction."""
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute('''
+            INSERT INTO log_archives (month, path, rows) VALUES (?, ?, ?)
+            ON CONFLICT(month) DO UPDATE SET path = excluded.path, rows = rows + excluded.rows,
+                archived_at = CURRENT_TIMESTAMP
+        ''', (month, path, rows))
+        deleted = conn.execute(
+            f"DELETE FROM activity_logs WHERE {_tenant_filter()} AND timestamp >= ? AND timestamp < ?",
+            (f"{month}-01", f"{_next_month(month)}-01")
+        ).rowcount
+    _invalidate('activity_logs', 'log_archives')
+    return deleted
+
+@_cached('log_archives')
+def get_log_archives():
+    """{month: path} of every archived month."""
+    with get_connection() as conn:
+        return dict(conn.execute("SELECT month, path FROM log_archives ORDER BY month").fetchall())
+
+def vacuum_incremental(max_pages=None):
+    """
+    Returns free pages to the OS. A file created before auto_vacuum=INCREMENTAL gets
+    one full VACUUM to switch modes (slow once, then incremental forever).
+    Returns (pages freed, file pages left).
+    """
+    with get_connection() as conn:
+        before = conn.execute("PRAGMA page_count").fetchone()[0]
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            # executescript steps the pragma to completion (execute() frees a single page)
+            conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages or 0)});")
+        conn.execute("PRAGMA optimize")
+        after = conn.execute("PRAGMA page_count").fetchone()[0]
+    return before - after, after
+
+# --- Stock Ledger Functions ---
+LOW_STOCK_DAYS = (7, 3, 0) # Alert once when the supply left drops to each of these (days)
+
+def _runout_date(stock, daily_usage):
+    if not daily_usage:
+        return None
+    days_left = math.floor(stock / daily_usage)
+    return (datetime.date.today() + datetime.timedelta(days=days_left)).isoformat()
+
+def _alert_level(stock, daily_usage):
+    # Lowest threshold the remaining supply has reached (None = comfortably stocked)
+    if not daily_usage:
+        return 0 if stock <= 0 else None
+    days_left = stock / daily_usage
+    reached = [t for t in LOW_STOCK_DAYS if days_left <= t]
+    return min(reached) if reached else None
+
+def _apply_stock_movement(conn, med_id, kind, quantity=None, note=None):
+    """
+    Changes a medication's stock by quantity (a 'dose' defaults to -dose_units) inside
+    the caller's transaction, records it in stock_movements, refreshes the forecast and
+    queues a low-stock alert the first time each LOW_STOCK_DAYS threshold is crossed.
+    Returns the stock after the movement (None if the medication does not exist).
+    """
+    if quantity is None:
+        row = conn.execute("SELECT dose_units FROM medications WHERE id = ?", (med_id,)).fetchone()
+        if row is None:
+            return None
+        quantity = -(row[0] or 1)
+
+    # Guarded decrement: applies only if the stock cannot go negative...
+    cur = conn.execute(
+        "UPDATE medications SET stock = stock + ? WHERE id = ? AND stock + ? >= 0",
+        (quantity, med_id, quantity)
+    )
+    row = conn.execute(
+        "SELECT patient_id, name, stock, daily_usage, stock_alert_level FROM medications WHERE id = ?", (med_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    patient_id, name, stock, daily_usage, alerted_level = row
+    if cur.rowcount == 0:
+        # ...otherwise take what is left (the UPDATE above already holds the write lock)
+        quantity = -stock
+        stock = 0
+
+    level = _alert_level(stock, daily_usage)
+    conn.execute(
+        "UPDATE medications SET stock = ?, runout_date = ?, stock_alert_level = ? WHERE id = ?",
+        (stock, _runout_date(stock, daily_usage), level, med_id)
+    )
+    conn.execute(
+        "INSERT INTO stock_movements (patient_id, med_id, kind, quantity, stock_after, note) VALUES (?, ?, ?, ?, ?, ?)",
+        (patient_id, med_id, kind, quantity, stock, note)
+    )
+
+    if level is not None and (alerted_level is None or level < alerted_level):
+        if stock <= 0:
+            message = f"❗ ยา '{name}' หมดแล้วค่ะ กรุณาซื้อเพิ่ม"
+        else:
+            message = f"💊 ยา '{name}' เหลือ {stock} เม็ด (พอใช้ประมาณ {math.floor(stock / daily_usage)} วัน) ควรเตรียมซื้อเพิ่มค่ะ"
+        owner = conn.execute("SELECT line_token, user_id FROM users WHERE id = ?", (patient_id,)).fetchone()
+        if owner and owner[0] and owner[1]:
+            _enqueue_notification(conn, message, patient_id)
+    return stock
+
+def refill_medication(med_id, quantity, note=""):
+    """Adds bought/received units to the stock. Returns the new stock (None on error)."""
     try:
-        c.execute("SELECT user_id FROM users LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("ALTER TABLE users ADD COLUMN user_id TEXT")
+        with get_connection() as conn:
+            stock = _apply_stock_movement(conn, med_id, 'refill', int(quantity), note)
+        _invalidate('medications', 'stock_movements')
+        return stock
+    except Exception as e:
+        st.error(f"Error refilling medication: {e}")
+        return None
 
-    if exists:
-        c.execute("UPDATE users SET name=?, line_token=?, user_id=? WHERE id=1", (name, line_token, user_id))
-    else:
-        c.execute("INSERT INTO users (id, name, line_token, user_id) VALUES (1, ?, ?, ?)", (name, line_token, user_id))
-    conn.commit()
-    conn.close()
+def adjust_stock(med_id, counted_stock, note=""):
+    """Sets the stock to a counted value (recorded as an 'adjustment' movement)."""
+    try:
+        with get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE") # Nobody can take a dose between the read and the write
+            row = conn.execute("SELECT stock FROM medications WHERE id = ?", (med_id,)).fetchone()
+            if row is None:
+                return None
+            stock = _apply_stock_movement(conn, med_id, 'adjustment', int(counted_stock) - row[0], note)
+        _invalidate('medications', 'stock_movements')
+        return stock
+    except Exception as e:
+        st.error(f"Error adjusting stock: {e}")
+        return None
+
+@_cached('stock_movements')
+def get_stock_movements(med_id, limit=50):
+    query = """
+        SELECT id, kind, quantity, stock_after, note, created_at
+        FROM stock_movements
+        WHERE med_id = ?
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    """
+    with get_connection() as conn:
+        return pd.read_sql_query(query, conn, params=(med_id, limit))
+
+@_cached('medications')
+def get_refill_status(patient_id=DEFAULT_PATIENT_ID):
+    """Stock and projected run-out per medication - a plain column read, no log scan."""
+    query = """
+        SELECT id, name, stock, dose_units, daily_usage, runout_date, stock_alert_level
+        FROM medications
+        WHERE patient_id = ?
+        ORDER BY runout_date IS NULL, runout_date, name
+    """
+    with get_connection() as conn:
+        return pd.read_sql_query(query, conn, params=(patient_id,))
+
+# --- Reminder Engine Functions ---
+def get_schedules():
+    """Every (med_id, period) schedule row, as plain tuples (for the reminder engine)."""
+    with get_connection() as conn:
+        return conn.execute("SELECT med_id, period FROM medication_schedules ORDER BY med_id").fetchall()
+
+MISSED_BATCH_SIZE = 500 # Keeps IN (...) lists well under SQLite's variable limit
+
+def record_missed_doses(period, start, end, med_ids):
+    """
+    Marks the dose of 'period' in the local window [start, end) as missed for every
+    med in med_ids whose dose is still pending in the dose ledger, then queues one
+    caregiver alert per patient. Everything commits in one transaction.
+    Returns the names of the missed meds.
+    """
+    day = start.date().isoformat()
+    missed = []
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE") # No dose can be confirmed between the check and the update
+        med_ids = list(med_ids)
+        for i in range(0, len(med_ids), MISSED_BATCH_SIZE):
+            chunk = med_ids[i:i + MISSED_BATCH_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            # Doses nobody generated (app not opened that day) still count;
+            # meds added after the window closed owe nothing
+            conn.execute(f'''
+                INSERT OR IGNORE INTO dose_instances (patient_id, med_id, day, period)
+                SELECT patient_id, id, ?, ? FROM medications
+                WHERE id IN ({placeholders}) AND created_at < ?
+            ''', (day, period, *chunk, _to_db_timestamp(end)))
+            missed += conn.execute(f'''
+                SELECT m.id, m.name, m.patient_id
+                FROM dose_instances d
+                JOIN medications m ON m.id = d.med_id
+                WHERE d.med_id IN ({placeholders}) AND d.day = ? AND d.period = ? AND d.status = 'pending'
+            ''', (*chunk, day, period)).fetchall()
+            conn.execute(f'''
+                UPDATE dose_instances SET status = 'missed', confirmed_at = CURRENT_TIMESTAMP
+                WHERE med_id IN ({placeholders}) AND day = ? AND period = ? AND status = 'pending'
+            ''', (*chunk, day, period))
+
+        conn.executemany(
+            "INSERT INTO activity_logs (patient_id, med_id, action, note, period) VALUES (?, ?, 'missed', ?, ?)",
+            [(patient_id, med_id, f"Missed at {period}", period) for med_id, _, patient_id in missed]
+        )
+
+        by_patient = defaultdict(list)
+        for _, name, patient_id in missed:
+            by_patient[patient_id].append(name)
+        for patient_id, names in by_patient.items():
+            owner = conn.execute(
+                "SELECT name, line_token, user_id FROM users WHERE id = ?", (patient_id,)
+            ).fetchone()
+            if owner and owner[1] and owner[2]:
+                _enqueue_notification(
+                    conn, f"⚠️ {owner[0]} ยังไม่ได้ทานยารอบ {PERIOD_LABELS[period]}: {', '.join(names)}", patient_id
+                )
+    if missed:
+        _invalidate('activity_logs', 'dose_instances')
+    return [name for _, name, _ in missed]
+
+# --- Notification Outbox Functions ---
+def _enqueue_notification(conn, message, owner_id=DEFAULT_PATIENT_ID):
+    now = time.time()
+    conn.execute('''
+        INSERT INTO notification_outbox (owner_id, message, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?)
+    ''', (owner_id, message, now, now))
 
-def get_user_settings():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+def enqueue_notification(message, owner_id=DEFAULT_PATIENT_ID):
+    with get_connection() as conn:
+        _enqueue_notification(conn, message, owner_id)
+
+def claim_notifications(coalesce_seconds, lease_seconds=120, now=None):
+    """
+    Claims every due outbox row of owners whose oldest pending message has waited out
+    the coalescing window, grouped into one batch per owner.
+    Claimed rows are leased ('sending'); if this process dies they become due again.
+    """
+    now = now or time.time()
+    with get_connection() as conn:
+        conn.execute("BEGIN IMMEDIATE") # Only one worker (in any process) claims a row
+        rows = conn.execute('''
+            SELECT o.id, o.owner_id, o.message, o.attempts, u.line_token, u.user_id
+            FROM notification_outbox o
+            LEFT JOIN users u ON u.id = o.owner_id
+            WHERE o.status IN ('pending', 'sending') AND o.next_attempt_at <= ?
+              AND o.owner_id IN (
+                  SELECT owner_id FROM notification_outbox
+                  WHERE status IN ('pending', 'sending')
+                  GROUP BY owner_id
+                  HAVING MIN(created_at) <= ?
+              )
+            ORDER BY o.owner_id, o.id
+        ''', (now, now - coalesce_seconds)).fetchall()
+        conn.executemany(
+            "UPDATE notification_outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?",
+            [(now + lease_seconds, row[0]) for row in rows]
+        )
+
+    batches = {}
+    for row_id, owner_id, message, attempts, line_token, line_user_id in rows:
+        batch = batches.setdefault(owner_id, {
+            "owner_id": owner_id, "line_token": line_token, "user_id": line_user_id,
+            "ids": [], "messages": [], "attempts": 0,
+        })
+        batch["ids"].append(row_id)
+        batch["messages"].append(message)
+        batch["attempts"] = max(batch["attempts"], attempts)
+    return list(batches.values())
+
+def get_next_notification_due(coalesce_seconds):
+    """Unix time at which the next pending row can be claimed (None if the outbox is empty)."""
+    with get_connection() as conn:
+        row = conn.execute('''
+            SELECT MIN(MAX(next_attempt_at, created_at + ?))
+            FROM notification_outbox
+            WHERE status IN ('pending', 'sending')
+        ''', (coalesce_seconds,)).fetchone()
+    return row[0]
+
+def mark_notifications_sent(ids):
+    with get_connection() as conn:
+        conn.executemany(
+            "UPDATE notification_outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1 WHERE id = ?",
+            [(time.time(), i) for i in ids]
+        )
+
+def mark_notifications_failed(ids, error, retry_at=None):
+    """Puts rows back in the queue until retry_at, or gives up on them when retry_at is None."""
+    status = 'pending' if retry_at else 'failed'
+    with get_connection() as conn:
+        conn.executemany('''
+            UPDATE notification_outbox
+            SET status = ?, attempts = attempts + 1, last_error = ?, next_attempt_at = COALESCE(?, next_attempt_at)
+            WHERE id = ?
+        ''', [(status, error, retry_at, i) for i in ids])
+
+# --- Vision Cache Functions ---
+def _hamming(a, b):
+    return ((a ^ b) & 0xFFFFFFFFFFFFFFFF).bit_count()
+
+def _to_signed64(value):
+    # SQLite INTEGER is signed 64-bit
+    return value - (1 << 64) if value is not None and value >= (1 << 63) else value
+
+def get_cached_extraction(image_hash, phash=None, max_distance=0, ttl_seconds=None):
+    """
+    Looks up a cached extraction result: exact content hash first, then (if phash is
+    given) the closest perceptual hash within max_distance bits. Returns a dict or None.
+    """
+    now = time.time()
+    min_created = now - ttl_seconds if ttl_seconds else 0
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT image_hash, result FROM vision_cache WHERE image_hash = ? AND created_at >= ?",
+            (image_hash, min_created)
+        ).fetchone()
+
+        if row is None and phash is not None and max_distance > 0:
+            # The table is size-bounded, so a linear scan over the hashes stays cheap
+            phash = _to_signed64(phash)
+            best = None
+            for key, candidate, result in conn.execute(
+                "SELECT image_hash, phash, result FROM vision_cache WHERE phash IS NOT NULL AND created_at >= ?",
+                (min_created,)
+            ):
+                distance = _hamming(phash, candidate)
+                if distance <= max_distance and (best is None or distance < best[0]):
+                    best = (distance, key, result)
+            if best:
+                row = best[1:]
+
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE vision_cache SET last_hit_at = ?, hits = hits + 1 WHERE image_hash = ?",
+            (now, row[0])
+        )
+    return json.loads(row[1])
+
+def save_cached_extraction(image_hash, phash, result, max_entries=500, ttl_seconds=None):
+    """Stores an extraction result, then evicts expired and least-recently-used entries."""
+    now = time.time()
+    with get_connection() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO vision_cache (image_hash, phash, result, created_at, last_hit_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (image_hash, _to_signed64(phash), json.dumps(result, ensure_ascii=False), now, now))
+        if ttl_seconds:
+            conn.execute("DELETE FROM vision_cache WHERE created_at < ?", (now - ttl_seconds,))
+        conn.execute('''
+            DELETE FROM vision_cache WHERE image_hash IN (
+                SELECT image_hash FROM vision_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (max_entries,))
+
+# --- Metrics Functions ---
+def save_metrics(rows, retention_seconds):
+    """rows: (window_start, name, count, errors, total_ms, max_ms, buckets dict). Drops expired windows."""
+    with get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO metrics (window_start, name, count, errors, total_ms, max_ms, buckets) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(*row[:6], json.dumps(row[6])) for row in rows]
+        )
+        conn.execute("DELETE FROM metrics WHERE window_start < ?", (time.time() - retention_seconds,))
+
+def get_metrics(since):
+    """Flushed windows since a unix time: (name, count, errors, total_ms, max_ms, buckets dict)."""
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT name, count, errors, total_ms, max_ms, buckets FROM metrics WHERE window_start >= ?", (since,)
+        ).fetchall()
+    return [
+        (name, count, errors, total_ms, max_ms, {int(k): v for k, v in json.loads(buckets).items()})
+        for name, count, errors, total_ms, max_ms, buckets in rows
+    ]
+
+# --- User/Settings Functions ---
+def save_user_settings(name, line_token, user_id, patient_id=DEFAULT_PATIENT_ID):
+    # One settings row per patient: the patient's name + the caregiver's LINE target
+    with get_connection() as conn:
+        conn.execute('''
+            INSERT INTO users (id, name, role, line_token, user_id) VALUES (?, ?, 'patient', ?, ?)
+            ON CONFLICT(id) DO UPDATE SET name = excluded.name, line_token = excluded.line_token, user_id = excluded.user_id
+        ''', (patient_id, name, line_token, user_id))
+    _invalidate('users')
+
+@_cached('users')
+def get_user_settings(patient_id=DEFAULT_PATIENT_ID):
     try:
-        c.execute("SELECT name, line_token, user_id FROM users WHERE id = 1")
-        row = c.fetchone()
-        conn.close()
+        with get_connection() as conn:
+            row = conn.execute("SELECT name, line_token, user_id FROM users WHERE id = ?", (patient_id,)).fetchone()
         if row:
             return {"name": row[0], "line_token": row[1], "user_id": row[2]}
-    except:
-        conn.close()
+    except sqlite3.Error:
         return None
     return None
+
+# --- Patient/Caregiver Functions ---
+def add_patient(name, line_token="", user_id="", caregiver_id=None):
+    """Creates a patient (optionally linked to a caregiver). Returns the new patient_id."""
+    with get_connection() as conn:
+        cur = conn.execute(
+            "INSERT INTO users (name, role, line_token, user_id) VALUES (?, 'patient', ?, ?)",
+            (name, line_token, user_id)
+        )
+        patient_id = cur.lastrowid
+        if caregiver_id is not None:
+            conn.execute(
+                "INSERT OR IGNORE INTO caregiver_patients (caregiver_id, patient_id) VALUES (?, ?)",
+                (caregiver_id, patient_id)
+            )
+    _invalidate('users', 'caregiver_patients')
+    return patient_id
+
+def add_caregiver(name, user_id=""):
+    """Creates a caregiver account (user_id = their LINE user ID). Returns its id."""
+    with get_connection() as conn:
+        cur = conn.execute("INSERT INTO users (name, role, user_id) VALUES (?, 'caregiver', ?)", (name, user_id))
+    _invalidate('users')
+    return cur.lastrowid
+
+def link_caregiver(caregiver_id, patient_id):
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO caregiver_patients (caregiver_id, patient_id) VALUES (?, ?)",
+            (caregiver_id, patient_id)
+        )
+    _invalidate('caregiver_patients')
+
+@_cached('users', 'caregiver_patients')
+def get_line_patients(line_user_id):
+    """
+    Patients a LINE user may act for: those whose users.user_id is theirs, plus those
+    linked to a caregiver account with that user_id. List of (id, name, line_token).
+    """
+    if not line_user_id:
+        return []
+    query = """
+        SELECT id, name, line_token FROM users WHERE role = 'patient' AND user_id = ?
+        UNION
+        SELECT u.id, u.name, u.line_token FROM users c
+        JOIN caregiver_patients cp ON cp.caregiver_id = c.id
+        JOIN users u ON u.id = cp.patient_id
+        WHERE c.role = 'caregiver' AND c.user_id = ?
+        ORDER BY id
+    """
+    with get_connection() as conn:
+        return conn.execute(query, (line_user_id, line_user_id)).fetchall()
+
+@_cached('users', 'caregiver_patients')
+def list_patients(caregiver_id=None):
+    """Patients (id, name), all of them or only those a caregiver looks after."""
+    if caregiver_id is None:
+        query, params = "SELECT id, name FROM users WHERE role = 'patient' ORDER BY id", ()
+    else:
+        query = """
+            SELECT u.id, u.name FROM caregiver_patients cp
+            JOIN users u ON u.id = cp.patient_id
+            WHERE cp.caregiver_id = ?
+            ORDER BY u.id
+        """
+        params = (caregiver_id,)
+    with get_connection() as conn:
+        return pd.read_sql_query(query, conn, params=params)
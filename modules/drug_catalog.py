@@ -0,0 +1,153 @@
+import re
+import unicodedata
+
+# --- Drug Catalog ---
+# Common medicines of older patients in Thailand, loaded into SQLite (drug_catalog,
+# drug_names, drug_name_trigrams) by database.init_db(). Every spelling a label may carry -
+# generic, Thai, brand - is a row of drug_names, so "Sara 500 mg", "พาราเซตามอล" and
+# "paracetamol" all resolve to one drug without asking Gemini.
+#
+# Bump CATALOG_VERSION whenever SEED_DRUGS or the name normalization below changes:
+# every database reloads its catalog on the next start.
+CATALOG_VERSION = 2
+
+# (generic name, Thai name, brand names / other spellings, usual dosage, usual periods, indication, warning)
+SEED_DRUGS = [
+    ("Paracetamol", "พาราเซตามอล", ["Acetaminophen", "Sara", "Tylenol", "Tempra", "Panadol", "พาราเซทามอล"],
+     "1 เม็ด", ["morning", "noon", "evening", "bedtime"], "แก้ปวด ลดไข้", "ไม่ควรเกิน 8 เม็ดต่อวัน ระวังในผู้ป่วยโรคตับ"),
+    ("Amlodipine", "แอมโลดิปีน", ["Norvasc", "Amlopine", "แอมโลดิปิน"],
+     "1 เม็ด", ["morning"], "ลดความดันโลหิต", "อาจทำให้ข้อเท้าบวม"),
+    ("Losartan", "โลซาร์แทน", ["Cozaar", "Losatan"],
+     "1 เม็ด", ["morning"], "ลดความดันโลหิต ปกป้องไต", "ลุกนั่งช้าๆ อาจหน้ามืด"),
+    ("Enalapril", "อีนาลาพริล", ["Renitec", "Anapril"],
+     "1 เม็ด", ["morning"], "ลดความดันโลหิต", "อาจทำให้ไอแห้ง"),
+    ("Hydrochlorothiazide", "ไฮโดรคลอโรไทอะไซด์", ["HCTZ", "Dichlotride"],
+     "1 เม็ด", ["morning"], "ขับปัสสาวะ ลดความดันโลหิต", "ทานตอนเช้า เลี่ยงปัสสาวะกลางคืน"),
+    ("Furosemide", "ฟูโรซีไมด์", ["Lasix", "Furosemid"],
+     "1 เม็ด", ["morning"], "ขับปัสสาวะ ลดอาการบวม", "ทานตอนเช้า ระวังเกลือแร่ต่ำ"),
+    ("Atenolol", "อะทีโนลอล", ["Tenormin"],
+     "1 เม็ด", ["morning"], "ลดความดันโลหิต ควบคุมชีพจร", "ห้ามหยุดยาเอง"),
+    ("Metoprolol", "เมโทโพรลอล", ["Betaloc"],
+     "1 เม็ด", ["morning", "evening"], "ลดความดันโลหิต ควบคุมชีพจร", "ห้ามหยุดยาเอง"),
+    ("Propranolol", "โพรพราโนลอล", ["Inderal"],
+     "1 เม็ด", ["morning", "evening"], "ควบคุมชีพจร ลดอาการใจสั่น มือสั่น", "ห้ามหยุดยาเอง"),
+    ("Metformin", "เมทฟอร์มิน", ["Glucophage", "Glucomet"],
+     "1 เม็ด", ["morning", "evening"], "ลดน้ำตาลในเลือด", "ทานหลังอาหารทันที"),
+    ("Glipizide", "ไกลพิไซด์", ["Minidiab"],
+     "1 เม็ด", ["morning"], "ลดน้ำตาลในเลือด", "ทานก่อนอาหาร ระวังน้ำตาลต่ำ"),
+    ("Gliclazide", "ไกลคลาไซด์", ["Diamicron"],
+     "1 เม็ด", ["morning"], "ลดน้ำตาลในเลือด", "ระวังน้ำตาลต่ำ"),
+    ("Simvastatin", "ซิมวาสแตติน", ["Zocor", "Simvas"],
+     "1 เม็ด", ["bedtime"], "ลดไขมันในเลือด", "แจ้งแพทย์หากปวดกล้ามเนื้อ"),
+    ("Atorvastatin", "อะทอร์วาสแตติน", ["Lipitor"],
+     "1 เม็ด", ["bedtime"], "ลดไขมันในเลือด", "แจ้งแพทย์หากปวดกล้ามเนื้อ"),
+    ("Aspirin", "แอสไพริน", ["ASA", "Aspent", "Cardiprin", "Bayer Aspirin"],
+     "1 เม็ด", ["morning"], "ต้านเกล็ดเลือด ป้องกันหลอดเลือดอุดตัน", "ทานหลังอาหาร ระวังเลือดออกง่าย"),
+    ("Clopidogrel", "โคลพิโดเกรล", ["Plavix", "Apolets"],
+     "1 เม็ด", ["morning"], "ต้านเกล็ดเลือด", "ระวังเลือดออกง่าย"),
+    ("Warfarin", "วาร์ฟาริน", ["Orfarin", "Coumadin"],
+     "1 เม็ด", ["bedtime"], "ป้องกันลิ่มเลือด", "ทานตรงเวลา ระวังเลือดออก เลี่ยงยาสมุนไพร"),
+    ("Omeprazole", "โอเมพราโซล", ["Miracid", "Losec"],
+     "1 แคปซูล", ["morning"], "ลดกรดในกระเพาะ", "ทานก่อนอาหารเช้า 30 นาที"),
+    ("Domperidone", "ดอมเพอริโดน", ["Motilium"],
+     "1 เม็ด", ["morning", "noon", "evening"], "แก้คลื่นไส้ อาเจียน ท้องอืด", "ทานก่อนอาหาร"),
+    ("Simethicone", "ไซเมทิโคน", ["Air-X", "Gas-X"],
+     "1 เม็ด", ["morning", "noon", "evening"], "ลดแก๊สในกระเพาะ ท้องอืด", "เคี้ยวก่อนกลืน"),
+    ("Senna", "มะขามแขก", ["Senokot", "Sennoside"],
+     "2 เม็ด", ["bedtime"], "ระบาย แก้ท้องผูก", "ไม่ควรใช้ต่อเนื่องนาน"),
+    ("Levothyroxine", "เลโวไทร็อกซิน", ["Euthyrox", "Eltroxin", "Thyroxine"],
+     "1 เม็ด", ["morning"], "ฮอร์โมนไทรอยด์", "ทานตอนท้องว่าง ก่อนอาหารเช้า"),
+    ("Allopurinol", "อัลโลพูรินอล", ["Zyloric"],
+     "1 เม็ด", ["morning"], "ลดกรดยูริก ป้องกันเกาต์", "หยุดยาและพบแพทย์หากมีผื่น"),
+    ("Colchicine", "โคลชิซีน", ["Colcine"],
+     "1 เม็ด", ["morning", "evening"], "รักษาเกาต์ ลดข้ออักเสบ", "หยุดยาหากท้องเสีย"),
+    ("Ibuprofen", "ไอบูโพรเฟน", ["Brufen", "Gofen", "Nurofen"],
+     "1 เม็ด", ["morning", "evening"], "แก้ปวด ลดอักเสบ", "ทานหลังอาหารทันที ระวังโรคไตและกระเพาะ"),
+    ("Diclofenac", "ไดโคลฟีแนค", ["Voltaren", "Cataflam"],
+     "1 เม็ด", ["morning", "evening"], "แก้ปวด ลดอักเสบ", "ทานหลังอาหารทันที ระวังโรคไตและกระเพาะ"),
+    ("Tramadol", "ทรามาดอล", ["Tramol", "Tramadal"],
+     "1 แคปซูล", ["morning", "evening"], "แก้ปวดปานกลางถึงรุนแรง", "อาจง่วงซึม ระวังหกล้ม"),
+    ("Cetirizine", "เซทิริซีน", ["Zyrtec", "Zyrac"],
+     "1 เม็ด", ["bedtime"], "แก้แพ้ ผื่นคัน น้ำมูก", "อาจง่วงนอน"),
+    ("Chlorpheniramine", "คลอร์เฟนิรามีน", ["CPM", "Piriton"],
+     "1 เม็ด", ["bedtime"], "แก้แพ้ ลดน้ำมูก", "ทำให้ง่วงนอน ระวังหกล้ม"),
+    ("Lorazepam", "ลอราซีแพม", ["Ativan"],
+     "1 เม็ด", ["bedtime"], "คลายกังวล ช่วยให้นอนหลับ", "ทำให้ง่วงซึม ระวังหกล้ม"),
+    ("Amitriptyline", "อะมิทริปไทลีน", ["Tryptanol"],
+     "1 เม็ด", ["bedtime"], "ช่วยนอนหลับ ลดปวดปลายประสาท", "อาจปากแห้ง ง่วงซึม"),
+    ("Calcium Carbonate", "แคลเซียมคาร์บอเนต", ["Calcium", "Caltrate", "แคลเซียม"],
+     "1 เม็ด", ["noon"], "เสริมแคลเซียม บำรุงกระดูก", "ทานพร้อมอาหาร"),
+    ("Ferrous Sulfate", "เฟอรัสซัลเฟต", ["Ferrous", "FeSO4", "ยาบำรุงเลือด"],
+     "1 เม็ด", ["morning"], "บำรุงเลือด รักษาโลหิตจาง", "อุจจาระอาจมีสีดำ"),
+    ("Folic Acid", "กรดโฟลิก", ["Folic", "Folate", "โฟลิก"],
+     "1 เม็ด", ["morning"], "บำรุงเลือด", ""),
+    ("Vitamin B Complex", "วิตามินบีรวม", ["B-Co", "B Complex", "วิตามินบีคอมเพล็กซ์"],
+     "1 เม็ด", ["morning"], "บำรุงประสาท", ""),
+]
+
+# Strengths and units are dropped before matching: "Amlodipine 5 mg" and "Amlodipine 10mg"
+# are the same drug (the strength is kept separately, see split_strength())
+_STRENGTH = re.compile(
+    r"(\d+(?:[.,]\d+)?)\s*(mg|mcg|µg|ug|g|ml|iu|units?|%|มก\.?|มิลลิกรัม|ไมโครกรัม|กรัม|มล\.?)(?![a-z])",
+    re.IGNORECASE,
+)
+# Thai tone marks and the silent-letter mark (่ ้ ๊ ๋ ์): labels spell them inconsistently
+_THAI_MARKS = dict.fromkeys(range(0x0E48, 0x0E4D))
+_NON_WORD = re.compile("[^0-9a-z\u0e00-\u0e7f]+")
+# "Amlodipine + Atorvastatin", "Calcium & Vit D", "Losartan/HCTZ": more than one ingredient
+_COMBINATION = re.compile(r"[+&/]|\b(?:and|with|plus)\b|และ|ผสม", re.IGNORECASE)
+WORD_MIN_SCORE = 0.7 # A label word still counts as the catalog word despite a typo
+# Dosage-form and salt words say nothing about which drug it is
+_FORM_WORDS = {
+    "tab", "tabs", "tablet", "tablets", "cap", "caps", "capsule", "capsules", "syrup", "เม็ด", "แคปซูล", "ยา",
+    "potassium", "sodium", "hcl", "hydrochloride", "besylate", "besilate", "maleate", "tartrate", "succinate",
+}
+
+def split_strength(text):
+    """("Sara", "500 mg") from "Sara 500mg"; the strength part is "" when there is none."""
+    text = unicodedata.normalize('NFKC', str(text or ''))
+    strengths = [f"{m.group(1)} {m.group(2)}" for m in _STRENGTH.finditer(text)]
+    name = _STRENGTH.sub(" ", text)
+    return re.sub(r"\s+", " ", name).strip(" -,/"), " ".join(strengths)
+
+def normalize_name(text):
+    """Matching key of a medicine name: lowercase, no strength, form words, punctuation or Thai tone marks."""
+    name, _ = split_strength(text)
+    name = name.lower().translate(_THAI_MARKS)
+    return " ".join(w for w in _NON_WORD.sub(" ", name).split() if w not in _FORM_WORDS)
+
+def trigrams(key):
+    """Character trigrams of a normalized name, each word padded so short names still match."""
+    grams = set()
+    for word in key.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def similarity(shared, grams_a, grams_b):
+    """Dice coefficient of two trigram sets, from their sizes and overlap (0..1)."""
+    total = grams_a + grams_b
+    return 2.0 * shared / total if total else 0.0
+
+def is_combination(text):
+    """True when a medicine name lists several ingredients ("A + B", "A/B 5/10 mg")."""
+    name, _ = split_strength(text)
+    return bool(_COMBINATION.search(name))
+
+def is_full_match(text, spelling):
+    """
+    True when text names exactly the drug of a catalog spelling: a single ingredient,
+    and every word of it is a word of the spelling. A high trigram score alone is not
+    enough - "Atorvastatin" scores high against "Amlodipine + Atorvastatin" too.
+    """
+    if is_combination(text):
+        return False
+    words = [w for w in normalize_name(text).split() if not w.isdigit()] # "Glucophage 500": a bare strength
+    catalog_words = [trigrams(w) for w in normalize_name(spelling).split()]
+    if not words:
+        return False
+    for word in words:
+        grams = trigrams(word)
+        if not any(similarity(len(grams & other), len(grams), len(other)) >= WORD_MIN_SCORE for other in catalog_words):
+            return False
+    return True
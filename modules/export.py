@@ -0,0 +1,110 @@
+import csv
+import datetime
+import importlib.util
+import io
+
+from modules import archive, database, schedule, startup
+
+# --- Doctor Reports ---
+# Every export is a generator fed by database.iter_*(), which reads the cursor in chunks:
+# memory stays at one chunk however many years of history there are. The writers below
+# go to any binary file object (a temp file for st.download_button, a socket, ...).
+
+LOG_COLUMNS = ['id', 'time', 'med_id', 'medicine', 'action', 'period', 'note']
+
+def _local_time(db_timestamp):
+    # activity_logs.timestamp is UTC text; doctors read local wall-clock time
+    utc = datetime.datetime.strptime(db_timestamp, '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc)
+    return utc.astimezone().replace(tzinfo=None)
+
+def _log_rows(chunk):
+    return [(log_id, _local_time(ts), med_id, name, action, period, note) for log_id, ts, med_id, name, action, period, note in chunk]
+
+def _log_chunks(start, end, patient_id):
+    # Archived months are all older than the live table, so this stays oldest first
+    yield from archive.iter_archived_logs(start, end, patient_id)
+    yield from database.iter_activity_logs(start, end, patient_id)
+
+def csv_chunks(start=None, end=None, patient_id=database.DEFAULT_PATIENT_ID):
+    """Activity logs in [start, end) as UTF-8 CSV, yielded as bytes one chunk at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff') # BOM: Excel opens Thai text correctly
+    writer.writerow(LOG_COLUMNS)
+    for chunk in _log_chunks(start, end, patient_id):
+        for row in _log_rows(chunk):
+            writer.writerow(row[:1] + (row[1].strftime('%Y-%m-%d %H:%M:%S'),) + row[2:])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def write_csv(fileobj, start=None, end=None, patient_id=database.DEFAULT_PATIENT_ID):
+    for data in csv_chunks(start, end, patient_id):
+        fileobj.write(data)
+
+def parquet_available():
+    # Checked without importing pyarrow (slow) until an export actually needs it
+    return importlib.util.find_spec('pyarrow') is not None
+
+def write_parquet(fileobj, start=None, end=None, patient_id=database.DEFAULT_PATIENT_ID):
+    """
+    Activity logs in [start, end) as Parquet (one row group per chunk).
+    Needs the optional pyarrow package: check parquet_available() first.
+    """
+    pa = startup.lazy_import('pyarrow')
+    pq = startup.lazy_import('pyarrow.parquet')
+    schema = pa.schema([
+        ('id', pa.int64()), ('time', pa.timestamp('s')), ('med_id', pa.int64()),
+        ('medicine', pa.string()), ('action', pa.dictionary(pa.int8(), pa.string())),
+        ('period', pa.dictionary(pa.int8(), pa.string())), ('note', pa.string()),
+    ])
+    with pq.ParquetWriter(fileobj, schema, compression='zstd') as writer:
+        for chunk in _log_chunks(start, end, patient_id):
+            columns = list(zip(*_log_rows(chunk)))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema
+            ))
+
+# --- Dosing Calendar ---
+def ics_chunks(patient_id=database.DEFAULT_PATIENT_ID, alarm=True):
+    """
+    The dosing schedule as an iCalendar feed: one daily repeating event per medication
+    and period, serialized event by event (bytes).
+    """
+    icalendar = startup.lazy_import('icalendar')
+    settings = database.get_user_settings(patient_id) or {}
+    yield (
+        "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Ya-Mor//Dosing Schedule//TH\r\n"
+        f"X-WR-CALNAME:ยาหมอ {settings.get('name') or ''}\r\n"
+    ).encode('utf-8')
+    stamp = datetime.datetime.now(datetime.timezone.utc)
+    for chunk in database.iter_schedules(patient_id):
+        events = []
+        for med_id, name, dosage, period, time_of_day, created_at in chunk:
+            dose_time = (
+                datetime.time.fromisoformat(time_of_day) if time_of_day else schedule.PERIOD_DOSE_TIMES[period]
+            )
+            first_day = datetime.date.fromisoformat(str(created_at)[:10]) if created_at else datetime.date.today()
+            event = icalendar.Event()
+            event.add('uid', f"yamor-{patient_id}-{med_id}-{period}@ya-mor") # Stable: re-imports update, not duplicate
+            event.add('dtstamp', stamp)
+            event.add('summary', f"💊 {name} ({dosage})" if dosage else f"💊 {name}")
+            event.add('description', f"ทานยารอบ {schedule.PERIOD_LABELS[period]}")
+            event.add('dtstart', datetime.datetime.combine(first_day, dose_time))
+            event.add('duration', datetime.timedelta(minutes=15))
+            event.add('rrule', {'freq': 'daily'})
+            if alarm:
+                reminder = icalendar.Alarm()
+                reminder.add('action', 'DISPLAY')
+                reminder.add('description', f"ได้เวลาทาน {name}")
+                reminder.add('trigger', datetime.timedelta(0))
+                event.add_component(reminder)
+            events.append(event.to_ical())
+        yield b"".join(events)
+    yield b"END:VCALENDAR\r\n"
+
+def write_ics(fileobj, patient_id=database.DEFAULT_PATIENT_ID):
+    for data in ics_chunks(patient_id):
+        fileobj.write(data)
@@ -0,0 +1,83 @@
+import hashlib
+import io
+import os
+import threading
+
+# --- Image Preprocessing ---
+# Phone cameras produce 12+ MP photos; Gemini reads a label just as well at a bounded
+# size, and a smaller upload means a faster response.
+MAX_LONG_EDGE = 1600
+THUMB_LONG_EDGE = 240
+JPEG_QUALITY = 85
+THUMB_QUALITY = 70
+
+# Content-addressed store: the file name is the SHA-256 of the encoded bytes, so the
+# same photo is only ever stored once and a path can never point at different content.
+MEDIA_DIR = 'media'
+
+def preprocess(image, grayscale=False):
+    """
+    Prepares a camera photo for OCR:
+    - applies the EXIF orientation (phones store portrait shots rotated)
+    - downscales so the long edge is at most MAX_LONG_EDGE
+    - stretches contrast (faded pharmacy labels read better)
+    Returns a new RGB (or 'L' if grayscale) image.
+    """
+    from PIL import Image, ImageOps # Imported on first scan, not on every page load
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('L' if grayscale else 'RGB')
+    if max(image.size) > MAX_LONG_EDGE:
+        image.thumbnail((MAX_LONG_EDGE, MAX_LONG_EDGE), Image.LANCZOS)
+    return ImageOps.autocontrast(image, cutoff=1)
+
+def _encode(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def encode_jpeg(image):
+    """The stored JPEG encoding of a (preprocessed) image - also what Gemini is sent."""
+    return _encode(image, JPEG_QUALITY)
+
+def _write_once(path, data):
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Per thread: Streamlit sessions are threads of one process and may save the same photo at once
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path) # Atomic: readers never see a half-written file
+
+def save(image):
+    """
+    Stores a (preprocessed) image and its thumbnail.
+    Returns the image path; the thumbnail path is thumbnail_path(image_path).
+    """
+    from PIL import Image
+    data = encode_jpeg(image)
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(MEDIA_DIR, digest[:2], f"{digest}.jpg")
+    _write_once(path, data)
+
+    thumb = image.copy()
+    thumb.thumbnail((THUMB_LONG_EDGE, THUMB_LONG_EDGE), Image.LANCZOS)
+    _write_once(thumbnail_path(path), _encode(thumb, THUMB_QUALITY))
+    return path
+
+def thumbnail_path(image_path):
+    root, ext = os.path.splitext(image_path)
+    return f"{root}_thumb{ext}"
+
+def existing_thumbnail(image_path):
+    """Thumbnail of a stored image, or None (e.g. old rows with the 'path/to/img' placeholder)."""
+    if not image_path:
+        return None
+    path = thumbnail_path(image_path)
+    return path if os.path.isfile(path) else None
+
+def prepare_upload(uploaded_file):
+    """Opens an uploaded photo, preprocesses it and stores it. Returns (image, image_path)."""
+    from PIL import Image
+    image = preprocess(Image.open(uploaded_file))
+    return image, save(image)
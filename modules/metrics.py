@@ -0,0 +1,221 @@
+import cProfile
+import contextlib
+import functools
+import inspect
+import io
+import math
+import pstats
+import threading
+import time
+
+# --- Hot-Path Metrics ---
+# Timings of every database call, Gemini attempt, LINE push and gTTS synthesis are
+# aggregated in memory as histograms (a fixed set of log-spaced buckets, so recording is
+# one dict update and percentiles never need the raw samples). A background thread
+# flushes one row per name and FLUSH_INTERVAL_SEC window into the 'metrics' table.
+# Names are '<area>.<what>' (db.*, gemini.*, line.*, tts.*), so the diagnostics page can
+# say which area the time went to.
+FLUSH_INTERVAL_SEC = 60
+RETENTION_DAYS = 14
+
+BUCKET_MIN_MS = 0.01
+BUCKET_GROWTH = 1.25 # Each bucket is 25% wider than the previous: percentiles within 25%
+BUCKET_COUNT = 80 # Up to ~570 s
+
+_lock = threading.Lock()
+_window = {} # name -> Histogram since the last flush
+_totals = {} # name -> Histogram since process start
+_window_started = time.time()
+_flusher = None
+last_profile = None # Text report of the last profiled() block
+
+def _bucket(ms):
+    if ms <= BUCKET_MIN_MS:
+        return 0
+    return min(int(math.ceil(math.log(ms / BUCKET_MIN_MS, BUCKET_GROWTH))), BUCKET_COUNT - 1)
+
+def bucket_upper_ms(index):
+    return BUCKET_MIN_MS * BUCKET_GROWTH ** index
+
+class Histogram:
+    __slots__ = ('count', 'errors', 'total_ms', 'max_ms', 'buckets')
+
+    def __init__(self, count=0, errors=0, total_ms=0.0, max_ms=0.0, buckets=None):
+        self.count = count
+        self.errors = errors
+        self.total_ms = total_ms
+        self.max_ms = max_ms
+        self.buckets = dict(buckets or {}) # bucket index -> samples
+
+    def add(self, ms, ok=True):
+        self.count += 1
+        self.errors += not ok
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        index = _bucket(ms)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+
+    def percentile(self, p):
+        """Upper bound (ms) of the bucket holding the p-th percentile sample."""
+        if not self.count:
+            return None
+        rank = max(math.ceil(p / 100 * self.count), 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(bucket_upper_ms(index), self.max_ms)
+        return self.max_ms
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": self.total_ms / self.count if self.count else None,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "max_ms": self.max_ms,
+            "total_ms": self.total_ms,
+        }
+
+# --- Recording ---
+def observe(name, seconds, ok=True):
+    """Records one timing (seconds) under name; ok=False counts it as an error."""
+    ms = seconds * 1000
+    with _lock:
+        for store in (_window, _totals):
+            histogram = store.get(name)
+            if histogram is None:
+                histogram = store[name] = Histogram()
+            histogram.add(ms, ok)
+
+def increment(name, n=1):
+    """A plain counter (e.g. cache hits): stored as samples of 0 ms."""
+    for _ in range(n):
+        observe(name, 0.0)
+
+class _Sample:
+    __slots__ = ('ok',)
+
+    def __init__(self):
+        self.ok = True
+
+@contextlib.contextmanager
+def timer(name):
+    """
+    Times the block under name. An exception marks the sample as an error;
+    the block can also set 'sample.ok = False' itself (e.g. on an HTTP error status).
+    """
+    sample = _Sample()
+    start = time.perf_counter()
+    try:
+        yield sample
+    except BaseException:
+        sample.ok = False
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, sample.ok)
+
+def instrument(name):
+    """Decorator: times every call of the function under name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        wrapper.__wrapped_by_metrics__ = True
+        return wrapper
+    return decorator
+
+def instrument_module(module, prefix, exclude=()):
+    """
+    Wraps every public function defined in module with a timer named '<prefix>.<function>'.
+    Callers that look functions up through the module (database.get_medications(...))
+    are timed; safe to call more than once.
+    """
+    for attr, func in list(vars(module).items()):
+        if (
+            attr.startswith('_') or attr in exclude or not inspect.isfunction(func)
+            or func.__module__ != module.__name__ or getattr(func, '__wrapped_by_metrics__', False)
+        ):
+            continue
+        setattr(module, attr, instrument(f"{prefix}.{attr}")(func))
+
+# --- Reading ---
+def snapshot():
+    """{name: summary} of everything recorded since the process started."""
+    with _lock:
+        return {name: h.summary() for name, h in sorted(_totals.items())}
+
+def by_area(summaries):
+    """Total time and calls per area (the part of the name before the first dot)."""
+    areas = {}
+    for name, s in summaries.items():
+        area = areas.setdefault(name.split('.', 1)[0], {"count": 0, "errors": 0, "total_ms": 0.0})
+        area["count"] += s["count"]
+        area["errors"] += s["errors"]
+        area["total_ms"] += s["total_ms"]
+    return areas
+
+def history(since_seconds=86400):
+    """{name: summary} merged from the flushed windows of the last since_seconds."""
+    from modules import database
+    merged = {}
+    for name, count, errors, total_ms, max_ms, buckets in database.get_metrics(time.time() - since_seconds):
+        merged.setdefault(name, Histogram()).merge(Histogram(count, errors, total_ms, max_ms, buckets))
+    return {name: h.summary() for name, h in sorted(merged.items())}
+
+# --- Flushing ---
+def flush():
+    """Writes the current window to the metrics table and starts a new one."""
+    global _window, _window_started
+    with _lock:
+        window, started = _window, _window_started
+        _window, _window_started = {}, time.time()
+    if not window:
+        return 0
+    from modules import database
+    database.save_metrics(
+        [(started, name, h.count, h.errors, h.total_ms, h.max_ms, h.buckets) for name, h in window.items()],
+        RETENTION_DAYS * 86400
+    )
+    return len(window)
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL_SEC)
+        try:
+            flush()
+        except Exception as e:
+            print(f"[metrics] flush failed: {e}")
+
+def start_flusher():
+    """Starts the periodic flush thread once per process."""
+    global _flusher
+    with _lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True)
+            _flusher.start()
+
+# --- Profiling ---
+@contextlib.contextmanager
+def profiled(limit=40):
+    """cProfile around the block; the top 'limit' functions by cumulative time end up in last_profile."""
+    global last_profile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+        last_profile = out.getvalue()
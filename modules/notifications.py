@@ -1,18 +1,43 @@
 import requests
 import streamlit as st
+import base64
+import hashlib
+import hmac
 import json
+import threading
+import time
+from requests.adapters import HTTPAdapter
 
-def send_line_message(access_token, user_id, message, image_file=None):
-    """
-    Sends a push message using LINE Messaging API.
-    Note: Free tier has a 200 message/month limit.
-    """
-    url = 'https://api.line.me/v2/bot/message/push'
+from modules import database, metrics
+
+LINE_PUSH_URL = 'https://api.line.me/v2/bot/message/push'
+LINE_REPLY_URL = 'https://api.line.me/v2/bot/message/reply'
+REQUEST_TIMEOUT = (3.05, 10) # (connect, read) seconds - never hang the caller on a slow LINE API
+REPLY_WORKERS = 64 # Replies in flight at once (each is a blocking HTTPS call)
+
+_session = None
+_session_lock = threading.Lock()
+
+def _get_session():
+    # One pooled, keep-alive session per process instead of a new TCP/TLS handshake per push
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # Sized for line_webhook.py, which sends up to REPLY_WORKERS replies at once
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=REPLY_WORKERS)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter) # Local fake servers (bench/fakes.py)
+                _session = session
+    return _session
+
+def _push(access_token, user_id, message):
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
-    
+
     payload = {
         "to": user_id,
         "messages": [
@@ -22,15 +47,139 @@ def send_line_message(access_token, user_id, message, image_file=None):
             }
         ]
     }
-    
-    # Image handling in Messaging API is harder (requires public URL). 
+    with metrics.timer("line.push") as sample:
+        response = _get_session().post(LINE_PUSH_URL, headers=headers, data=json.dumps(payload), timeout=REQUEST_TIMEOUT)
+        sample.ok = response.status_code == 200
+    return response
+
+def send_line_message(access_token, user_id, message, image_file=None):
+    """
+    Sends a push message using LINE Messaging API.
+    Note: Free tier has a 200 message/month limit.
+    """
+    # Image handling in Messaging API is harder (requires public URL).
     # For now, we stick to text alerts to keep it simple without needing external storage.
-    
+
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
+        response = _push(access_token, user_id, message)
         if response.status_code == 200:
             return True, "แจ้งเตือน LINE สำเร็จ"
         else:
             return False, f"LINE Error: {response.status_code} - {response.text}"
     except Exception as e:
         return False, f"Exception: {e}"
+
+# --- Webhook Replies ---
+# Inbound events (line_webhook.py) are answered with their reply token: a reply is free,
+# while every push counts against the monthly quota. A token works once, within a minute.
+def verify_signature(channel_secret, body, signature):
+    """True if X-Line-Signature is the base64 HMAC-SHA256 of the raw body under the channel secret."""
+    if not channel_secret or not signature:
+        return False
+    digest = hmac.new(channel_secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode('ascii'), signature)
+
+def postback_action(label, data, display_text=None):
+    return {"type": "postback", "label": label[:20], "data": data, "displayText": display_text or label}
+
+def message_action(label, text):
+    return {"type": "message", "label": label[:20], "text": text}
+
+def text_message(text, actions=()):
+    """A text message, with quick-reply buttons for the given actions (LINE shows at most 13)."""
+    message = {"type": "text", "text": text}
+    if actions:
+        message["quickReply"] = {"items": [{"type": "action", "action": action} for action in list(actions)[:13]]}
+    return message
+
+def reply_message(access_token, reply_token, messages):
+    """Answers a webhook event (up to 5 messages). Returns (ok, error message)."""
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    payload = {"replyToken": reply_token, "messages": list(messages)[:5]}
+    try:
+        with metrics.timer("line.reply") as sample:
+            response = _get_session().post(LINE_REPLY_URL, headers=headers, data=json.dumps(payload), timeout=REQUEST_TIMEOUT)
+            sample.ok = response.status_code == 200
+        if sample.ok:
+            return True, ""
+        return False, f"LINE Error: {response.status_code} - {response.text}"
+    except requests.RequestException as e:
+        return False, f"Exception: {e}"
+
+# --- Outbox Worker ---
+# The app only writes alerts into database.notification_outbox (a local insert).
+# This background thread drains it: alerts for the same caregiver that arrive within
+# COALESCE_SECONDS are merged into one push (saves the 200/month quota), and failures
+# are retried with exponential backoff instead of being lost.
+COALESCE_SECONDS = 60
+MAX_ATTEMPTS = 6
+BACKOFF_BASE_SEC = 30
+BACKOFF_MAX_SEC = 3600
+IDLE_POLL_SEC = 300 # Safety net in case another process queued something
+
+_worker = None
+_worker_lock = threading.Lock()
+_wake = threading.Event()
+
+def _send_batch(batch):
+    if not batch["line_token"] or not batch["user_id"]:
+        database.mark_notifications_failed(batch["ids"], "LINE is not configured")
+        return False
+
+    message = "\n".join(batch["messages"])
+    try:
+        response = _push(batch["line_token"], batch["user_id"], message)
+        if response.status_code == 200:
+            database.mark_notifications_sent(batch["ids"])
+            return True
+        error = f"LINE Error: {response.status_code} - {response.text}"
+        # 429 / 5xx are worth retrying; other 4xx (bad token, bad user id) will not fix themselves
+        retryable = response.status_code == 429 or response.status_code >= 500
+    except requests.RequestException as e:
+        error = f"Exception: {e}"
+        retryable = True
+
+    attempts = batch["attempts"] + 1
+    retry_at = None
+    if retryable and attempts < MAX_ATTEMPTS:
+        retry_at = time.time() + min(BACKOFF_BASE_SEC * 2 ** (attempts - 1), BACKOFF_MAX_SEC)
+    database.mark_notifications_failed(batch["ids"], error, retry_at)
+    return False
+
+def drain_outbox():
+    """Sends every outbox batch that is due now. Returns the number of pushes that succeeded."""
+    sent = 0
+    for batch in database.claim_notifications(COALESCE_SECONDS):
+        if _send_batch(batch):
+            sent += 1
+    return sent
+
+def _worker_loop():
+    while True:
+        try:
+            drain_outbox()
+            next_due = database.get_next_notification_due(COALESCE_SECONDS)
+            timeout = IDLE_POLL_SEC if next_due is None else min(max(next_due - time.time(), 0.5), IDLE_POLL_SEC)
+        except Exception as e:
+            print(f"[notifications] outbox worker error: {e}")
+            timeout = BACKOFF_BASE_SEC
+        # Sleep until the next row is due, or until someone queues a new alert
+        _wake.wait(timeout)
+        _wake.clear()
+
+def start_outbox_worker():
+    """Starts the background sender once per process (safe to call on every rerun)."""
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name="line-outbox", daemon=True)
+            _worker.start()
+
+def wake_outbox_worker():
+    """Tells the worker a new alert was queued, so it can recompute when to send."""
+    _wake.set()
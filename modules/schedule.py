@@ -0,0 +1,49 @@
+import datetime
+
+# --- Dosing Periods ---
+# The day is split into four periods (local time). A dose belongs to the period whose
+# window contains it; when a window closes, untaken doses of that period are 'missed'.
+PERIODS = ('morning', 'noon', 'evening', 'bedtime')
+
+PERIOD_WINDOWS = { # period -> (start hour, end hour)
+    "morning": (0, 11),
+    "noon": (11, 16),
+    "evening": (16, 20),
+    "bedtime": (20, 24),
+}
+
+# Default reminder time of each period (when a schedule has no time_of_day)
+PERIOD_DOSE_TIMES = {
+    "morning": datetime.time(8, 0),
+    "noon": datetime.time(12, 0),
+    "evening": datetime.time(18, 0),
+    "bedtime": datetime.time(21, 0),
+}
+
+PERIOD_LABELS = {
+    "morning": "☀️ เช้า",
+    "noon": "☀️ เที่ยง",
+    "evening": "🌆 เย็น",
+    "bedtime": "🌙 ก่อนนอน"
+}
+
+def current_period(now=None):
+    hour = (now or datetime.datetime.now()).hour
+    for period in PERIODS:
+        start, end = PERIOD_WINDOWS[period]
+        if start <= hour < end:
+            return period
+    return PERIODS[-1]
+
+def period_window(day, period):
+    """(start, end) local datetimes of a period on a given date; end is exclusive."""
+    start_hour, end_hour = PERIOD_WINDOWS[period]
+    midnight = datetime.datetime.combine(day, datetime.time())
+    return midnight + datetime.timedelta(hours=start_hour), midnight + datetime.timedelta(hours=end_hour)
+
+def next_period_end(period, after):
+    """First end of the period's window strictly after the 'after' datetime."""
+    end = period_window(after.date(), period)[1]
+    if end <= after:
+        end = period_window(after.date() + datetime.timedelta(days=1), period)[1]
+    return end
@@ -0,0 +1,79 @@
+import importlib
+import sys
+import threading
+import time
+
+# --- Process Startup ---
+# Streamlit re-executes app.py on every click, but Python modules stay loaded for the
+# life of the server process. One-time work (schema migrations, Gemini client, workers)
+# therefore lives here behind a module-level flag, and heavy libraries that only the
+# scan page needs are imported on first use through lazy_import().
+# Every timing ends up in report(), so a slow cold start or a new heavy import shows up.
+
+_process_started = time.time()
+_timings = {} # name -> seconds (first occurrence only)
+_lock = threading.Lock()
+_init_lock = threading.Lock()
+_done = False
+
+# database functions that are not worth a timer: plumbing, pure parsing, and the
+# metrics table itself (timing the flush would feed the next flush)
+NOT_INSTRUMENTED = {
+    'get_connection', 'close_connections', 'clear_cache', 'open_change_probe',
+    'parse_frequency', 'parse_dose_units', 'next_page_cursor', 'save_metrics', 'get_metrics',
+    'iter_activity_logs', 'iter_schedules', 'iter_log_month', # Generators: a timer would only see the first call
+}
+
+def record(name, seconds):
+    with _lock:
+        _timings.setdefault(name, seconds)
+
+def timed(name, func, *args, **kwargs):
+    """Runs func and records how long it took under name."""
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        record(name, time.perf_counter() - start)
+
+def lazy_import(module_name):
+    """Imports a module on first use and records the import time ('import <name>')."""
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    return timed(f"import {module_name}", importlib.import_module, module_name)
+
+def run_once():
+    """
+    Process-level initialization; a no-op on every rerun after the first that succeeded.
+    A failing step raises (Streamlit shows the error) and the next rerun tries again:
+    every step is safe to repeat.
+    """
+    global _done
+    if _done:
+        return
+    # Sessions arriving meanwhile wait here, so nobody queries a half-migrated DB
+    with _init_lock:
+        if _done:
+            return
+        from modules import database, ai_vision, notifications, tts, metrics
+        metrics.instrument_module(database, 'db', exclude=NOT_INSTRUMENTED)
+        timed("database.init_db", database.init_db)
+        timed("ai_vision.configure_genai", ai_vision.configure_genai)
+        timed("notifications.start_outbox_worker", notifications.start_outbox_worker)
+        timed("tts.warm_cache", tts.warm_cache)
+        timed("metrics.start_flusher", metrics.start_flusher)
+        _done = True # Only once every step succeeded; a half-migrated DB is retried next rerun
+    print(format_report())
+
+def report():
+    """{'uptime_sec': ..., 'timings': {name: seconds}} for diagnostics."""
+    with _lock:
+        timings = dict(_timings)
+    return {"uptime_sec": time.time() - _process_started, "timings": timings}
+
+def format_report():
+    lines = ["[startup] timings:"]
+    for name, seconds in sorted(report()["timings"].items(), key=lambda kv: -kv[1]):
+        lines.append(f"  {seconds * 1000:8.1f} ms  {name}")
+    return "\n".join(lines)
@@ -0,0 +1,110 @@
+import hashlib
+import io
+import os
+import threading
+
+from modules import metrics
+
+# --- Text-to-Speech Cache ---
+# gTTS is a network round-trip to Google for every phrase, and most phrases repeat
+# ("เจอแล้วค่ะ", "บันทึก ... เรียบร้อยแล้วค่ะ"). MP3 bytes are cached on disk by (text, lang),
+# least-recently-used files are evicted above MAX_CACHE_BYTES.
+# MP3 frames can be concatenated (gTTS itself does this for long text), so sentences are
+# spoken as fixed segments + variable segments: the fixed ones are warmed at startup and
+# only a new medicine name ever needs the network.
+CACHE_DIR = 'tts_cache'
+MAX_CACHE_BYTES = 50 * 1024 * 1024
+SYNTH_TIMEOUT_SEC = 5
+
+COMMON_PHRASES = [
+    "เจอแล้วค่ะ", "กินช่วง", "ค่ะ",
+    "เช้า", "เที่ยง", "เย็น", "ก่อนนอน",
+    "บันทึก", "เรียบร้อยแล้วค่ะ", "บันทึกยา", "รายการ",
+]
+
+_evict_lock = threading.Lock()
+_warm_started = False
+
+def _cache_path(text, lang):
+    digest = hashlib.sha256(f"{lang}\0{text}".encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, f"{digest}.mp3")
+
+def _evict():
+    with _evict_lock:
+        files = []
+        total = 0
+        for entry in os.scandir(CACHE_DIR):
+            if entry.name.endswith('.mp3'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= MAX_CACHE_BYTES:
+            return
+        for _, size, path in sorted(files): # Oldest use first
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            if total <= MAX_CACHE_BYTES:
+                return
+
+def synthesize(text, lang='th'):
+    """MP3 bytes for text, from the disk cache when possible (network only on a miss)."""
+    path = _cache_path(text, lang)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path) # Mark as recently used for LRU eviction
+        metrics.increment("tts.cache_hit")
+        return data
+    except FileNotFoundError:
+        pass
+
+    from gtts import gTTS # Heavy import, only needed on a cache miss
+    buffer = io.BytesIO()
+    with metrics.timer("tts.gtts"):
+        gTTS(text=text, lang=lang, timeout=SYNTH_TIMEOUT_SEC).write_to_fp(buffer)
+    data = buffer.getvalue()
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    _evict()
+    return data
+
+def speak(*segments, lang='th'):
+    """
+    MP3 bytes for a sentence given as segments, e.g. speak("บันทึก", name, "เรียบร้อยแล้วค่ะ").
+    A segment that cannot be synthesized (offline) is skipped so the rest still plays.
+    Returns None if nothing could be synthesized.
+    """
+    parts = []
+    for segment in segments:
+        segment = str(segment).strip()
+        if not segment:
+            continue
+        try:
+            parts.append(synthesize(segment, lang))
+        except Exception as e:
+            print(f"[tts] could not synthesize '{segment}': {e}")
+    return b"".join(parts) or None
+
+def warm_cache(phrases=None, lang='th'):
+    """Synthesizes missing common phrases in a background thread (once per process)."""
+    global _warm_started
+    if _warm_started:
+        return
+    _warm_started = True
+
+    def _warm():
+        for phrase in phrases or COMMON_PHRASES:
+            if not os.path.exists(_cache_path(phrase, lang)):
+                try:
+                    synthesize(phrase, lang)
+                except Exception as e:
+                    print(f"[tts] warm-up skipped '{phrase}': {e}")
+                    return # Probably offline; try again next start
+    threading.Thread(target=_warm, name="tts-warmup", daemon=True).start()
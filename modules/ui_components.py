@@ -1,5 +1,112 @@
+import base64
+import functools
+import html
 import streamlit as st
 
+from modules import image_store
+
+# --- Fragments ---
+# st.fragment (Streamlit >= 1.37) reruns only the decorated function when a widget inside
+# it is used. Older versions only have the experimental name.
+fragment = getattr(st, 'fragment', None) or st.experimental_fragment
+
+def rerun_fragment():
+    """Reruns only the current fragment (falls back to a full rerun on old Streamlit)."""
+    try:
+        st.rerun(scope="fragment")
+    except TypeError:
+        st.rerun()
+
+# --- Global CSS for Senior UI ---
+GLOBAL_CSS = """
+<style>
+    /* Fluid Typography: Scales with screen width but never gets too small */
+    html, body, [class*="css"] {
+        font-family: 'Sarabun', sans-serif;
+        /* Minimum 18px, Preference 5% of viewport width, Maximum 26px */
+        font-size: clamp(20px, 5vw, 26px); 
+    }
+    
+    /* Responsive Headers */
+    h1 { 
+        font-size: clamp(2rem, 8vw, 3rem) !important; 
+        color: #1B4F72; 
+        text-align: center; 
+        margin-bottom: 20px; 
+    }
+    h2 { 
+        font-size: clamp(1.6rem, 6vw, 2.2rem) !important; 
+        color: #154360; 
+        border-bottom: 3px solid #D4E6F1; 
+        padding-bottom: 10px; 
+    }
+    h3 { font-size: 1.4rem !important; color: #21618C; }
+    p, div, label, span { font-size: 1rem !important; }
+    
+    /* Responsive Buttons */
+    .stButton > button {
+        min-height: 70px !important; /* Allow growing if text wraps */
+        height: auto !important;
+        padding-top: 15px !important;
+        padding-bottom: 15px !important;
+        font-size: clamp(1.4rem, 5vw, 1.8rem) !important;
+        font-weight: bold !important;
+        border-radius: 20px !important;
+        margin-bottom: 15px !important;
+        border: 2px solid #ccc !important;
+        box-shadow: 0px 4px 6px rgba(0,0,0,0.1);
+        white-space: normal !important; /* Allow text wrapping */
+        word-wrap: break-word !important;
+        line-height: 1.3 !important;
+    }
+    
+    /* Input fields */
+    div[data-baseweb="input"] > div {
+        min-height: 60px !important;
+        height: auto !important;
+    }
+    input {
+        font-size: 1rem !important;
+    }
+    
+    /* Checkbox/Radio size fix */
+    label[data-baseweb="checkbox"] div:first-child {
+        transform: scale(1.5); /* Scale up the checkbox box itself */
+        margin-right: 15px;
+    }
+
+    /* Container Spacing for Mobile */
+    .block-container {
+        padding-top: 2rem;
+        padding-bottom: 5rem;
+        padding-left: 1rem !important;
+        padding-right: 1rem !important;
+    }
+</style>
+"""
+
+def inject_global_css():
+    st.markdown(GLOBAL_CSS, unsafe_allow_html=True)
+
+SOS_BUTTON_HTML = """
+        <a href="tel:1669" style="text-decoration: none;">
+            <div style="
+                display: flex; flex-direction: column; justify-content: center; align-items: center;
+                width: 100%; min-height: 120px; 
+                padding: 15px;
+                background-color: #C0392B; color: white; 
+                border-radius: 25px; 
+                font-weight: bold; cursor: pointer;
+                box-shadow: 0px 5px 15px rgba(192, 57, 43, 0.4);
+                border: 4px solid white;
+                transition: transform 0.1s;
+            ">
+                <span style="font-size: 4rem; line-height: 1;">🚑</span>
+                <span style="font-size: clamp(1.6rem, 5vw, 2rem); margin-top: 5px;">แจ้งฉุกเฉิน</span>
+            </div>
+        </a>
+"""
+
 def big_button(label, key=None, primary=False):
     """
     Renders a big button using custom CSS class. 
@@ -10,16 +117,8 @@ def big_button(label, key=None, primary=False):
     type_arg = "primary" if primary else "secondary"
     return st.button(label, key=key, type=type_arg, use_container_width=True)
 
-def med_card(med_data, on_click_action=None):
-    """
-    Renders a medication card with big text.
-    med_data: tuple/dict from DB
-    """
-    # med_data = (id, name, image_path, dosage, frequency, stock, created_at)
-    med_id, name, img, dosage, freq, stock, _ = med_data
-    
-    with st.container():
-        st.markdown(f"""
+# One template for every card; filled in one pass by med_cards()
+MED_CARD_TEMPLATE = """
         <div style="
             background-color: #E8F8F5; 
             padding: 20px; 
@@ -28,15 +127,64 @@ def med_card(med_data, on_click_action=None):
             margin-bottom: 20px;
             box-shadow: 0px 4px 6px rgba(0,0,0,0.1);
         ">
+            {thumb}
             <h2 style="margin:0; color:#0E6251; font-size: clamp(1.8rem, 6vw, 2.2rem); border-bottom: none;">💊 {name}</h2>
             <div style="font-size: clamp(1.2rem, 4vw, 1.6rem); margin: 10px 0; color: #145A32; line-height: 1.4;">
                 <strong>กินครั้งละ:</strong> {dosage}<br>
-                <strong>เหลือ:</strong> <span style="color:#C0392B; font-weight:bold;">{stock}</span> เม็ด
+                <strong>เหลือ:</strong> <span style="color:#C0392B; font-weight:bold;">{stock}</span> เม็ด{runout}
             </div>
         </div>
-        """, unsafe_allow_html=True)
-        
-        # Action Button - Full Width for easier clicking
-        if on_click_action:
-            if st.button(f"✅ กินแล้ว ({name})", key=f"take_{med_id}", type="primary", use_container_width=True):
-                on_click_action(med_id, name)
+        """
+
+@functools.lru_cache(maxsize=256)
+def _thumb_html(image_path):
+    # Inlined as a data URI so the card is a single element instead of image + markdown
+    thumb = image_store.existing_thumbnail(image_path)
+    if not thumb:
+        return ""
+    with open(thumb, 'rb') as f:
+        encoded = base64.b64encode(f.read()).decode('ascii')
+    return f'<img src="data:image/jpeg;base64,{encoded}" style="width:120px; border-radius:12px; float:right;">'
+
+def _runout_html(runout_date):
+    # runout_date is kept up to date by the stock ledger, so this is a plain read
+    if not runout_date or not isinstance(runout_date, str):
+        return ""
+    year, month, day = runout_date.split('-')
+    return f" (พอถึง {int(day)}/{int(month)})"
+
+def _card_html(name, img, dosage, stock, runout_date=None):
+    return MED_CARD_TEMPLATE.format(
+        thumb=_thumb_html(img) if img else "",
+        name=html.escape(str(name)),
+        dosage=html.escape(str(dosage or '')),
+        stock=stock,
+        runout=_runout_html(runout_date),
+    )
+
+def med_cards(meds, on_click_action=None):
+    """
+    Renders many medication cards.
+    meds: iterable of (id, name, image_path, dosage, frequency, stock, created_at[, runout_date])
+    The markup of every card is built in one pass, then each card is emitted as one
+    markdown element plus its button.
+    """
+    meds = list(meds)
+    cards = [_card_html(name, img, dosage, stock, *runout) for _, name, img, dosage, _, stock, _, *runout in meds]
+
+    for (med_id, name, *_), card in zip(meds, cards):
+        with st.container():
+            st.markdown(card, unsafe_allow_html=True)
+
+            # Action Button - Full Width for easier clicking
+            if on_click_action:
+                if st.button(f"✅ กินแล้ว ({name})", key=f"take_{med_id}", type="primary", use_container_width=True):
+                    on_click_action(med_id, name)
+
+def med_card(med_data, on_click_action=None):
+    """
+    Renders a medication card with big text.
+    med_data: tuple/dict from DB
+    """
+    # med_data = (id, name, image_path, dosage, frequency, stock, created_at)
+    med_cards([med_data], on_click_action)
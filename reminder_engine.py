@@ -0,0 +1,99 @@
+"""
+Ya-Mor Reminder Engine - runs next to the Streamlit app, without a browser:
+
+    python reminder_engine.py
+
+The dashboard only knows what is due when somebody opens it. This process keeps the
+next period end of every scheduled medication in a heap and sleeps until the earliest
+one (waking every CHANGE_CHECK_SEC to pick up medications added meanwhile). When a
+period closes, every dose of it that was not taken/skipped is written as 'missed' in
+one transaction and the caregiver gets one LINE alert (via the outbox).
+"""
+import datetime
+import heapq
+import threading
+import time
+from itertools import groupby
+
+from modules import database, notifications, schedule
+
+CHANGE_CHECK_SEC = 60 # Longest a new medication's schedule can wait to be picked up
+
+class ReminderEngine:
+    def __init__(self):
+        self._heap = [] # (period end as unix time, period, med_id)
+        self._schedules = [] # get_schedules() rows the heap was built from
+        self._stop = threading.Event()
+        self._schedules_changed = None
+
+    def load(self, after=None):
+        """
+        (Re)builds the heap from medication_schedules: one pending event per med and
+        period, the first period end after 'after' (default: now).
+        """
+        after = after or datetime.datetime.now()
+        self._schedules = database.get_schedules()
+        self._heap = [
+            (schedule.next_period_end(period, after).timestamp(), period, med_id)
+            for med_id, period in self._schedules
+        ]
+        heapq.heapify(self._heap)
+        print(f"[reminder] loaded {len(self._heap)} scheduled doses")
+
+    def _process_due(self):
+        database.ensure_dose_instances() # Keeps tomorrow's doses generated even if nobody opens the app
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+
+        # Every med of one period shares the same end time: one bulk check per period
+        for (end_ts, period), events in groupby(due, key=lambda e: (e[0], e[1])):
+            med_ids = [med_id for _, _, med_id in events]
+            end = datetime.datetime.fromtimestamp(end_ts)
+            start, _ = schedule.period_window((end - datetime.timedelta(seconds=1)).date(), period)
+            missed = database.record_missed_doses(period, start, end, med_ids)
+            if missed:
+                print(f"[reminder] {period} {end:%Y-%m-%d}: missed {len(missed)} dose(s)")
+                notifications.wake_outbox_worker()
+
+            next_ts = schedule.next_period_end(period, end).timestamp()
+            for med_id in med_ids:
+                heapq.heappush(self._heap, (next_ts, period, med_id))
+
+    def run(self):
+        database.init_db()
+        notifications.start_outbox_worker()
+        self._schedules_changed = database.open_change_probe()
+        self.load()
+
+        while not self._stop.is_set():
+            # Something was committed (any table, any process): rebuild if the schedules
+            # changed - a medication added at 9:00 for noon must not wait for tonight's
+            # event. From just before the earliest due event, so it is not skipped to tomorrow.
+            if self._schedules_changed() and database.get_schedules() != self._schedules:
+                after = datetime.datetime.now()
+                if self._heap:
+                    after = min(after, datetime.datetime.fromtimestamp(self._heap[0][0] - 1))
+                self.load(after=after)
+
+            if not self._heap:
+                self._stop.wait(CHANGE_CHECK_SEC) # Nothing scheduled yet
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                self._stop.wait(min(delay, CHANGE_CHECK_SEC)) # Sleep until the next period closes
+                continue
+
+            self._process_due()
+
+    def stop(self):
+        self._stop.set()
+
+if __name__ == "__main__":
+    engine = ReminderEngine()
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        engine.stop()
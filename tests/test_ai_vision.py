@@ -0,0 +1,39 @@
+import threading
+import time
+
+from modules import ai_vision
+
+class FakeModel:
+    latency = {"fast": 0.3, "slow": 5.0}
+
+    def __init__(self, name, sent):
+        self.name = name
+        self.sent = sent
+
+    def generate_content(self, parts, generation_config=None, request_options=None):
+        self.sent.append(self.name)
+        time.sleep(self.latency[self.name])
+        return type("Response", (), {"text": "ok"})()
+
+def router(names, sent):
+    return ai_vision.ModelRouter(names, lambda name: FakeModel(name, sent))
+
+def test_concurrent_calls_do_not_queue_behind_each_other():
+    sent = []
+    models = router(["fast"], sent)
+    results = []
+    calls = [threading.Thread(target=lambda: results.append(models.generate([], str, deadline_sec=1.0))) for _ in range(8)]
+    for call in calls:
+        call.start()
+    for call in calls:
+        call.join()
+    assert [result for result, _, _ in results] == ["ok"] * 8
+    assert len(sent) == 8
+
+def test_deadline_cancels_fallbacks_and_opens_the_circuit():
+    sent = []
+    models = router(["slow", "fast"], sent)
+    result, _, errors = models.generate([], str, deadline_sec=0.2)
+    assert result is None and "timeout" in errors[-1]
+    assert sent == ["slow"] # The fallback never started after the deadline
+    assert models._failures["slow"] == 1
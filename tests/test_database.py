@@ -0,0 +1,58 @@
+import datetime
+
+import pytest
+
+from modules import ai_vision, database
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_FILE", str(tmp_path / "test.db"))
+    database.init_db()
+    yield database
+    database.close_connections()
+
+def test_combination_product_is_not_renamed_to_one_ingredient(db):
+    record, drug = ai_vision.apply_catalog(ai_vision.LabelRecord(medicine_name="Amlodipine + Atorvastatin 5 mg/10 mg"))
+    assert record.medicine_name == "Amlodipine + Atorvastatin 5 mg/10 mg"
+    assert drug is None
+
+    record, drug = ai_vision.apply_catalog(ai_vision.LabelRecord(medicine_name="Calcium + Vit D"))
+    assert record.medicine_name == "Calcium + Vit D"
+    assert record.dosage # Empty fields still come from the catalog
+    assert drug is None
+
+def test_single_ingredient_is_normalized(db):
+    record, drug = ai_vision.apply_catalog(ai_vision.LabelRecord(medicine_name="Norvasc 5 mg"))
+    assert record.medicine_name == "Amlodipine 5 mg"
+    assert drug["generic_name"] == "Amlodipine"
+
+def test_combination_product_is_not_a_refill_of_one_ingredient(db):
+    db.add_medication("Atorvastatin 10 mg", None, "1 เม็ด", ["bedtime"], 30)
+    assert db.find_existing_medication("Amlodipine + Atorvastatin 10 mg") is None
+    assert db.find_existing_medication("Lipitor 10 mg")["name"] == "Atorvastatin 10 mg"
+
+def test_dose_units_count_only_counted_numbers():
+    assert database.parse_dose_units("2 เม็ด") == 2
+    assert database.parse_dose_units("1/2 tablet") == 1
+    assert database.parse_dose_units("2 tabs") == 2
+    assert database.parse_dose_units("1 ช้อนชา") == 1
+    assert database.parse_dose_units("5 mg") == 1
+    assert database.parse_dose_units("Warfarin 3 mg") == 1
+    assert database.parse_dose_units("10 ml") == 1
+    assert database.parse_dose_units("500 mg 1 tab") == 1
+    assert database.parse_dose_units("500 มก. ครั้งละ 2 เม็ด") == 2
+    assert database.parse_dose_units("") == 1
+
+def test_strength_in_dosage_does_not_drain_stock(db):
+    db.add_medication("Warfarin", None, "3 mg", ["bedtime"], 30)
+    status = db.get_refill_status()
+    assert status["daily_usage"].tolist() == [1]
+
+def test_add_medication_refreshes_cached_reads(db):
+    today = datetime.date.today()
+    db.ensure_dose_instances(today)
+    assert db.get_pending_doses(today, "bedtime").empty # Cached now
+    assert db.get_stock_movements(1).empty
+    db.add_medication("Simvastatin 20 mg", None, "1 เม็ด", ["bedtime"], 30)
+    assert db.get_pending_doses(today, "bedtime")["name"].tolist() == ["Simvastatin 20 mg"]
+    assert db.get_stock_movements(1)["stock_after"].tolist() == [30] # Opening balance
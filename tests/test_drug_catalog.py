@@ -0,0 +1,18 @@
+from modules import drug_catalog
+
+def test_combination_products_are_detected():
+    assert drug_catalog.is_combination("Amlodipine + Atorvastatin 5 mg/10 mg")
+    assert drug_catalog.is_combination("Calcium + Vit D")
+    assert drug_catalog.is_combination("Losartan/HCTZ 50/12.5 mg")
+    assert drug_catalog.is_combination("Calcium & Vitamin D")
+    assert not drug_catalog.is_combination("Atorvastatin 5 mg/10 mg")
+    assert not drug_catalog.is_combination("Sara 500 mg")
+
+def test_full_match_needs_every_ingredient():
+    assert drug_catalog.is_full_match("Atorvastatin 10 mg", "Atorvastatin")
+    assert drug_catalog.is_full_match("Amlodipin 5mg tablets", "Amlodipine") # Typo and form word
+    assert drug_catalog.is_full_match("Sara 500 mg", "Sara")
+    assert drug_catalog.is_full_match("Glucophage 500", "Glucophage")
+    assert not drug_catalog.is_full_match("Amlodipine + Atorvastatin 5 mg/10 mg", "Atorvastatin")
+    assert not drug_catalog.is_full_match("Calcium + Vit D", "Calcium")
+    assert not drug_catalog.is_full_match("Calcium Vit D", "Calcium")